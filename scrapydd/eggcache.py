@@ -0,0 +1,93 @@
+import os
+import urllib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EggCache(object):
+    '''
+    Persistent cache of project eggs on agent, keyed by project and version, the hash of
+    egg, which is the ETag returned by server, is kept in a sidecar file beside it.
+    Least recently used eggs are evicted when the total size exceeds max_size.
+    '''
+    cache_dir = 'eggs-cache'
+
+    def __init__(self, max_size=100 * 1024 * 1024, cache_dir=None):
+        self.max_size = max_size
+        if cache_dir is not None:
+            self.cache_dir = cache_dir
+
+    def _safe_name(self, value):
+        # escaped reversibly, different names never share a file.
+        return urllib.quote(str(value), safe='')
+
+    def _project_dir(self, project):
+        return os.path.join(self.cache_dir, self._safe_name(project))
+
+    def path(self, project, version):
+        return os.path.join(self._project_dir(project), '%s.egg' % self._safe_name(version))
+
+    def _hash_path(self, egg_path):
+        return egg_path[:-len('.egg')] + '.hash'
+
+    def get(self, project, version):
+        '''
+        Returns (path, hash) of the cached egg of the project version, None if it is not
+        cached. The egg is marked as used.
+        '''
+        path = self.path(project, version)
+        hash_path = self._hash_path(path)
+        if not os.path.exists(path) or not os.path.exists(hash_path):
+            return None
+        with open(hash_path, 'r') as f:
+            egg_hash = f.read()
+        os.utime(path, None)
+        return path, egg_hash
+
+    def put(self, project, version, egg_hash, data):
+        '''
+        Store an egg and evict the least recently used ones, returns the path.
+        '''
+        path = self.path(project, version)
+        project_dir = os.path.dirname(path)
+        if not os.path.exists(project_dir):
+            os.makedirs(project_dir)
+        # the egg is replaced before its hash, a stale hash only causes downloading again.
+        self._write_file(path, data)
+        self._write_file(self._hash_path(path), egg_hash)
+        self.evict(keep=path)
+        return path
+
+    def _write_file(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+    def evict(self, keep=None):
+        '''
+        Remove least recently used eggs until the total size is within max_size.
+        '''
+        if not os.path.exists(self.cache_dir):
+            return
+        eggs = []
+        for project in os.listdir(self.cache_dir):
+            project_dir = os.path.join(self.cache_dir, project)
+            for filename in os.listdir(project_dir):
+                if filename.endswith('.egg'):
+                    path = os.path.join(project_dir, filename)
+                    eggs.append((os.path.getmtime(path), os.path.getsize(path), path))
+        total_size = sum(size for mtime, size, path in eggs)
+        for mtime, size, path in sorted(eggs):
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            logger.debug('evicting cached egg %s' % path)
+            os.remove(path)
+            if os.path.exists(self._hash_path(path)):
+                os.remove(self._hash_path(path))
+            total_size -= size
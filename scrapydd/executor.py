@@ -1,11 +1,11 @@
 from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.concurrent import Future
 from tornado.gen import coroutine
+from tornado.locks import Condition
 import urllib2, urllib
 import json
 from scrapyd.eggstorage import FilesystemEggStorage
 import scrapyd.config
-import subprocess
 import os
 import urlparse
 import logging
@@ -16,8 +16,18 @@ from w3lib.url import path_to_file_uri
 import socket
 from tornado import gen
 from workspace import ProjectWorkspace
+from .storage import compress_file, file_checksum
+from .stats import read_log_stats
+from .eggcache import EggCache
+from .process import wait_for_exit
+from tornado.process import Subprocess
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 import shutil
+import datetime
+import time
+import functools
+import hashlib
 from exceptions import *
 
 logger = logging.getLogger(__name__)
@@ -54,6 +64,9 @@ class TaskSlotContainer():
                 return False
         return True
 
+    def free_count(self):
+        return len([slot for slot in self.slots if slot is None])
+
     def put_task(self, task):
         if not isinstance(task, TaskExecutor):
             raise ValueError('Task in TaskSlotContainer must be TaskExecutor type.')
@@ -85,16 +98,47 @@ class TaskSlotContainer():
 class Executor():
     heartbeat_interval = 10
     checktask_interval = 10
+    wait_task_timeout = 30
+    # seconds before a failed provisioning of a project version is tried again.
+    provision_retry_interval = 600
 
     def __init__(self, config=None):
         self.ioloop = IOLoop.current()
         self.node_id = None
         self.status = EXECUTOR_STATUS_OFFLINE
+        # long-poll server for new tasks, turned off if server does not support it.
+        self.wait_task_enabled = True
+        self.leasing_task = False
+        self.slot_released = Condition()
+        # log and items files are gzipped before uploading.
+        self.compress_executor = ThreadPoolExecutor(1)
 
         if config is None:
             config =AgentConfig()
         self.task_slots = TaskSlotContainer(config.getint('slots', 1))
         self.config = config
+        # log and items of running tasks are shipped to server every log_ship_interval and
+        # items_ship_interval seconds, 0 to disable.
+        self.ship_intervals = {
+            'log': config.getint('log_ship_interval', 10),
+            'items': config.getint('items_ship_interval', 0),
+        }
+        self.ship_max_size = 1024 * 1024
+        # eggs of projects run recently are kept on agent, up to egg_cache_size MB.
+        self.egg_cache = EggCache(config.getint('egg_cache_size', 100) * 1024 * 1024)
+        # workspaces of projects in warm_projects or run before are provisioned in background when
+        # server announces a new version, and venv_pool_size blank virtualenvs are kept ready.
+        # project versions are fetched only when their digest in heartbeat response changes.
+        self.warm_projects = [project.strip() for project in config.get('warm_projects', '').split(',') if project.strip()]
+        self.venv_pool_size = config.getint('venv_pool_size', 1)
+        self.projects_digest = None
+        self.project_versions = {}
+        self.provisioned_versions = {}
+        # project_name -> (version, time) of the last failed provisioning
+        self.provision_failures = {}
+        self.provisioning = set()
+        # chunk size of resumable uploads of completed tasks.
+        self.upload_chunk_size = 1024 * 1024
         # if server_https_port is configured, prefer to use it.
         if config.get('server_https_port'):
             self.service_base = 'https://%s:%d'% (config.get('server'), config.getint('server_https_port'))
@@ -126,6 +170,17 @@ class Executor():
         # client sill need to poll GET_TASK.
         self.checktask_callback = PeriodicCallback(self.check_task, self.checktask_interval*1000)
 
+        # wait_task is notified by server as soon as new task is queued, the heartbeat header
+        # still works as a fallback.
+        self.ioloop.add_callback(self.wait_task)
+
+        for output_name, ship_interval in self.ship_intervals.items():
+            if ship_interval > 0:
+                PeriodicCallback(functools.partial(self.ship_outputs, output_name), ship_interval*1000).start()
+
+        if self.venv_pool_size > 0:
+            self.ioloop.add_callback(ProjectWorkspace.fill_pool, self.venv_pool_size)
+
         # code for debuging memory leak
         # import objgraph
         # def check_memory():
@@ -174,6 +229,7 @@ class Executor():
                         logger.info('%s' % task_to_kill)
                         task_to_kill.kill()
             self.check_header_new_task_on_server(res.headers)
+            yield self.check_header_projects(res.headers)
         except urllib2.HTTPError as e:
             if e.code == 400:
                 logging.warning('Node expired, register now.')
@@ -190,6 +246,69 @@ class Executor():
             logging.warning('Cannot connect to server. %s' % e)
 
 
+    @coroutine
+    def check_header_projects(self, headers):
+        '''
+        Fetch project versions when their digest announced by server changes, and provision
+        workspaces of new versions.
+        '''
+        projects_digest = headers.get('X-DD-Projects-Digest')
+        if projects_digest and projects_digest != self.projects_digest:
+            url = urlparse.urljoin(self.service_base, '/executing/projects')
+            try:
+                response = yield self.httpclient.fetch(url)
+                self.project_versions = json.loads(response.body)
+                self.projects_digest = projects_digest
+            except Exception as e:
+                logger.warning('Cannot fetch project versions: %s' % e)
+        self.provision_projects()
+
+    def provision_projects(self):
+        '''
+        Provision workspaces of projects in warm_projects or run on this agent before, which are
+        not at the version server has. Failed ones are tried again after provision_retry_interval.
+        '''
+        if not self.project_versions:
+            return
+        ready_projects = ProjectWorkspace.list_ready_projects()
+        now = time.time()
+        for project_name, version in self.project_versions.items():
+            if version is None or project_name in self.provisioning:
+                continue
+            if project_name not in self.warm_projects and project_name not in ready_projects:
+                continue
+            if self.provisioned_versions.get(project_name) == version:
+                continue
+            failed_version, failed_time = self.provision_failures.get(project_name, (None, 0))
+            if failed_version == version and now - failed_time < self.provision_retry_interval:
+                continue
+            self.ioloop.add_callback(self.provision_project, project_name, version)
+
+    @coroutine
+    def provision_project(self, project_name, version):
+        '''
+        Create the virtualenv of a project, cache its egg and install the requirements ahead of
+        jobs, so the first job of a new version starts like the following ones.
+        '''
+        self.provisioning.add(project_name)
+        try:
+            logger.info('provisioning workspace of project %s version %s.' % (project_name, version))
+            workspace = ProjectWorkspace(project_name)
+            yield workspace.init()
+            egg_request_url = urlparse.urljoin(self.service_base, '/projects/%s/egg' % project_name)
+            egg_path = yield fetch_egg(self.httpclient, self.egg_cache, egg_request_url, project_name, version)
+            with open(egg_path, 'rb') as eggf:
+                requirements = workspace.find_project_requirements(project_name, eggf=eggf)
+            yield workspace.pip_install(requirements)
+            logger.info('workspace of project %s version %s is ready.' % (project_name, version))
+            self.provisioned_versions[project_name] = version
+            self.provision_failures.pop(project_name, None)
+        except Exception as e:
+            logger.warning('Error when provisioning workspace of project %s: %s' % (project_name, e))
+            self.provision_failures[project_name] = (version, time.time())
+        finally:
+            self.provisioning.discard(project_name)
+
     @coroutine
     def register_node(self):
         if self.service_base.startswith('https') and not os.path.exists('keys/ca.crt') :
@@ -201,7 +320,9 @@ class Executor():
             open('keys/ca.crt', 'wb').write(cacertresponse.body)
         try:
             url = urlparse.urljoin(self.service_base, '/nodes')
-            request = HTTPRequest(url = url, method='POST', body='')
+            post_data = urllib.urlencode({'slots': self.task_slots.max_size,
+                                          'tags': self.config.get('tags', '')})
+            request = HTTPRequest(url = url, method='POST', body=post_data)
             res = yield self.httpclient.fetch(request)
             self.status = EXECUTOR_STATUS_ONLINE
             self.node_id = json.loads(res.body)['id']
@@ -211,16 +332,80 @@ class Executor():
         except socket.error as e:
             logging.warning('Cannot connect to server, %s' % e)
 
-    def on_new_task_reach(self, task):
-        if task is not None:
+    def on_new_task_reach(self, tasks):
+        for task in tasks:
+            if self.task_slots.is_full():
+                logger.warning('No free slot for task %s.' % task.id)
+                break
             task_executor = self.execute_task(task)
             self.task_slots.put_task(task_executor)
 
+    def parse_task(self, task_data):
+        task = SpiderTask()
+        task.id = task_data['task']['task_id']
+        task.spider_id = task_data['task']['spider_id']
+        task.project_name = task_data['task']['project_name']
+        task.project_version = task_data['task']['version']
+        task.spider_name = task_data['task']['spider_name']
+        if 'spider_parameters' in task_data['task']:
+            task.spider_parameters = task_data['task']['spider_parameters']
+        else:
+            task.spider_parameters = {}
+        return task
+
+    @coroutine
+    def wait_task(self):
+        '''
+        Park a long-poll request on server, which responses as soon as new task is queued,
+        then lease it without waiting for the next heartbeat.
+        '''
+        url = urlparse.urljoin(self.service_base, '/executing/wait_task')
+        while self.wait_task_enabled:
+            if self.status == EXECUTOR_STATUS_OFFLINE:
+                yield gen.sleep(self.heartbeat_interval)
+                continue
+            if self.task_slots.is_full():
+                yield self.slot_released.wait(timeout=datetime.timedelta(seconds=self.heartbeat_interval))
+                continue
+
+            post_data = urllib.urlencode({'node_id': self.node_id, 'timeout': self.wait_task_timeout})
+            request = HTTPRequest(url=url, method='POST', body=post_data,
+                                  request_timeout=self.wait_task_timeout + self.heartbeat_interval)
+            try:
+                response = yield self.httpclient.fetch(request)
+                if json.loads(response.body)['new_task']:
+                    leased_tasks = yield self.get_next_task()
+                    if not leased_tasks:
+                        # the task is leased by others, or leasing is in flight.
+                        yield gen.sleep(self.heartbeat_interval)
+            except HTTPError as e:
+                if e.code == 404:
+                    logger.info('Server does not support waiting task, checking new task on heartbeat.')
+                    self.wait_task_enabled = False
+                    return
+                logger.warning('Error when waiting task. %s' % e)
+                yield gen.sleep(self.heartbeat_interval)
+            except Exception as e:
+                logger.warning('Cannot connect to server. %s' % e)
+                yield gen.sleep(self.heartbeat_interval)
 
     @coroutine
     def get_next_task(self):
+        '''
+        Lease as many tasks as free slots in one request.
+
+        :return: future of the count of leased tasks.
+        '''
+        # heartbeat and wait_task can both trigger leasing, only one request is in flight
+        # to not lease more tasks than free slots.
+        if self.leasing_task:
+            raise gen.Return(0)
+        self.leasing_task = True
+        tasks = []
         url = urlparse.urljoin(self.service_base, '/executing/next_task')
-        post_data = urllib.urlencode({'node_id': self.node_id})
+        post_data = urllib.urlencode({'node_id': self.node_id,
+                                      'max_tasks': self.task_slots.free_count(),
+                                      'projects': ','.join(ProjectWorkspace.list_ready_projects())})
         request = HTTPRequest(url=url, method='POST', body=post_data)
         try:
             response = yield self.httpclient.fetch(request)
@@ -228,23 +413,22 @@ class Executor():
             response_data = json.loads(response_content)
             logger.debug(url)
             logger.debug(response_content)
-            if response_data['data'] is not None:
-                task = SpiderTask()
-                task.id = response_data['data']['task']['task_id']
-                task.spider_id = response_data['data']['task']['spider_id']
-                task.project_name = response_data['data']['task']['project_name']
-                task.project_version = response_data['data']['task']['version']
-                task.spider_name = response_data['data']['task']['spider_name']
-                if 'spider_parameters' in response_data['data']['task']:
-                    task.spider_parameters = response_data['data']['task']['spider_parameters']
-                else:
-                    task.spider_parameters = {}
-                self.on_new_task_reach(task)
+            tasks_data = response_data['data']
+            if tasks_data is None:
+                tasks_data = []
+            # old version server ignores max_tasks and responses a single task.
+            elif isinstance(tasks_data, dict):
+                tasks_data = [tasks_data]
+            tasks = [self.parse_task(task_data) for task_data in tasks_data]
+            self.on_new_task_reach(tasks)
         except urllib2.URLError:
             logger.warning('Cannot connect to server')
+        finally:
+            self.leasing_task = False
+        raise gen.Return(len(tasks))
 
     def execute_task(self, task):
-        executor = TaskExecutor(task, config=self.config)
+        executor = TaskExecutor(task, config=self.config, egg_cache=self.egg_cache)
         pid = None
         future = executor.execute()
         self.post_start_task(task, pid)
@@ -264,38 +448,144 @@ class Executor():
         except urllib2.HTTPError as e:
             logger.error('Error when post_task_task: %s' % e)
 
+    @gen.coroutine
     def complete_task(self, task_executor, status):
         '''
+        Upload log and items files gzipped, they are compressed in a background thread.
+        Files are sent by a resumable upload in checksummed chunks, so a retry only sends what
+        server has not received. Servers not supporting it get them in the complete request.
         @type task_executor: TaskExecutor
         '''
         url = urlparse.urljoin(self.service_base, '/executing/complete')
 
-        log_file = open(task_executor.output_file, 'rb')
+        # stop shipping, the rest of log and items after shipped offsets are uploaded.
+        for output_name in self.ship_intervals:
+            task_executor.shipping[output_name] = False
+            if output_name in task_executor.ship_futures:
+                yield task_executor.ship_futures[output_name]
+
+        # stats are read from the tail of plain log here, server does not need to decompress the log.
+        log_path = task_executor.output_path('log')
+        stats = None
+        if os.path.exists(log_path):
+            stats = yield self.compress_executor.submit(read_log_stats, log_path)
+        upload_files = {'log': (yield self.compress_output(task_executor, 'log'))}
+        if task_executor.items_file and os.path.exists(task_executor.items_file):
+            logger.debug('item file size : %d' % os.path.getsize(task_executor.items_file))
+            upload_files['items'] = yield self.compress_output(task_executor, 'items')
 
         post_data = {
             'task_id': task_executor.task.id,
             'status': status,
-            'log': log_file,
+            'stats': json.dumps(stats or {}),
         }
+        for output_name, offset in task_executor.shipped_offsets.items():
+            if offset:
+                post_data['%s_offset' % output_name] = str(offset)
+
+        try:
+            upload_id = yield self.upload_task_files(task_executor, upload_files)
+        except Exception as e:
+            upload_id = None
+            if self.is_transient_error(e):
+                logger.warning('Error when uploading files of task %s, retry in 10 seconds: %s' % (task_executor.task.id, e))
+                self.ioloop.call_later(10, self.complete_task, task_executor, status)
+                return
+            logger.warning('Error when uploading files of task %s: %s' % (task_executor.task.id, e))
+
+        opened_files = []
+        if upload_id:
+            post_data['upload_id'] = upload_id
+            for output_name, path in upload_files.items():
+                post_data['%s_checksum' % output_name] = yield self.compress_executor.submit(file_checksum, path)
+        else:
+            for output_name, path in upload_files.items():
+                post_data[output_name] = f = open(path, 'rb')
+                opened_files.append(f)
 
-        items_file = None
-        if task_executor.items_file and os.path.exists(task_executor.items_file):
-            post_data['items'] = items_file = open(task_executor.items_file, "rb")
-            logger.debug('item file size : %d' % os.path.getsize(task_executor.items_file))
         logger.debug(post_data)
         datagen, headers = multipart_encode(post_data)
         headers['X-DD-Nodeid'] = str(self.node_id)
         request = HTTPRequest(url, method='POST', headers=headers, body_producer=MultipartRequestBodyProducer(datagen))
         client = self.httpclient
         future = client.fetch(request, raise_error=False)
-        self.ioloop.add_future(future, self.complete_task_done(task_executor, log_file, items_file))
+        self.ioloop.add_future(future, self.complete_task_done(task_executor, status, opened_files))
         logger.info('task %s finished' % task_executor.task.id)
 
+    @gen.coroutine
+    def upload_task_files(self, task_executor, upload_files):
+        '''
+        Resumable upload of the gzipped files of a task in checksummed chunks, starting from
+        what server has received for the upload of the task. Returns the upload id, or None if
+        server does not support resumable uploads.
+        '''
+        upload_url = urlparse.urljoin(self.service_base, '/executing/uploads')
+        headers = {'X-DD-Nodeid': str(self.node_id)}
+        received = {}
+        if task_executor.upload_id:
+            response = yield self.httpclient.fetch('%s/%s' % (upload_url, task_executor.upload_id), headers=headers,
+                                                   raise_error=False)
+            if response.code in (403, 404):
+                # removed on server, or not of this node, start over.
+                task_executor.upload_id = None
+            elif response.error:
+                raise response.error
+            else:
+                received = json.loads(response.body)['files']
+        if not task_executor.upload_id:
+            response = yield self.httpclient.fetch(upload_url, method='POST', headers=headers, raise_error=False,
+                                                   body=urllib.urlencode({'task_id': task_executor.task.id}))
+            if response.code in (403, 404, 405):
+                # old server, or the job is no longer running on server or on this node.
+                raise gen.Return(None)
+            if response.error:
+                raise response.error
+            task_executor.upload_id = json.loads(response.body)['upload_id']
+
+        for output_name, path in upload_files.items():
+            offset = received.get(output_name, 0)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(self.upload_chunk_size)
+                while data:
+                    chunk_headers = dict(headers)
+                    chunk_headers['X-DD-Checksum'] = hashlib.md5(data).hexdigest()
+                    request = HTTPRequest('%s/%s/%s?offset=%d' % (upload_url, task_executor.upload_id, output_name, offset),
+                                          method='POST', headers=chunk_headers, body=data)
+                    response = yield self.httpclient.fetch(request, raise_error=False)
+                    if response.code == 409:
+                        # server has received different length, continue from there.
+                        offset = int(response.headers['X-DD-Offset'])
+                        f.seek(offset)
+                    elif response.error:
+                        raise response.error
+                    else:
+                        offset += len(data)
+                    data = f.read(self.upload_chunk_size)
+        raise gen.Return(task_executor.upload_id)
+
+    def is_transient_error(self, error):
+        '''
+        Network errors and timeouts, the request can be retried later.
+        '''
+        return isinstance(error, socket.error) or (isinstance(error, HTTPError) and error.code == 599)
 
-    def complete_task_done(self, task_executor, log_file, items_file):
+    def compress_output(self, task_executor, output_name):
+        '''
+        Gzip log or items file of a task in background, from the offset shipped to server.
+        '''
+        path = task_executor.output_path(output_name)
+        offset = task_executor.shipped_offsets[output_name]
+        if offset:
+            return self.compress_executor.submit(compress_file, path, path + '.rest.gz', offset)
+        return self.compress_executor.submit(compress_file, path)
+
+    def complete_task_done(self, task_executor, status, opened_files):
         def complete_task_done_f(future):
             '''
-            The callback of complete job request, if socket error occurred, retry commiting complete request in 10 seconds.
+            The callback of complete job request, if socket error occurred or the uploaded files
+            do not verify, retry commiting complete request in 10 seconds. If the resumable upload
+            is missing or expired on server, retry with a new upload.
             If request is completed successfully, remove task from slots.
             Always close stream files.
             @type future: Future
@@ -303,21 +593,70 @@ class Executor():
             '''
             response = future.result()
             logger.debug(response)
-            if log_file:
-                log_file.close()
-            if items_file:
-                items_file.close()
-            if response.error and isinstance(response.error, socket.error):
-                self.ioloop.call_later(10, self.complete_task, task_executor, TASK_STATUS_SUCCESS if task_executor.ret_code == 0 else TASK_STATUS_FAIL)
-                logger.warning('Socket error when completing job, retry in 10 seconds.')
+            for f in opened_files:
+                f.close()
+            if response.error and (self.is_transient_error(response.error) or response.code == 409):
+                self.ioloop.call_later(10, self.complete_task, task_executor, status)
+                logger.warning('Error when completing job, retry in 10 seconds: %s' % response.error)
+                return
+            if task_executor.upload_id and response.code in (403, 404):
+                logger.warning('Upload %s of task %s is not found on server, uploading again.' %
+                               (task_executor.upload_id, task_executor.task.id))
+                task_executor.upload_id = None
+                self.ioloop.add_callback(self.complete_task, task_executor, status)
                 return
 
             if response.error:
                 logger.warning('Error when post task complete request: %s' % response.error)
             self.task_slots.remove_task(task_executor)
+            self.slot_released.notify_all()
             logger.debug('complete_task_done')
         return complete_task_done_f
 
+    def ship_outputs(self, output_name):
+        for task_executor in self.task_slots.tasks():
+            if task_executor.shipping[output_name] and output_name not in task_executor.ship_futures:
+                task_executor.ship_futures[output_name] = self.ship_task_output(task_executor, output_name)
+
+    @gen.coroutine
+    def ship_task_output(self, task_executor, output_name):
+        '''
+        Ship the log or items written since the last shipped offset of a running task.
+        Only complete lines of items are shipped.
+        '''
+        try:
+            path = task_executor.output_path(output_name)
+            offset = task_executor.shipped_offsets[output_name]
+            if not path or not os.path.exists(path) or os.path.getsize(path) <= offset:
+                return
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(self.ship_max_size)
+                if output_name == 'items':
+                    if '\n' not in data:
+                        # an item line longer than ship_max_size
+                        data += f.readline()
+                    data = data[:data.rfind('\n') + 1]
+            if not data:
+                return
+            url = urlparse.urljoin(self.service_base, '/jobs/%s/%s?offset=%d' % (task_executor.task.id,
+                                                                                output_name, offset))
+            request = HTTPRequest(url, method='POST', body=data, headers={'X-DD-Nodeid': str(self.node_id)})
+            response = yield self.httpclient.fetch(request, raise_error=False)
+            if response.code == 200:
+                task_executor.shipped_offsets[output_name] = offset + len(data)
+            elif response.code == 409:
+                # server has received different length, continue from there.
+                task_executor.shipped_offsets[output_name] = int(response.headers['X-DD-Offset'])
+            elif response.code in (403, 404, 405):
+                # old server, or the job is no longer running on server or on this node.
+                logger.warning('Server does not accept %s of task %s, stop shipping.' % (output_name, task_executor.task.id))
+                task_executor.shipping[output_name] = False
+            else:
+                logger.warning('Error when shipping %s of task %s: %s' % (output_name, task_executor.task.id, response.error))
+        finally:
+            task_executor.ship_futures.pop(output_name, None)
+
     def task_finished(self, future):
         task_executor = future.result()
         self.complete_task(task_executor, TASK_STATUS_SUCCESS if task_executor.ret_code == 0 else TASK_STATUS_FAIL)
@@ -326,6 +665,30 @@ class Executor():
         if not self.task_slots.is_full():
             self.get_next_task()
 
+@gen.coroutine
+def fetch_egg(httpclient, egg_cache, url, project_name, version):
+    '''
+    Get an egg through the cache, it is downloaded from url only if the server has a different one.
+    Returns the path of the cached egg.
+    @type egg_cache: EggCache
+    '''
+    cached = egg_cache.get(project_name, version)
+    headers = {}
+    if cached:
+        headers['If-None-Match'] = '"%s"' % cached[1]
+    logger.debug('begin download egg.')
+    response = yield httpclient.fetch(HTTPRequest(url, headers=headers), raise_error=False)
+    if cached and response.code == 304:
+        logger.debug('egg is not modified, use the cached one.')
+        raise gen.Return(cached[0])
+    if response.error:
+        raise response.error
+    egg_hash = response.headers.get('Etag', '').strip('"') or hashlib.md5(response.body).hexdigest()
+    egg_path = egg_cache.put(project_name, version, egg_hash, response.body)
+    logger.debug('download egg done.')
+    raise gen.Return(egg_path)
+
+
 class TaskExecuteResult():
     task = None
     output_file = None
@@ -340,13 +703,17 @@ class TaskExecuteResult():
         self.ret_code = ret_code
 
 class TaskExecutor():
-    def __init__(self, task, config=None):
+    def __init__(self, task, config=None, egg_cache=None):
         '''
         @type task: SpiderTask
+        @type egg_cache: EggCache
         '''
         self.task = task
         if config is None:
             config = AgentConfig()
+        if egg_cache is None:
+            egg_cache = EggCache(config.getint('egg_cache_size', 100) * 1024 * 1024)
+        self.egg_cache = egg_cache
         if config.get('server_https_port'):
             self.service_base = 'https://%s:%d' % (config.get('server'), config.getint('server_https_port'))
         else:
@@ -354,9 +721,15 @@ class TaskExecutor():
         self._f_output = None
         self.output_file = None
         self.p = None
-        self.check_process_callback = None
         self.items_file = None
         self.ret_code = None
+        # length of log and items received by server while running, shipping is turned off
+        # when the task is completing or server does not accept it.
+        self.shipped_offsets = {'log': 0, 'items': 0}
+        self.shipping = {'log': True, 'items': True}
+        self.ship_futures = {}
+        # resumable upload of log and items files when completing.
+        self.upload_id = None
         self.workspace_dir = tempfile.mkdtemp(prefix='ddjob-%s-%s-' % (task.project_name, task.id))
         if not os.path.exists(self.workspace_dir):
             os.makedirs(self.workspace_dir)
@@ -374,13 +747,9 @@ class TaskExecutor():
         try:
             workspace = ProjectWorkspace(self.task.project_name)
             yield workspace.init()
-            logger.debug('begin download egg.')
-            egg_request_url = urlparse.urljoin(self.service_base, '/spiders/%d/egg' % self.task.spider_id)
-            request = HTTPRequest(egg_request_url)
-            client = AsyncHTTPClient()
-            response = yield client.fetch(request)
-            self.egg_storage.put(response.buffer, self.task.project_name, self.task.project_version)
-            logger.debug('download egg done.')
+            egg_path = yield self.download_egg()
+            with open(egg_path, 'rb') as f:
+                self.egg_storage.put(f, self.task.project_name, self.task.project_version)
             requirements = workspace.find_project_requirements(self.task.project_name, egg_storage=self.egg_storage)
             yield workspace.pip_install(requirements)
             result = yield self.execute_subprocess()
@@ -397,12 +766,14 @@ class TaskExecutor():
             result = self.complete_with_error(error_log)
         raise gen.Return(result)
 
-    def check_process(self):
-        execute_result = self.p.poll()
-        logger.debug('check process')
-        if execute_result is not None:
-            logger.info('task complete')
-            self.complete(execute_result)
+    def download_egg(self):
+        '''
+        Get the egg of the task from cache, it is downloaded only if the server has a different one.
+        Returns future of the path of the cached egg.
+        '''
+        egg_request_url = urlparse.urljoin(self.service_base, '/spiders/%d/egg' % self.task.spider_id)
+        return fetch_egg(AsyncHTTPClient(), self.egg_cache, egg_request_url, self.task.project_name,
+                         self.task.project_version)
 
     def execute_subprocess(self):
         future = Future()
@@ -423,7 +794,8 @@ class TaskExecutor():
         env['SCRAPY_JOB'] = str(self.task.id)
         env['SCRAPY_FEED_URI'] = str(path_to_file_uri(self.items_file))
         try:
-            self.p = subprocess.Popen(pargs, env=env, stdout=self._f_output, cwd=self.workspace_dir, stderr=self._f_output)
+            process = Subprocess(pargs, env=env, stdout=self._f_output, cwd=self.workspace_dir, stderr=self._f_output)
+            self.p = process.proc
             if self.on_subprocess_start:
                 self.on_subprocess_start(self.task, self.p.pid)
 
@@ -431,25 +803,24 @@ class TaskExecutor():
             return self.complete_with_error('Error when starting crawl subprocess : %s' % e)
         logger.info('job %s started on pid: %d' % (self.task.id, self.p.pid))
 
-        def check_process():
-            execute_result = self.p.poll()
-            logger.debug('check process')
-            if execute_result is not None:
-                logger.info('task complete')
-                future.set_result(self.complete(execute_result))
+        def on_exit(exit_future):
+            logger.info('task complete')
+            future.set_result(self.complete(exit_future.result()))
 
-        self.check_process_callback = PeriodicCallback(check_process, 1*1000)
-        self.check_process_callback.start()
+        IOLoop.current().add_future(wait_for_exit(process), on_exit)
         return future
 
     def result(self):
         return self
 
+    def output_path(self, output_name):
+        if output_name == 'log':
+            return self.output_file
+        return self.items_file
+
     def complete(self, ret_code):
         self._f_output.close()
         self.ret_code = ret_code
-        self.check_process_callback.stop()
-        self.check_process_callback = None
         return self.result()
 
     def complete_with_error(self, error_message):
@@ -470,8 +841,9 @@ class TaskExecutor():
         if self.p:
             self.p.terminate()
 
-        gen.sleep(10)
-        if self.p:
+        yield gen.sleep(10)
+        # the exit code is set as soon as the process exits
+        if self.p and self.p.returncode is None:
             self.p.kill()
 
 
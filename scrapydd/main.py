@@ -5,8 +5,8 @@ import tornado.template
 from scrapyd.eggstorage import FilesystemEggStorage
 import scrapyd.config
 from cStringIO import StringIO
-from models import Session, Project, Spider, Trigger, SpiderExecutionQueue, Node, init_database, HistoricalJob, \
-    SpiderWebhook, session_scope, SpiderSettings, WebhookJob, SpiderParameter
+from models import Session, Project, Spider, Trigger, SpiderExecutionQueue, Node, init_database, init_engine, HistoricalJob, \
+    SpiderWebhook, session_scope, SpiderSettings, WebhookJob, SpiderParameter, JobStats
 from schedule import SchedulerManager
 from scrapydd.nodes import NodeManager
 import datetime
@@ -28,10 +28,19 @@ from tornado import gen
 import tornado.httpserver
 import tornado.netutil
 from workspace import ProjectWorkspace
+from .storage import COMPRESSED_SUFFIX, is_compressed, compress_file, compress_streams, iter_file, file_checksum, \
+    live_log_path, live_items_path
+from .stats import read_log_stats
 from scrapydd.cluster import ClusterNode
 from scrapydd.ssl_gen import SSLCertificateGenerator
 import ssl
 import re
+import hashlib
+import uuid
+import shutil
+import gzip
+import time
+from collections import deque, OrderedDict
 from .settting import SpiderSettingLoader
 
 logger = logging.getLogger(__name__)
@@ -227,13 +236,42 @@ class SpiderInstanceHandler2(tornado.web.RequestHandler):
         self.write(loader.load("spider.html").generate(**context))
         session.close()
 
-class SpiderEggHandler(tornado.web.RequestHandler):
+class ProjectEggHandler(tornado.web.RequestHandler):
+    '''
+    The egg of a project, with the md5 of egg as ETag. Agents send the ETag of their cached
+    egg in If-None-Match and get 304 if it is not modified.
+    '''
+    def get(self, project_name):
+        with session_scope() as session:
+            if session.query(Project).filter_by(name=project_name).first() is None:
+                raise tornado.web.HTTPError(404)
+        self.send_egg(project_name)
+
+    def send_egg(self, project_name):
+        version, f = ProjectWorkspace(project_name).get_egg()
+        try:
+            egg = f.read()
+        finally:
+            f.close()
+        self.set_header('ETag', '"%s"' % hashlib.md5(egg).hexdigest())
+        self.set_header('X-DD-Version', version)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(egg)
+
+
+class SpiderEggHandler(ProjectEggHandler):
+    '''
+    The egg of the project of a spider.
+    '''
     def get(self, id):
-        session = Session()
-        spider = session.query(Spider).filter_by(id=id).first()
-        version, f = ProjectWorkspace(spider.project.name).get_egg()
-        self.write(f.read())
-        session.close()
+        with session_scope() as session:
+            spider = session.query(Spider).filter_by(id=id).first()
+            if spider is None:
+                raise tornado.web.HTTPError(404)
+            project_name = spider.project.name
+        self.send_egg(project_name)
 
 
 class SpiderListHandler(tornado.web.RequestHandler):
@@ -285,43 +323,78 @@ class DeleteSpiderTriggersHandler(tornado.web.RequestHandler):
         self.redirect('/projects/%s/spiders/%s' % (project_name, spider_name))
 
 class  ExecuteNextHandler(tornado.web.RequestHandler):
+    # the most tasks a node can lease in one request.
+    max_tasks_limit = 100
+
     def initialize(self, scheduler_manager):
         self.scheduler_manager = scheduler_manager
 
     def post(self):
         with session_scope() as session:
             node_id = int(self.request.arguments['node_id'][0])
-            next_task = self.scheduler_manager.get_next_task(node_id)
+            max_tasks = self.get_argument('max_tasks', None)
+
+            # be compatible with old agent version, which leases one task each time
+            # and expects a single task object in data.
+            if max_tasks is None:
+                next_task = self.scheduler_manager.get_next_task(node_id)
+                response_data = {'data': None}
+                if next_task is not None:
+                    response_data['data'] = self.task_data(session, next_task)
+                self.write(json.dumps(response_data))
+                return
 
-            response_data = {'data': None}
+            max_tasks = min(max(int(max_tasks), 0), self.max_tasks_limit)
+            node_projects = [project for project in self.get_argument('projects', '').split(',') if project]
+            next_tasks = self.scheduler_manager.get_next_tasks(node_id, max_tasks, node_projects) if max_tasks else []
+            tasks_data = [self.task_data(session, next_task) for next_task in next_tasks]
+            response_data = {'data': [task_data for task_data in tasks_data if task_data is not None]}
+            self.write(json.dumps(response_data))
 
-            if next_task is not None:
-                spider = session.query(Spider).filter_by(id=next_task.spider_id).first()
-                if not spider:
-                    logger.error('Task %s has not spider, deleting.' % next_task.id)
-                    session.query(SpiderExecutionQueue).filter_by(id=next_task.id).delete()
-                    self.write({'data': None})
-                    return
+    def task_data(self, session, next_task):
+        spider = session.query(Spider).filter_by(id=next_task.spider_id).first()
+        if not spider:
+            logger.error('Task %s has not spider, deleting.' % next_task.id)
+            session.query(SpiderExecutionQueue).filter_by(id=next_task.id).delete()
+            return None
 
-                project = session.query(Project).filter_by(id=spider.project_id).first()
-                if not project:
-                    logger.error('Task %s has not project, deleting.' % next_task.id)
-                    session.query(SpiderExecutionQueue).filter_by(id=next_task.id).delete()
-                    self.write({'data': None})
-                    return
-                response_data['data'] = {'task':{
-                    'task_id': next_task.id,
-                    'spider_id':  next_task.spider_id,
-                    'spider_name': next_task.spider_name,
-                    'project_name': next_task.project_name,
-                    'version': project.version,
-                    'spider_parameters': {parameter.parameter_key: parameter.value for parameter in spider.parameters}
-                }}
-            self.write(json.dumps(response_data))
+        project = session.query(Project).filter_by(id=spider.project_id).first()
+        if not project:
+            logger.error('Task %s has not project, deleting.' % next_task.id)
+            session.query(SpiderExecutionQueue).filter_by(id=next_task.id).delete()
+            return None
+
+        return {'task':{
+            'task_id': next_task.id,
+            'spider_id':  next_task.spider_id,
+            'spider_name': next_task.spider_name,
+            'project_name': next_task.project_name,
+            'version': project.version,
+            'spider_parameters': {parameter.parameter_key: parameter.value for parameter in spider.parameters}
+        }}
+
+
+class ExecuteWaitTaskHandler(tornado.web.RequestHandler):
+    '''
+    Long-poll request for agents, it responses as soon as new task is queued or timeout.
+    '''
+    max_timeout = 60
+
+    def initialize(self, scheduler_manager):
+        self.scheduler_manager = scheduler_manager
+
+    @gen.coroutine
+    def post(self):
+        timeout = min(float(self.get_argument('timeout', '30')), self.max_timeout)
+        node_id = self.get_argument('node_id', None)
+        new_task = yield self.scheduler_manager.wait_task(timeout, int(node_id) if node_id else None)
+        self.write(json.dumps({'new_task': new_task}))
 
 
 @tornado.web.stream_request_body
 class ExecuteCompleteHandler(tornado.web.RequestHandler):
+    upload_dir = 'uploads'
+
     def initialize(self, webhook_daemon, scheduler_manager):
         '''
 
@@ -331,7 +404,7 @@ class ExecuteCompleteHandler(tornado.web.RequestHandler):
         self.webhook_daemon = webhook_daemon
         self.scheduler_manager = scheduler_manager
 
-    #
+    @gen.coroutine
     def prepare(self):
         MB = 1024 * 1024
         GB = 1024 * MB
@@ -343,11 +416,20 @@ class ExecuteCompleteHandler(tornado.web.RequestHandler):
             total = int(self.request.headers.get("Content-Length", "0"))
         except:
             total = 0
-        self.ps = PostDataStreamer(total)  # ,tmpdir="/tmp"
-
-        # self.fout = open("raw_received.dat","wb+")
+        # back-pressure: do not read more uploads while the completing stage is full.
+        self.complete_slot_acquired = False
+        yield self.scheduler_manager.job_complete_semaphore.acquire()
+        self.complete_slot_acquired = True
+        if self.request.connection.stream.closed():
+            self.release_complete_slot()
+        if not os.path.exists(self.upload_dir):
+            os.makedirs(self.upload_dir)
+        # receive parts beside logs and items, so they can be renamed into place.
+        self.ps = PostDataStreamer(total, tmpdir=self.upload_dir)
 
+    @gen.coroutine
     def post(self):
+        executor = self.scheduler_manager.job_complete_executor
         try:
             self.ps.finish_receive()
             fields = self.ps.get_values(['task_id','status'])
@@ -363,19 +445,81 @@ class ExecuteCompleteHandler(tornado.web.RequestHandler):
                 self.set_status(401, 'Invalid argument: status.')
                 return
 
-            session = Session()
-            query = session.query(SpiderExecutionQueue).filter(SpiderExecutionQueue.id == task_id, SpiderExecutionQueue.status == 1)
             # be compatible with old agent version
+            if not node_id:
+                logger.warning('Agent has not specified node id in complete request, client address: %s.' % self.request.remote_ip)
+
+            # the beginning of log and items has been shipped while running, only the rest is uploaded.
+            log_offset = int(self.get_field('log_offset', 0))
+            items_offset = int(self.get_field('items_offset', 0))
+
+            # files have been sent by a resumable upload, the job is completed only if they verify.
+            upload_id = self.get_field('upload_id')
+            if upload_id:
+                upload = load_resumable_upload(upload_id, task_id)
+                if upload is None:
+                    self.set_status(404, 'Upload not found.')
+                    return
+                if upload['node_id'] != node_id:
+                    self.set_status(403, 'Upload of other node.')
+                    return
+                checksums = dict((name, self.get_field('%s_checksum' % name)) for name in ('log', 'items'))
+                failed_files = yield executor.submit(verify_resumable_upload, upload_id, checksums)
+                if failed_files:
+                    self.set_status(409, 'Upload is not verified.')
+                    self.write(json.dumps({'status': 'error', 'files': failed_files}))
+                    return
+
+            # moving files, parsing log and committing run in the thread pool, keep the IOLoop serving agents.
+            job_found = yield executor.submit(self.complete_job, task_id, node_id, status_int, log_offset, items_offset,
+                                              upload_id, self.get_stats_field())
+            if not job_found:
+                self.set_status(404, 'Job not found.')
+                return
+
+            logger.info('Job %s completed.' % task_id)
+            response_data = {'status': 'ok'}
+            self.write(json.dumps(response_data))
+
+        finally:
+            # Don't forget to release temporary files.
+            yield executor.submit(self.ps.release_parts)
+
+    def get_field(self, name, default=None):
+        parts = self.ps.get_parts_by_name(name)
+        return self.ps.get_part_payload(parts[0]) if parts else default
+
+    def get_stats_field(self):
+        '''
+        The scrapy stats agents read from the log before gzipping it, an empty dict if the log
+        has no stats. None if not sent by old agents, or invalid.
+        '''
+        value = self.get_field('stats')
+        if value is None:
+            return None
+        try:
+            stats = json.loads(value)
+        except ValueError:
+            logger.warning('Invalid stats field: %s' % value)
+            return None
+        return stats if isinstance(stats, dict) else None
+
+    def complete_job(self, task_id, node_id, status_int, log_offset=0, items_offset=0, upload_id=None, stats=None):
+        '''
+        Store log and items files of the job and move it into history.
+        Runs in SchedulerManager.job_complete_executor, must not touch the request.
+        Stats are read from the log if agent has not sent them, before it is gzipped if uploaded plain.
+        Returns False if the job is not found.
+        '''
+        session = Session()
+        try:
+            query = session.query(SpiderExecutionQueue).filter(SpiderExecutionQueue.id == task_id, SpiderExecutionQueue.status == 1)
             if node_id:
                 query = query.filter(SpiderExecutionQueue.node_id == node_id)
-            else:
-                logger.warning('Agent has not specified node id in complete request, client address: %s.' % self.request.remote_ip)
             job = query.first()
 
             if job is None:
-                self.set_status(404, 'Job not found.')
-                session.close()
-                return
+                return False
             log_file = None
             items_file = None
             try:
@@ -383,60 +527,288 @@ class ExecuteCompleteHandler(tornado.web.RequestHandler):
                 if not os.path.exists(spider_log_folder):
                     os.makedirs(spider_log_folder)
 
-                log_part = self.ps.get_parts_by_name('log')[0]
-                if log_part:
-                    import shutil
-                    log_file = os.path.join(spider_log_folder, job.id + '.log')
-                    shutil.copy(log_part['tmpfile'].name, log_file)
+                log_upload = self.get_uploaded_file('log', upload_id)
+                if log_upload and stats is None and not log_upload[1]:
+                    stats = read_log_stats(log_upload[0])
+                if log_upload:
+                    log_file = self.store_shipped_part(log_upload, live_log_path(job.project_name, job.spider_name, job.id),
+                                                       log_offset)
 
             except Exception as e:
                 logger.error('Error when writing task log file, %s' % e)
 
-            items_parts = self.ps.get_parts_by_name('items')
-            if items_parts:
+            items_upload = self.get_uploaded_file('items', upload_id)
+            items_webhook_file = None
+            if items_upload:
                 try:
-                    part = items_parts[0]
-                    tmpfile = part['tmpfile'].name
-                    logger.debug('tmpfile size: %d' % os.path.getsize(tmpfile))
+                    logger.debug('uploaded items file size: %d' % os.path.getsize(items_upload[0]))
                     items_file_path = os.path.join('items', job.project_name, job.spider_name)
                     if not os.path.exists(items_file_path):
                         os.makedirs(items_file_path)
-                    items_file = os.path.join(items_file_path, '%s.jl' % job.id)
-                    import shutil
-                    shutil.copy(tmpfile, items_file)
+                    if items_offset:
+                        # items before items_offset have been passed to webhook, only the rest is left.
+                        items_webhook_file = self.link_part(items_upload, os.path.join(self.upload_dir, '%s-%d.jl' % (job.id, items_offset)))
+                    items_file = self.store_shipped_part(items_upload, live_items_path(job.project_name, job.spider_name, job.id),
+                                                         items_offset)
+                    items_webhook_file = items_webhook_file or items_file
                     logger.debug('item file size: %d' % os.path.getsize(items_file))
                 except Exception as e:
                     logger.error('Error when writing items file, %s' % e)
 
             job.status = status_int
             job.update_time = datetime.datetime.now()
-            historical_job = self.scheduler_manager.job_finished(job, log_file, items_file)
+            historical_job = self.scheduler_manager.job_finished(job, log_file, items_file, stats)
+
+            if items_webhook_file:
+                self.webhook_daemon.on_spider_complete(historical_job, items_webhook_file)
+                if items_webhook_file != items_file:
+                    os.remove(items_webhook_file)
+            if upload_id:
+                shutil.rmtree(resumable_upload_path(upload_id), ignore_errors=True)
+            return True
+        finally:
+            session.close()
 
-            if items_file:
-                self.webhook_daemon.on_spider_complete(historical_job, items_file)
+    def get_uploaded_file(self, name, upload_id=None):
+        '''
+        The received log or items file as (path, compressed), from the resumable upload or a
+        part of the request. None if the file is not uploaded.
+        '''
+        if upload_id:
+            path = resumable_upload_path(upload_id, name)
+            return (path, True) if os.path.exists(path) else None
+        parts = self.ps.get_parts_by_name(name)
+        if not parts:
+            return None
+        part = parts[0]
+        part['tmpfile'].close()
+        return part['tmpfile'].name, is_compressed(self.ps.get_part_ct_param(part, 'filename') or '')
 
-            session.close()
-            logger.info('Job %s completed.' % task_id)
-            response_data = {'status': 'ok'}
-            self.write(json.dumps(response_data))
+    def move_upload(self, path, target):
+        '''
+        Rename a received file into place, parts of the request are marked moved so they are
+        not released.
+        '''
+        for part in self.ps.parts:
+            if part['tmpfile'].name == path:
+                return self.ps.move_part(part, target)
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(path, target)
+        return target
+
+    def store_part(self, upload, path):
+        '''
+        Store an uploaded file gzipped, returns the stored path.
+        Agents upload gzipped files named with .gz suffix, which are moved into place,
+        files uploaded by old agents are compressed here.
+        '''
+        source, compressed = upload
+        stored_path = path + COMPRESSED_SUFFIX
+        if compressed:
+            self.move_upload(source, stored_path)
+        else:
+            compress_file(source, stored_path)
+        return stored_path
 
+    def link_part(self, upload, path):
+        '''
+        Hardlink an uploaded file to path, keeping the .gz suffix of uploaded file name.
+        Returns the linked path.
+        '''
+        source, compressed = upload
+        if compressed:
+            path += COMPRESSED_SUFFIX
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.link(source, path)
+        except (AttributeError, OSError):
+            shutil.copy(source, path)
+        return path
 
-        finally:
-            # Don't forget to release temporary files.
-            self.ps.release_parts()
+    def store_shipped_part(self, upload, live_file, offset):
+        '''
+        Store an uploaded file gzipped, joined after the live file shipped while running if
+        the upload starts from offset. The live file is removed once stored.
+        '''
+        stored_path = live_file + COMPRESSED_SUFFIX
+        if offset and os.path.exists(live_file):
+            live_size = os.path.getsize(live_file)
+            if live_size < offset:
+                logger.warning('Shipped file %s is incomplete.' % live_file)
+            with open(live_file, 'r+b') as f_live:
+                if live_size > offset:
+                    # drop the chunk which the agent has not got acknowledged
+                    f_live.truncate(offset)
+                source, compressed = upload
+                f_rest = gzip.open(source, 'rb') if compressed else open(source, 'rb')
+                try:
+                    compress_streams([f_live, f_rest], stored_path)
+                finally:
+                    f_rest.close()
+        else:
+            if offset:
+                logger.warning('Shipped file %s is not found.' % live_file)
+            self.store_part(upload, live_file)
+        if os.path.exists(live_file):
+            os.remove(live_file)
+        return stored_path
+
+    def on_finish(self):
+        self.release_complete_slot()
 
+    def on_connection_close(self):
+        self.release_complete_slot()
+
+    def release_complete_slot(self):
+        if getattr(self, 'complete_slot_acquired', False):
+            self.complete_slot_acquired = False
+            self.scheduler_manager.job_complete_semaphore.release()
 
     def data_received(self, chunk):
         # self.fout.write(chunk)
         self.ps.receive(chunk)
 
 
+def resumable_upload_path(upload_id, name=None):
+    '''
+    Folder of a resumable upload, or the path of its gzipped log or items file if name is given.
+    '''
+    folder = os.path.join(ExecuteCompleteHandler.upload_dir, 'resumable', upload_id)
+    if name is None:
+        return folder
+    return os.path.join(folder, name + COMPRESSED_SUFFIX)
+
+
+def load_resumable_upload(upload_id, task_id=None):
+    '''
+    Returns the info of a resumable upload, None if it is not found or is not of task_id.
+    '''
+    info_file = os.path.join(resumable_upload_path(upload_id), 'upload.json')
+    if not os.path.exists(info_file):
+        return None
+    with open(info_file, 'r') as f:
+        upload = json.load(f)
+    if task_id and upload['task_id'] != task_id:
+        return None
+    return upload
+
+
+def verify_resumable_upload(upload_id, checksums):
+    '''
+    Check files of a resumable upload against their md5 checksums, files which do not verify
+    are removed to be uploaded again. Returns the names of the failed files.
+    '''
+    failed_files = []
+    for name, checksum in checksums.items():
+        if checksum is None:
+            continue
+        path = resumable_upload_path(upload_id, name)
+        if not os.path.exists(path) or file_checksum(path) != checksum:
+            logger.warning('Uploaded file %s does not verify.' % path)
+            failed_files.append(name)
+            if os.path.exists(path):
+                os.remove(path)
+    return failed_files
+
+
+class ResumableUploadHandler(tornado.web.RequestHandler):
+    '''
+    Resumable upload of the gzipped log and items files of a completing job.
+    POST /executing/uploads with task_id creates an upload and returns its upload_id.
+    GET /executing/uploads/<upload_id> returns the received size of each file.
+    POST /executing/uploads/<upload_id>/<log|items>?offset=N appends a chunk, with the md5 of
+    the chunk in X-DD-Checksum header. 400 is returned if the chunk does not verify, 409 with
+    the received size in X-DD-Offset header if it does not follow the received part.
+    Only the node which created an upload may access it, others get 403.
+    The job is completed by ExecuteCompleteHandler with the upload_id and the md5 of files.
+    '''
+    # uploads abandoned longer than this are removed
+    upload_expire = 24 * 3600
+
+    def get(self, upload_id=None):
+        upload = self.get_upload(upload_id)
+        if upload is None:
+            return
+        files = {}
+        for name in ('log', 'items'):
+            path = resumable_upload_path(upload_id, name)
+            files[name] = os.path.getsize(path) if os.path.exists(path) else 0
+        self.write(json.dumps({'upload_id': upload_id, 'task_id': upload['task_id'], 'files': files}))
+
+    def post(self, upload_id=None, name=None):
+        if upload_id is None:
+            return self.create_upload()
+
+        if self.get_upload(upload_id) is None:
+            return
+        offset = int(self.get_argument('offset'))
+        data = self.request.body
+        if hashlib.md5(data).hexdigest() != self.request.headers.get('X-Dd-Checksum'):
+            self.set_status(400, 'Checksum mismatch.')
+            return
+        size, data = append_chunk(resumable_upload_path(upload_id, name), offset, data)
+        self.set_header('X-DD-Offset', size)
+        if data is None:
+            self.set_status(409, 'Chunk is not continuous.')
+            return
+        self.write(json.dumps({'status': 'ok'}))
+
+    def get_upload(self, upload_id):
+        '''
+        The info of upload, None if it is not found or created by other node, the status is set.
+        '''
+        upload = load_resumable_upload(upload_id) if upload_id else None
+        if upload is None:
+            self.set_status(404, 'Upload not found.')
+            return None
+        if upload['node_id'] != self.request.headers.get('X-Dd-Nodeid'):
+            self.set_status(403, 'Upload of other node.')
+            return None
+        return upload
+
+    def create_upload(self):
+        task_id = self.get_argument('task_id')
+        node_id = self.request.headers.get('X-Dd-Nodeid')
+        with session_scope() as session:
+            job = session.query(SpiderExecutionQueue).filter_by(id=task_id, status=1).first()
+        if job is None:
+            self.set_status(404, 'Job not found.')
+            return
+        if not node_id or str(job.node_id) != node_id:
+            self.set_status(403, 'Job of other node.')
+            return
+
+        self.remove_expired_uploads()
+        upload_id = uuid.uuid4().hex
+        folder = resumable_upload_path(upload_id)
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'upload.json'), 'w') as f:
+            json.dump({'task_id': task_id, 'node_id': node_id}, f)
+        self.write(json.dumps({'upload_id': upload_id}))
+
+    def remove_expired_uploads(self):
+        uploads_folder = os.path.dirname(resumable_upload_path('_'))
+        if not os.path.exists(uploads_folder):
+            return
+        expire_time = time.time() - self.upload_expire
+        for upload_id in os.listdir(uploads_folder):
+            folder = resumable_upload_path(upload_id)
+            if os.path.getmtime(folder) < expire_time:
+                logger.info('Removing expired upload %s.' % upload_id)
+                shutil.rmtree(folder, ignore_errors=True)
+
+
 class NodesHandler(tornado.web.RequestHandler):
     def initialize(self, node_manager):
         self.node_manager = node_manager
 
     def post(self):
-        node = self.node_manager.create_node(self.request.remote_ip)
+        slots = self.get_argument('slots', None)
+        slots = int(slots) if slots else None
+        tags = [tag.strip() for tag in self.get_argument('tags', '').split(',') if tag.strip()]
+        node = self.node_manager.create_node(self.request.remote_ip, slots=slots, tags=tags)
         self.write(json.dumps({'id': node.id}))
 
 
@@ -448,21 +820,66 @@ class NodeHeartbeatHandler(tornado.web.RequestHandler):
     def post(self, id):
         #logger.debug(self.request.headers)
         node_id = int(id)
-        self.set_header('X-DD-New-Task', self.scheduler_manager.has_task())
         try:
             self.node_manager.heartbeat(node_id)
             running_jobs = self.request.headers.get('X-DD-RunningJobs', None)
+            # answered from memory, the node is told only about tasks it has free slots and tags for.
+            slots, node_tags = self.node_manager.node_spec(node_id)
+            running_count = len(running_jobs.split(',')) if running_jobs else 0
+            has_free_slots = not slots or running_count < slots
+            self.set_header('X-DD-New-Task', has_free_slots and self.scheduler_manager.has_pending_task(node_tags))
             if running_jobs:
                 killing_jobs = list(self.scheduler_manager.jobs_running(node_id,running_jobs.split(',')))
                 if killing_jobs:
                     logger.info('killing %s' % killing_jobs)
                     self.set_header('X-DD-KillJobs', json.dumps(killing_jobs))
+            # agents provision workspaces of new project versions in background, they fetch
+            # the versions only when the digest changes.
+            project_versions, projects_digest = ProjectVersionsHandler.project_versions()
+            self.set_header('X-DD-Projects-Digest', projects_digest)
             response_data = {'status':'ok'}
         except NodeExpired:
+            self.set_header('X-DD-New-Task', False)
             response_data = {'status': 'error', 'errmsg': 'Node expired'}
             self.set_status(400, 'Node expired')
         self.write(json.dumps(response_data))
 
+class ProjectVersionsHandler(tornado.web.RequestHandler):
+    '''
+    Current version of each project, for agents to provision workspaces of new versions.
+    Heartbeat responses carry the digest of versions in X-DD-Projects-Digest header, which is
+    also the ETag here, so agents only fetch versions when the digest changes.
+    The versions are cached in each server process for cache_ttl seconds, heartbeats of many
+    nodes do not query all projects every time.
+    '''
+    cache_ttl = 10
+    _cached = None
+    _cached_time = 0
+
+    @classmethod
+    def project_versions(cls):
+        '''
+        Returns (versions, digest), versions is a dict of project name -> version.
+        '''
+        now = time.time()
+        if cls._cached is None or now - cls._cached_time >= cls.cache_ttl:
+            with session_scope() as session:
+                versions = dict(session.query(Project.name, Project.version))
+            digest = hashlib.md5(json.dumps(versions, sort_keys=True)).hexdigest()
+            cls._cached = (versions, digest)
+            cls._cached_time = now
+        return cls._cached
+
+    def get(self):
+        versions, digest = self.project_versions()
+        self.set_header('Etag', '"%s"' % digest)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(versions))
+
+
 class JobsHandler(tornado.web.RequestHandler):
     def initialize(self, scheduler_manager):
         self.scheduler_manager = scheduler_manager
@@ -477,24 +894,336 @@ class JobsHandler(tornado.web.RequestHandler):
         loader = get_template_loader()
         self.write(loader.load("jobs.html").generate(**context))
 
-class LogsHandler(tornado.web.RequestHandler):
+def accepts_encoding(value, encoding):
+    '''
+    Whether Accept-Encoding header value accepts encoding, an encoding with q=0 is refused.
+    '''
+    qvalues = {}
+    for part in value.split(','):
+        params = part.split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params[1:]:
+            name, _, param_value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(param_value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding] = qvalue
+    if encoding in qvalues:
+        return qvalues[encoding] > 0
+    return qvalues.get('*', 0) > 0
+
+
+def parse_range_header(value, size):
+    '''
+    Parse a single byte range of Range header into (start, end), end is exclusive.
+    Returns None if the range is not supported, such as multiple ranges, and raises
+    ValueError if it is not satisfiable.
+    '''
+    m = re.match(r'^bytes=(\d*)-(\d*)$', value.strip())
+    if not m or m.group(1) == m.group(2) == '':
+        return None
+    if m.group(1) == '':
+        # suffix range, the last n bytes
+        start, end = max(size - int(m.group(2)), 0), size
+    else:
+        start = int(m.group(1))
+        end = min(int(m.group(2)) + 1, size) if m.group(2) else size
+    if start >= size or start >= end:
+        raise ValueError('Range not satisfiable.')
+    return start, end
+
+
+class StoredFileHandler(tornado.web.RequestHandler):
+    '''
+    Base handler serving a stored log or items file of historical job.
+    Gzipped file is served as is with Content-Encoding: gzip when the client accepts it,
+    otherwise it is decompressed on the fly. The file is sent in chunks, supporting ETag,
+    and Range when the file is sent without decompressing.
+    '''
+    content_type = 'text/plain; charset=UTF-8'
+
+    def get_file_path(self, job):
+        raise NotImplementedError()
+
+    @gen.coroutine
     def get(self, project, spider, jobid):
         with session_scope() as session:
             job = session.query(HistoricalJob).filter_by(id=jobid).first()
-            log_file = job.log_file
-            with open(log_file, 'r') as f:
-                log = f.read()
-            loader = get_template_loader()
-            self.write(loader.load("log.html").generate(log=log))
+            file_path = job and self.get_file_path(job)
+        if not file_path or not os.path.exists(file_path):
+            self.set_status(404, 'File not found.')
+            return
 
+        self.set_header('Content-Type', self.content_type)
+        send_compressed = False
+        if is_compressed(file_path):
+            self.set_header('Vary', 'Accept-Encoding')
+            send_compressed = accepts_encoding(self.request.headers.get('Accept-Encoding', ''), 'gzip')
+
+        # stored files are not modified once the job is finished, the tag varies with
+        # content encoding and query arguments, such as log paging.
+        stat = os.stat(file_path)
+        etag = '%x-%x' % (int(stat.st_mtime), stat.st_size)
+        if send_compressed:
+            etag += '-gz'
+        if self.request.query:
+            etag += '-' + hashlib.md5(self.request.query).hexdigest()[:8]
+        self.set_header('Etag', '"%s"' % etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
 
-class ItemsFileHandler(tornado.web.RequestHandler):
-    def get(self, project, spider, jobid):
+        yield self.send_file(file_path, send_compressed, stat.st_size)
+
+    @gen.coroutine
+    def send_file(self, file_path, send_compressed, size):
+        decompress = is_compressed(file_path) and not send_compressed
+        if send_compressed:
+            self.set_header('Content-Encoding', 'gzip')
+        start, end = 0, None
+        if not decompress:
+            self.set_header('Accept-Ranges', 'bytes')
+            range_header = self.request.headers.get('Range')
+            if range_header:
+                try:
+                    request_range = parse_range_header(range_header, size)
+                except ValueError:
+                    self.set_status(416)
+                    self.set_header('Content-Range', 'bytes */%d' % size)
+                    return
+                if request_range:
+                    start, end = request_range
+                    self.set_status(206)
+                    self.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+            self.set_header('Content-Length', (end or size) - start)
+
+        yield self.write_chunks(iter_file(file_path, decompress=decompress, start=start, end=end))
+
+    @gen.coroutine
+    def write_chunks(self, chunks):
+        for chunk in chunks:
+            if not chunk:
+                # skipping decompressed content to the start offset, let other requests run
+                yield gen.moment
+                continue
+            self.write(chunk)
+            yield self.flush()
+
+
+class LogsHandler(StoredFileHandler):
+    '''
+    Besides the whole log file, a page of the log can be read by arguments:
+        offset: offset of the decompressed log in bytes, a negative offset counts from
+        the end of log, e.g. -10000 to tail the last 10000 bytes.
+        limit: max bytes to return, default and at most max_page_size.
+    The start offset of the page is returned in X-DD-Offset header.
+    The decompressed tails of recently tailed gzipped logs are cached, keyed by the path,
+    modified time and size of file as the ETag is.
+    '''
+    max_page_size = 1024 * 1024
+    tail_cache = OrderedDict()
+    tail_cache_size = 16
+
+    def get_file_path(self, job):
+        return job.log_file
+
+    @gen.coroutine
+    def send_file(self, file_path, send_compressed, size):
+        offset = self.get_argument('offset', None)
+        limit = self.get_argument('limit', None)
+        if offset is None and limit is None:
+            yield super(LogsHandler, self).send_file(file_path, send_compressed, size)
+            return
+
+        offset = int(offset or 0)
+        limit = min(int(limit or self.max_page_size), self.max_page_size)
+        yield self.send_page(file_path, offset, limit, size)
+
+    @gen.coroutine
+    def send_page(self, file_path, offset, limit, size):
+        if offset < 0 and is_compressed(file_path):
+            # the size of decompressed log is unknown, it is got with the cached tail.
+            tail, log_size = yield self.cached_tail(file_path)
+            offset = max(log_size + offset, 0)
+            tail_offset = log_size - len(tail)
+            if offset >= tail_offset:
+                self.set_header('X-DD-Offset', offset)
+                self.write(tail[offset - tail_offset:offset - tail_offset + limit])
+                return
+
+        if offset < 0:
+            offset = max(size + offset, 0)
+        self.set_header('X-DD-Offset', offset)
+        yield self.write_chunks(iter_file(file_path, start=offset, end=offset + limit))
+
+    @gen.coroutine
+    def cached_tail(self, file_path):
+        '''
+        The last max_page_size bytes and the size of a decompressed log, as (tail, size).
+        '''
+        stat = os.stat(file_path)
+        key = (file_path, int(stat.st_mtime), stat.st_size)
+        cached = self.tail_cache.pop(key, None)
+        if cached is None:
+            cached = yield self.read_tail(file_path, self.max_page_size)
+        # the most recently used one goes last.
+        self.tail_cache[key] = cached
+        while len(self.tail_cache) > self.tail_cache_size:
+            self.tail_cache.popitem(last=False)
+        raise gen.Return(cached)
+
+    @gen.coroutine
+    def read_tail(self, file_path, tail_size):
+        chunks = deque()
+        kept_size = 0
+        total_size = 0
+        for chunk in iter_file(file_path):
+            chunks.append(chunk)
+            kept_size += len(chunk)
+            total_size += len(chunk)
+            while kept_size - len(chunks[0]) >= tail_size:
+                kept_size -= len(chunks.popleft())
+            # let other requests run between chunks
+            yield gen.moment
+        tail = b''.join(chunks)[-tail_size:] if tail_size else b''
+        raise gen.Return((tail, total_size))
+
+
+def append_chunk(file_path, offset, data):
+    '''
+    Append data shipped from offset of a job output to file_path, the part already received
+    is skipped in case of retry.
+    Returns the size of file and the appended data, which is None if the chunk does not
+    follow the end of file.
+    '''
+    folder = os.path.dirname(file_path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    if offset > size:
+        return size, None
+    data = data[size - offset:]
+    if data:
+        with open(file_path, 'ab') as f:
+            f.write(data)
+    return size + len(data), data
+
+
+class JobItemsHandler(tornado.web.RequestHandler):
+    '''
+    Agents POST batches of complete item lines of running jobs, with the offset of batch in
+    the items file, the same as JobLogHandler. Received items are passed to webhook at once.
+    '''
+    def initialize(self, webhook_daemon):
+        self.webhook_daemon = webhook_daemon
+
+    def post(self, job_id):
+        node_id = self.request.headers.get('X-Dd-Nodeid')
+        offset = int(self.get_argument('offset'))
         with session_scope() as session:
-            job = session.query(HistoricalJob).filter_by(id=jobid).first()
-            items_file =job.items_file
-            self.set_header('Content-Type', 'application/json')
-            self.write(open(items_file, 'r').read())
+            job = session.query(SpiderExecutionQueue).filter_by(id=job_id, status=1).first()
+        if job is None:
+            self.set_status(404, 'Job not running.')
+            return
+        if not node_id or str(job.node_id) != node_id:
+            self.set_status(403, 'Job of other node.')
+            return
+
+        items_file = live_items_path(job.project_name, job.spider_name, job.id)
+        size, data = append_chunk(items_file, offset, self.request.body)
+        self.set_header('X-DD-Offset', size)
+        if data is None:
+            self.set_status(409, 'Items batch is not continuous.')
+            return
+        if data:
+            self.webhook_daemon.on_items_received(job, data, size - len(data))
+        self.write(json.dumps({'status': 'ok'}))
+
+
+class JobLogHandler(LogsHandler):
+    '''
+    Log of a job, live while running.
+    Agents POST log chunks of running jobs, with the offset of chunk in log. The chunk is
+    appended if it follows the received log, otherwise 409 with the received size in
+    X-DD-Offset header is returned.
+    GET reads a page of the log like LogsHandler, while the job is running and there is no
+    log after offset, it waits up to `wait` seconds for new log. X-DD-Job-Running header
+    tells whether the job is still running.
+    '''
+    max_wait = 60
+
+    def initialize(self, scheduler_manager):
+        self.scheduler_manager = scheduler_manager
+
+    def get_running_job(self, session, job_id):
+        return session.query(SpiderExecutionQueue).filter_by(id=job_id, status=1).first()
+
+    def post(self, job_id):
+        node_id = self.request.headers.get('X-Dd-Nodeid')
+        offset = int(self.get_argument('offset'))
+        with session_scope() as session:
+            job = self.get_running_job(session, job_id)
+        if job is None:
+            self.set_status(404, 'Job not running.')
+            return
+        if not node_id or str(job.node_id) != node_id:
+            self.set_status(403, 'Job of other node.')
+            return
+
+        log_file = live_log_path(job.project_name, job.spider_name, job.id)
+        size, data = append_chunk(log_file, offset, self.request.body)
+        self.set_header('X-DD-Offset', size)
+        if data is None:
+            self.set_status(409, 'Log chunk is not continuous.')
+            return
+        if data:
+            self.scheduler_manager.job_log_appended.notify_all()
+        self.write(json.dumps({'status': 'ok'}))
+
+    @gen.coroutine
+    def get(self, job_id):
+        offset = int(self.get_argument('offset', 0))
+        limit = min(int(self.get_argument('limit', self.max_page_size)), self.max_page_size)
+        wait = min(float(self.get_argument('wait', 0)), self.max_wait)
+        deadline = time.time() + wait
+        while True:
+            with session_scope() as session:
+                running_job = self.get_running_job(session, job_id)
+                historical_job = None if running_job else session.query(HistoricalJob).filter_by(id=job_id).first()
+            if running_job:
+                log_file = live_log_path(running_job.project_name, running_job.spider_name, running_job.id)
+                size = os.path.getsize(log_file) if os.path.exists(log_file) else 0
+                remaining = deadline - time.time()
+                if (offset < 0 and size) or offset < size or remaining <= 0:
+                    break
+                # waiters also recheck every second for log received by other processes.
+                yield self.scheduler_manager.job_log_appended.wait(timeout=datetime.timedelta(seconds=min(1, remaining)))
+            elif historical_job and historical_job.log_file and os.path.exists(historical_job.log_file):
+                log_file = historical_job.log_file
+                size = os.path.getsize(log_file)
+                break
+            else:
+                self.set_status(404, 'Log not found.')
+                return
+
+        self.set_header('Content-Type', self.content_type)
+        self.set_header('X-DD-Job-Running', running_job is not None)
+        if not os.path.exists(log_file):
+            self.set_header('X-DD-Offset', 0)
+            return
+        yield self.send_page(log_file, offset, limit, size)
+
+
+class ItemsFileHandler(StoredFileHandler):
+    content_type = 'application/json'
+
+    def get_file_path(self, job):
+        return job.items_file
 
 
 class JobStartHandler(tornado.web.RequestHandler):
@@ -560,6 +1289,7 @@ class DeleteProjectHandler(tornado.web.RequestHandler):
                 session.commit()
                 for trigger in triggers:
                     self.scheduler_manager.remove_schedule(project_name, spider.name, trigger_id=trigger.id)
+                session.query(JobStats).filter_by(spider_id=spider.id).delete()
                 for history_log in session.query(HistoricalJob).filter(HistoricalJob.spider_id == spider.id):
                     try:
                         os.remove(history_log.log_file)
@@ -575,12 +1305,62 @@ class DeleteProjectHandler(tornado.web.RequestHandler):
             ProjectWorkspace(project_name).delete_egg(project_name)
 
 
+class SpiderStatsHandler(tornado.web.RequestHandler):
+    max_limit = 1000
+
+    def get(self, project_name, spider_name):
+        '''
+        Scrapy stats of the latest finished jobs of a spider, in order of complete time.
+        Arguments:
+            key: stat keys to return, can be repeated, return all stats if not specified.
+            since: only jobs completed after this time, in format of "%Y-%m-%d %H:%M:%S".
+            limit: max count of jobs, default 100.
+        '''
+        keys = self.get_arguments('key')
+        since = self.get_argument('since', None)
+        limit = min(int(self.get_argument('limit', 100)), self.max_limit)
+        with session_scope() as session:
+            project = session.query(Project).filter(Project.name == project_name).first()
+            spider = project and session.query(Spider).filter(Spider.project_id == project.id, Spider.name == spider_name).first()
+            if spider is None:
+                self.set_status(404, 'Spider not found.')
+                return
+
+            jobs_query = session.query(HistoricalJob.id, HistoricalJob.complete_time, HistoricalJob.status)\
+                .filter(HistoricalJob.spider_id == spider.id)
+            if since:
+                jobs_query = jobs_query.filter(HistoricalJob.complete_time > datetime.datetime.strptime(since, '%Y-%m-%d %H:%M:%S'))
+            jobs = list(reversed(jobs_query.order_by(desc(HistoricalJob.complete_time)).limit(limit).all()))
+
+            jobs_stats = {job.id: {} for job in jobs}
+            if jobs:
+                stats_query = session.query(JobStats.job_id, JobStats.stat_key, JobStats.value)\
+                    .filter(JobStats.job_id.in_(list(jobs_stats.keys())))
+                if keys:
+                    stats_query = stats_query.filter(JobStats.stat_key.in_(keys))
+                for job_id, stat_key, value in stats_query:
+                    jobs_stats[job_id][stat_key] = value
+
+            response_data = {
+                'project': project_name,
+                'spider': spider_name,
+                'jobs': [{'job_id': job.id,
+                          'complete_time': job.complete_time.strftime('%Y-%m-%d %H:%M:%S') if job.complete_time else None,
+                          'status': job.status,
+                          'stats': jobs_stats[job.id]} for job in jobs]
+            }
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps(response_data))
+
+
 class SpiderSettingsHandler(tornado.web.RequestHandler):
     available_settings = {
         'concurrency': '\d+',
         'timeout': '\d+',
         'webhook_payload': '.*',
         'webhook_batch_size': '\d+',
+        'priority': '-?\d+',
+        'tags': '.*',
     }
 
     def get(self, project, spider):
@@ -594,6 +1374,8 @@ class SpiderSettingsHandler(tornado.web.RequestHandler):
                 job_settings['concurrency'] = 1
             if 'timeout' not in job_settings:
                 job_settings['timeout'] = 3600
+            if 'priority' not in job_settings:
+                job_settings['priority'] = 0
             template = get_template_loader().load('spidersettings.html')
             context = {}
             context['settings'] = job_settings
@@ -608,6 +1390,11 @@ class SpiderSettingsHandler(tornado.web.RequestHandler):
             return self.write(template.generate(**context))
 
     def post(self, project, spider):
+        setting_priority_value = self.get_body_argument('priority', '0')
+        if not re.match(self.available_settings['priority'] + '$', setting_priority_value):
+            self.set_status(400, 'Invalid priority')
+            return
+
         with session_scope() as session:
             project = session.query(Project).filter_by(name=project).first()
             spider = session.query(Spider).filter_by(project_id = project.id, name=spider).first()
@@ -655,6 +1442,25 @@ class SpiderSettingsHandler(tornado.web.RequestHandler):
             setting_webhook_batch_size.value = setting_webhook_batch_size_value
             session.add(setting_webhook_batch_size)
 
+            setting_priority = session.query(SpiderSettings).filter_by(spider_id=spider.id,
+                                                                       setting_key='priority').first()
+            if not setting_priority:
+                setting_priority = SpiderSettings()
+                setting_priority.spider_id = spider.id
+                setting_priority.setting_key = 'priority'
+            setting_priority.value = setting_priority_value
+            session.add(setting_priority)
+
+            setting_tags_value = self.get_body_argument('tags', '')
+            setting_tags = session.query(SpiderSettings).filter_by(spider_id=spider.id,
+                                                                   setting_key='tags').first()
+            if not setting_tags:
+                setting_tags = SpiderSettings()
+                setting_tags.spider_id = spider.id
+                setting_tags.setting_key = 'tags'
+            setting_tags.value = setting_tags_value
+            session.add(setting_tags)
+
             spider_parameter_keys = self.get_body_arguments('SpiderParameterKey')
             spider_parameter_values = self.get_body_arguments('SpiderParameterValue')
             session.query(SpiderParameter).filter_by(spider_id=spider.id).delete()
@@ -714,17 +1520,26 @@ def make_app(scheduler_manager, node_manager, webhook_daemon):
         (r'/spiders', SpiderListHandler),
         (r'/spiders/(\d+)', SpiderInstanceHandler),
         (r'/spiders/(\d+)/egg', SpiderEggHandler),
+        (r'/projects/(\w+)/egg', ProjectEggHandler),
         (r'/projects/(\w+)/spiders/(\w+)', SpiderInstanceHandler2),
         (r'/projects/(\w+)/spiders/(\w+)/triggers', SpiderTriggersHandler, {'scheduler_manager': scheduler_manager}),
         (r'/projects/(\w+)/spiders/(\w+)/triggers/(\w+)/delete', DeleteSpiderTriggersHandler, {'scheduler_manager': scheduler_manager}),
         (r'/projects/(\w+)/spiders/(\w+)/settings', SpiderSettingsHandler),
         (r'/projects/(\w+)/spiders/(\w+)/webhook', SpiderWebhookHandler),
+        (r'/projects/(\w+)/spiders/(\w+)/stats', SpiderStatsHandler),
         (r'/executing/next_task', ExecuteNextHandler, {'scheduler_manager': scheduler_manager}),
+        (r'/executing/wait_task', ExecuteWaitTaskHandler, {'scheduler_manager': scheduler_manager}),
         (r'/executing/complete', ExecuteCompleteHandler, {'webhook_daemon': webhook_daemon, 'scheduler_manager': scheduler_manager}),
+        (r'/executing/uploads', ResumableUploadHandler),
+        (r'/executing/uploads/(\w+)', ResumableUploadHandler),
+        (r'/executing/uploads/(\w+)/(log|items)', ResumableUploadHandler),
+        (r'/executing/projects', ProjectVersionsHandler),
         (r'/nodes', NodesHandler, {'node_manager': node_manager}),
         (r'/nodes/(\d+)/heartbeat', NodeHeartbeatHandler, {'node_manager': node_manager, 'scheduler_manager': scheduler_manager}),
         (r'/jobs', JobsHandler, {'scheduler_manager': scheduler_manager}),
         (r'/jobs/(\w+)/start', JobStartHandler, {'scheduler_manager': scheduler_manager}),
+        (r'/jobs/(\w+)/log', JobLogHandler, {'scheduler_manager': scheduler_manager}),
+        (r'/jobs/(\w+)/items', JobItemsHandler, {'webhook_daemon': webhook_daemon}),
         (r'/logs/(\w+)/(\w+)/(\w+).log', LogsHandler),
         (r'/items/(\w+)/(\w+)/(\w+).jl', ItemsFileHandler),
         (r'/ca.crt', CACertHandler),
@@ -755,7 +1570,7 @@ def start_server(argv=None):
     config = Config()
     logging.debug('starting server with argv : %s' % str(argv))
 
-    init_database()
+    init_database(config)
     bind_address = config.get('bind_address')
     bind_port = config.getint('bind_port')
     try:
@@ -776,6 +1591,9 @@ def start_server(argv=None):
     else:
         logger.warning('Windows platform does not support forking process, running in single process mode.')
 
+    # database connections opened before forking cannot be shared.
+    init_engine(config)
+
     cluster_sync_obj = None
     if task_id is not None and config.get('cluster_bind_address'):
         cluster_node = ClusterNode(task_id, config)
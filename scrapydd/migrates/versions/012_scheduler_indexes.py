@@ -0,0 +1,44 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+
+def _indexes():
+    spider_execution_queue = Table('spider_execution_queue', meta, autoload=True)
+    job_history = Table('job_history', meta, autoload=True)
+    spider_settings = Table('spider_settings', meta, autoload=True)
+    spider_parameters = Table('spider_parameters', meta, autoload=True)
+    return [
+        # dispatching pending jobs and resetting timeout running jobs
+        Index('ix_spider_execution_queue_status_update_time',
+              spider_execution_queue.c.status, spider_execution_queue.c.update_time),
+        # concurrency check on trigger fired
+        Index('ix_spider_execution_queue_spider_id_status',
+              spider_execution_queue.c.spider_id, spider_execution_queue.c.status),
+        # resetting jobs of expired node
+        Index('ix_spider_execution_queue_node_id_status',
+              spider_execution_queue.c.node_id, spider_execution_queue.c.status),
+        # history retention
+        Index('ix_job_history_spider_id_complete_time',
+              job_history.c.spider_id, job_history.c.complete_time),
+        # spider job list
+        Index('ix_job_history_spider_id_start_time',
+              job_history.c.spider_id, job_history.c.start_time),
+        Index('ix_spider_settings_spider_id_setting_key',
+              spider_settings.c.spider_id, spider_settings.c.setting_key),
+        Index('ix_spider_parameters_spider_id_parameter_key',
+              spider_parameters.c.spider_id, spider_parameters.c.parameter_key),
+    ]
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for index in _indexes():
+        index.create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for index in _indexes():
+        index.drop()
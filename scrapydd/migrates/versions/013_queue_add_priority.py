@@ -0,0 +1,17 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    job_queue = Table('spider_execution_queue', meta, autoload=True)
+    job_queue_priority = Column('priority', Integer, default=0)
+    job_queue_priority.create(job_queue, populate_default=True)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    job_queue = Table('spider_execution_queue', meta, autoload=True)
+    job_queue.c['priority'].drop()
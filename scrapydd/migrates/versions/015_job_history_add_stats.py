@@ -0,0 +1,17 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    job_history = Table('job_history', meta, autoload=True)
+    job_history_stats = Column('stats', Text)
+    job_history_stats.create(job_history)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    job_history = Table('job_history', meta, autoload=True)
+    job_history.c['stats'].drop()
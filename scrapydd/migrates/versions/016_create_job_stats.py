@@ -0,0 +1,30 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+job_stats = Table('job_stats', meta,
+                  Column('id', Integer, primary_key=True, autoincrement=True),
+                  Column('job_id', String(length=50), ForeignKey('job_history.id')),
+                  Column('spider_id', Integer, ForeignKey('spiders.id')),
+                  Column('complete_time', DateTime),
+                  Column('stat_key', String(length=200)),
+                  Column('value', Float),
+                  )
+
+Index('ix_job_stats_spider_id_complete_time',
+      job_stats.c.spider_id, job_stats.c.complete_time)
+Index('ix_job_stats_job_id', job_stats.c.job_id)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    Table('job_history', meta, autoload=True)
+    Table('spiders', meta, autoload=True)
+    # indexes are created with the table
+    job_stats.create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    job_stats.drop()
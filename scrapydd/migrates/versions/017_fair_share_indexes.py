@@ -0,0 +1,29 @@
+from sqlalchemy import *
+from migrate import *
+
+meta = MetaData()
+
+
+def _indexes():
+    spider_execution_queue = Table('spider_execution_queue', meta, autoload=True)
+    spider_settings = Table('spider_settings', meta, autoload=True)
+    return [
+        # fair share of pending jobs between projects
+        Index('ix_spider_execution_queue_status_project_name',
+              spider_execution_queue.c.status, spider_execution_queue.c.project_name),
+        # spiders requiring node tags
+        Index('ix_spider_settings_setting_key_spider_id',
+              spider_settings.c.setting_key, spider_settings.c.spider_id),
+    ]
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for index in _indexes():
+        index.create()
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for index in _indexes():
+        index.drop()
@@ -1,5 +1,5 @@
-from sqlalchemy import create_engine, schema, Column, desc
-from sqlalchemy.types import Integer, String, DateTime
+from sqlalchemy import create_engine, schema, Column, desc, Index, event
+from sqlalchemy.types import Integer, String, DateTime, Text, Float
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import ForeignKey
@@ -8,6 +8,7 @@ from migrate.versioning.api import version_control, upgrade
 from migrate.exceptions import DatabaseAlreadyControlledError
 import os
 from contextlib import contextmanager
+from config import Config
 
 metadata = schema.MetaData()
 Base = declarative_base(metadata=metadata)
@@ -67,6 +68,14 @@ class SpiderExecutionQueue(Base):
     status_obj = relationship('JobStatus')
     update_time = Column(DateTime)
     pid = Column(Integer)
+    priority = Column(Integer, default=0)
+
+    __table_args__ = (
+        Index('ix_spider_execution_queue_status_update_time', 'status', 'update_time'),
+        Index('ix_spider_execution_queue_spider_id_status', 'spider_id', 'status'),
+        Index('ix_spider_execution_queue_node_id_status', 'node_id', 'status'),
+        Index('ix_spider_execution_queue_status_project_name', 'status', 'project_name'),
+    )
 
 class Node(Base):
     __tablename__ = 'nodes'
@@ -76,6 +85,8 @@ class Node(Base):
     create_time = Column(DateTime)
     last_heartbeat = Column(DateTime)
     isalive = Column(Integer)
+    slots = Column(Integer)
+    tags = Column(String(length=200))
 
 
 class HistoricalJob(Base):
@@ -94,10 +105,33 @@ class HistoricalJob(Base):
     log_file = Column(String(500))
     items_file = Column(String(500))
     items_count = Column(Integer)
+    # scrapy stats dumped at the end of log, in json
+    stats = Column(Text)
+
+    __table_args__ = (
+        Index('ix_job_history_spider_id_complete_time', 'spider_id', 'complete_time'),
+        Index('ix_job_history_spider_id_start_time', 'spider_id', 'start_time'),
+    )
 
 Spider.historical_jobs = relationship("HistoricalJob", order_by=desc(HistoricalJob.start_time))
 
 
+class JobStats(Base):
+    __tablename__ = 'job_stats'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String(length=50), ForeignKey('job_history.id'))
+    spider_id = Column(Integer, ForeignKey('spiders.id'))
+    complete_time = Column(DateTime)
+    stat_key = Column(String(length=200))
+    value = Column(Float)
+
+    __table_args__ = (
+        Index('ix_job_stats_spider_id_complete_time', 'spider_id', 'complete_time'),
+        Index('ix_job_stats_job_id', 'job_id'),
+    )
+
+
 class SpiderWebhook(Base):
     __tablename__ = 'spider_webhook'
 
@@ -125,6 +159,11 @@ class SpiderSettings(Base):
     setting_key = Column(String(length=50), nullable=False)
     value = Column(String(length=200))
 
+    __table_args__ = (
+        Index('ix_spider_settings_spider_id_setting_key', 'spider_id', 'setting_key'),
+        Index('ix_spider_settings_setting_key_spider_id', 'setting_key', 'spider_id'),
+    )
+
 
 class SpiderParameter(Base):
     __tablename__ = 'spider_parameters'
@@ -134,16 +173,57 @@ class SpiderParameter(Base):
     parameter_key = Column(String(length=50), nullable=False)
     value = Column(String(length=200))
 
+    __table_args__ = (
+        Index('ix_spider_parameters_spider_id_parameter_key', 'spider_id', 'parameter_key'),
+    )
+
 Spider.parameters = relationship('SpiderParameter', order_by=SpiderParameter.parameter_key)
 
 
-def init_database():
+def init_engine(config=None):
+    '''
+    Create database engine by config and bind Session to it.
+    SQLite database is opened in WAL mode with busy timeout, so that forked server processes
+    can read while one is writing. Other databases use pooled connections.
+    Call it again in forked processes, pooled connections cannot be shared between processes.
+
+    @type config: Config
+    '''
+    global database_url, engine
+    if config is None:
+        config = Config()
+    database_url = config.get('database_url', 'sqlite:///database.db')
+    engine_options = {}
+    if database_url.startswith('sqlite'):
+        busy_timeout = config.getfloat('database_busy_timeout', 30)
+        engine_options['connect_args'] = {'timeout': busy_timeout}
+    else:
+        engine_options['pool_size'] = config.getint('database_pool_size', 5)
+        engine_options['pool_recycle'] = config.getint('database_pool_recycle', 3600)
+
+    if engine is not None:
+        engine.dispose()
+    engine = create_engine(database_url, **engine_options)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _set_sqlite_pragma)
+    Session.configure(bind=engine)
+    return engine
+
+
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
+
+
+def init_database(config=None):
+    init_engine(config)
     db_repository = os.path.join(os.path.dirname(__file__), 'migrates')
     try:
-        version_control(url=database_url, repository=db_repository)
+        version_control(url=engine, repository=db_repository)
     except DatabaseAlreadyControlledError:
         pass
-    upgrade(database_url, db_repository)
+    upgrade(engine, db_repository)
 
 
 @contextmanager
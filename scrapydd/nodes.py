@@ -1,8 +1,9 @@
-from models import Node, Session
+from models import Node, Session, session_scope
 from tornado.ioloop import IOLoop, PeriodicCallback
 import datetime
 import logging
 from .exceptions import *
+from .schedule import parse_tags
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +13,11 @@ class NodeManager():
 
     def __init__(self, scheduler_manager):
         self.scheduler_manager = scheduler_manager
+        # heartbeats are kept in memory and flushed to database in batch on each poll.
+        self.alive_nodes = set()
+        self.pending_heartbeats = {}
+        # slots and tags of alive nodes, heartbeats tell nodes about new tasks they can run.
+        self.node_specs = {}
 
     def init(self):
         self.ioloop = IOLoop.current()
@@ -19,6 +25,7 @@ class NodeManager():
         self.peroid_callback.start()
 
     def _poll(self):
+        self.flush_heartbeats()
         last_heartbeat_lessthan = datetime.datetime.now() - datetime.timedelta(seconds=self.node_timeout)
         session = Session()
         for node in session.query(Node).filter(Node.last_heartbeat<last_heartbeat_lessthan, Node.isalive==1):
@@ -26,34 +33,75 @@ class NodeManager():
             self.scheduler_manager.on_node_expired(node.id)
             node.isalive = 0
             session.add(node)
+            self.alive_nodes.discard(node.id)
+            self.node_specs.pop(node.id, None)
         session.commit()
         session.close()
 
         logger.debug('node manager poll')
 
     def heartbeat(self, node_id):
-        try:
-            session = Session()
-            node = session.query(Node).filter_by(id=node_id).first()
-            if node is None:
-                raise NodeExpired()
-            if node.isalive == 0:
-                raise NodeExpired()
-            node.last_heartbeat = datetime.datetime.now()
-            session.add(node)
-            session.commit()
-        finally:
-            session.close()
+        '''
+        Record the heartbeat of node in memory, it is written to database on next flush_heartbeats.
+        '''
+        if node_id not in self.alive_nodes:
+            # the first heartbeat of node in this process, check it in database.
+            with session_scope() as session:
+                node = session.query(Node).filter_by(id=node_id).first()
+                if node is None:
+                    raise NodeExpired()
+                if node.isalive == 0:
+                    raise NodeExpired()
+                self.node_specs[node_id] = (node.slots, parse_tags(node.tags))
+            self.alive_nodes.add(node_id)
+        self.pending_heartbeats[node_id] = datetime.datetime.now()
+
+    def flush_heartbeats(self):
+        '''
+        Write pending heartbeats to database in one transaction.
+        Nodes expired meanwhile, maybe by other server processes, are not updated and will be
+        told to register again on their next heartbeat.
+        '''
+        if not self.pending_heartbeats:
+            return
+        pending_heartbeats = self.pending_heartbeats
+        self.pending_heartbeats = {}
+        with session_scope() as session:
+            alive_node_ids = set(row.id for row in session.query(Node.id).filter(
+                Node.id.in_(pending_heartbeats.keys()), Node.isalive == 1))
+            session.bulk_update_mappings(Node, [{'id': node_id, 'last_heartbeat': last_heartbeat}
+                                                for node_id, last_heartbeat in pending_heartbeats.items()
+                                                if node_id in alive_node_ids])
+        for node_id in pending_heartbeats:
+            if node_id not in alive_node_ids:
+                self.alive_nodes.discard(node_id)
+                self.node_specs.pop(node_id, None)
+        logger.debug('%d heartbeats flushed.' % len(alive_node_ids))
 
-    def create_node(self, remote_ip):
+    def create_node(self, remote_ip, slots=None, tags=None):
+        '''
+        @param slots: how many concurrent jobs the node can run.
+        @param tags: list of tags of the node, jobs of spiders requiring tags are only placed on nodes
+        having all the tags.
+        '''
         session = Session()
         node = Node()
         node.client_ip = remote_ip
         node.create_time = datetime.datetime.now()
         node.last_heartbeat = datetime.datetime.now()
         node.isalive = 1
+        node.slots = slots
+        node.tags = ','.join(tags) if tags else None
         session.add(node)
         session.commit()
         session.refresh(node)
         session.close()
+        self.alive_nodes.add(node.id)
+        self.node_specs[node.id] = (node.slots, parse_tags(node.tags))
         return node
+
+    def node_spec(self, node_id):
+        '''
+        Returns (slots, tags) of an alive node, slots is None if the node has not registered slots.
+        '''
+        return self.node_specs.get(node_id, (None, set()))
@@ -1,4 +1,9 @@
 from tornado.process import cpu_count, _reseed_random
+from tornado.concurrent import Future
+from tornado.process import Subprocess
+from tornado import gen
+from tornado.iostream import StreamClosedError
+import tempfile
 from tornado import ioloop
 import logging
 import os
@@ -107,4 +112,77 @@ def fork_processes(num_processes, max_restarts=100):
     # instead of just returning to right after the call to
     # fork_processes (which will probably just start up another IOLoop
     # unless the caller checks the return value).
-    sys.exit(0)
\ No newline at end of file
+    sys.exit(0)
+
+
+def wait_for_exit(process, poll_interval=1):
+    """Returns a future of the exit code of a `tornado.process.Subprocess`.
+
+    The exit is delivered by the SIGCHLD handler of ``Subprocess``, so it
+    is noticed at once without waking the IOLoop periodically. Where
+    SIGCHLD is not available the process is polled every ``poll_interval``
+    seconds.
+    """
+    if hasattr(signal, 'SIGCHLD'):
+        return process.wait_for_exit(raise_error=False)
+
+    future = Future()
+
+    def check_process():
+        retcode = process.proc.poll()
+        if retcode is None:
+            ioloop.IOLoop.current().call_later(poll_interval, check_process)
+        else:
+            future.set_result(retcode)
+
+    check_process()
+    return future
+
+
+@gen.coroutine
+def read_stream(stream, max_size, chunk_size=64 * 1024):
+    """Reads a `tornado.iostream.IOStream` until it is closed, keeping the
+    last ``max_size`` bytes, which are returned."""
+    buf = bytearray()
+    while True:
+        try:
+            data = yield stream.read_bytes(chunk_size, partial=True)
+        except StreamClosedError:
+            break
+        buf.extend(data)
+        if len(buf) > max_size:
+            del buf[:len(buf) - max_size]
+    raise gen.Return(bytes(buf))
+
+
+@gen.coroutine
+def run_process(args, max_output_size=1024 * 1024, **kwargs):
+    """Runs a process and returns ``(retcode, stdout, stderr)``.
+
+    stdout and stderr are drained while the process runs, so it never
+    blocks on a full pipe. Only the last ``max_output_size`` bytes of each
+    are kept. Where pipes cannot be read by the IOLoop (Windows) the output
+    goes to temporary files, which are read after the process exits.
+    """
+    if os.name != 'posix':
+        stdout_file = tempfile.TemporaryFile()
+        stderr_file = tempfile.TemporaryFile()
+        try:
+            process = Subprocess(args, stdout=stdout_file, stderr=stderr_file, **kwargs)
+            retcode = yield wait_for_exit(process)
+            outputs = []
+            for f in (stdout_file, stderr_file):
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - max_output_size))
+                outputs.append(f.read())
+        finally:
+            stdout_file.close()
+            stderr_file.close()
+        raise gen.Return((retcode, outputs[0], outputs[1]))
+
+    process = Subprocess(args, stdout=Subprocess.STREAM, stderr=Subprocess.STREAM, **kwargs)
+    stdout_future = read_stream(process.stdout, max_output_size)
+    stderr_future = read_stream(process.stderr, max_output_size)
+    retcode = yield wait_for_exit(process)
+    stdout, stderr = yield [stdout_future, stderr_future]
+    raise gen.Return((retcode, stdout, stderr))
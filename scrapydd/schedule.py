@@ -1,20 +1,27 @@
 
 from models import Session, Trigger, Spider, Project, SpiderExecutionQueue, HistoricalJob, session_scope, \
-    SpiderSettings
+    SpiderSettings, Node, JobStats
 from apscheduler.schedulers.tornado import TornadoScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor, ProcessPoolExecutor
 from apscheduler.triggers.cron import CronTrigger
 from sqlite3 import IntegrityError
 from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Condition, Semaphore
+from tornado import gen
 import uuid
 import logging
 import datetime
+import json
 from scrapydd.exceptions import *
-from Queue import Queue, Empty
 from config import Config
-from sqlalchemy import distinct, desc
+from sqlalchemy import desc, func, and_
+from sqlalchemy.orm import aliased
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor as FileThreadPoolExecutor
 from .mail import MailSender
+from .stats import read_log_stats, numeric_stats
+from .storage import live_log_path, live_items_path
 
 
 
@@ -22,6 +29,15 @@ def generate_job_id():
     jobid = uuid.uuid4().hex
     return jobid
 
+
+def parse_tags(value):
+    '''
+    Parse comma separated tags into a set.
+    '''
+    if not value:
+        return set()
+    return set(tag.strip() for tag in value.split(',') if tag.strip())
+
 logger = logging.getLogger(__name__)
 
 JOB_STATUS_PENDING = 0
@@ -41,13 +57,28 @@ class SchedulerManager():
             'processpool': ProcessPoolExecutor(5)
         }
         self.scheduler = TornadoScheduler(executors=executors)
-        self.task_queue = Queue()
-        self.poll_task_queue_callback = None
-        self.pool_task_queue_interval = 10
+        self.claim_task_retries = 5
         self.ioloop = IOLoop.instance()
-        self.poll_task_queue_callback = PeriodicCallback(self.poll_task_queue, self.pool_task_queue_interval * 1000)
         self.clear_finished_jobs_callback = PeriodicCallback(self.clear_finished_jobs, 60*1000)
+        self.job_history_limit_each_spider = config.getint('job_history_limit_each_spider', 100)
+        self.clear_finished_jobs_time_budget = config.getfloat('clear_finished_jobs_time_budget', 1)
+        self.clear_finished_jobs_batch_size = 500
+        # log and items files of removed jobs are deleted in background.
+        self.file_remove_executor = FileThreadPoolExecutor(1)
+        # completed jobs are stored and moved into history in a bounded thread pool, off the IOLoop.
+        # job_complete_max_pending bounds the uploads being received or waiting for the pool.
+        self.job_complete_executor = FileThreadPoolExecutor(config.getint('job_complete_workers', 2))
+        self.job_complete_semaphore = Semaphore(config.getint('job_complete_max_pending', 8))
         self.reset_timeout_job_callback = PeriodicCallback(self.reset_timeout_job, 10*1000)
+        # agents parking on wait_task are woken by this condition when new task is queued.
+        self.new_task_condition = Condition()
+        self.task_waiters = 0
+        # required tags of pending tasks, refreshed by check_new_task, heartbeats are answered from it.
+        self.pending_task_tags = set()
+        self.check_new_task_interval = 1
+        self.check_new_task_callback = PeriodicCallback(self.check_new_task, self.check_new_task_interval * 1000)
+        # clients tailing live job logs are woken by this condition when log chunks are received.
+        self.job_log_appended = Condition()
 
         self.sync_obj = syncobj
         if syncobj is not None:
@@ -83,17 +114,9 @@ class SchedulerManager():
 
         self.scheduler.start()
 
-        self.poll_task_queue_callback.start()
         self.clear_finished_jobs_callback.start()
         self.reset_timeout_job_callback.start()
-
-    def poll_task_queue(self):
-        if self.task_queue.empty():
-            with session_scope() as session:
-                tasks_to_run = session.query(SpiderExecutionQueue).filter_by(status=0).order_by(
-                    SpiderExecutionQueue.update_time).slice(0, 10)
-                for task in tasks_to_run:
-                    self.task_queue.put(task)
+        self.check_new_task_callback.start()
 
     def build_cron_trigger(self, cron):
         cron_parts = cron.split(' ')
@@ -164,11 +187,14 @@ class SchedulerManager():
             executing.fire_time = datetime.datetime.now()
             executing.update_time = datetime.datetime.now()
             executing.slot = free_slots[0]
+            executing.priority = self._spider_priority(session, spider.id)
             session.add(executing)
             try:
                 session.commit()
             except (Exception, IntegrityError) as e:
                 logger.warning(e)
+            else:
+                self.notify_new_task()
             session.close()
             return
 
@@ -209,15 +235,28 @@ class SchedulerManager():
             executing.spider_name = spider.name
             executing.fire_time = datetime.datetime.now()
             executing.update_time = datetime.datetime.now()
+            executing.priority = self._spider_priority(session, spider.id)
             session.add(executing)
             session.commit()
             session.refresh(executing)
+            self.notify_new_task()
             return executing
         finally:
             session.close()
 
+    def _spider_priority(self, session, spider_id):
+        priority_setting = session.query(SpiderSettings).filter_by(spider_id=spider_id, setting_key='priority').first()
+        if not priority_setting or not priority_setting.value:
+            return 0
+        try:
+            return int(priority_setting.value)
+        except ValueError:
+            logger.warning('Invalid priority setting of spider %s: %s' % (spider_id, priority_setting.value))
+            return 0
+
     def on_node_expired(self, node_id):
         session = Session()
+        reset_jobs = []
         for job in session.query(SpiderExecutionQueue).filter(SpiderExecutionQueue.node_id==node_id, SpiderExecutionQueue.status == 1):
             job.status = 0
             job.update_time = datetime.datetime.now()
@@ -225,8 +264,21 @@ class SchedulerManager():
             job.pid = None
             job.node_id = None
             session.add(job)
+            reset_jobs.append(job)
         session.commit()
         session.close()
+        self._remove_live_files(reset_jobs)
+
+    def _remove_live_files(self, jobs):
+        '''
+        Remove the log and items shipped by the last run of jobs reset to PENDING, the rerun
+        ships them from the beginning.
+        '''
+        for job in jobs:
+            for live_file in (live_log_path(job.project_name, job.spider_name, job.id),
+                              live_items_path(job.project_name, job.spider_name, job.id)):
+                if os.path.exists(live_file):
+                    os.remove(live_file)
 
     def jobs(self):
         session = Session()
@@ -249,56 +301,331 @@ class SchedulerManager():
             session.close()
 
     def get_next_task(self, node_id):
-        if not self.task_queue.empty():
-            session = Session()
-            try:
-                next_task = self.task_queue.get_nowait()
-            except Empty:
-                return None
-            next_task = session.query(SpiderExecutionQueue).filter(SpiderExecutionQueue.id == next_task.id,
-                                                                   SpiderExecutionQueue.status == 0).first()
-            if not next_task:
-                return None
-            next_task.start_time = datetime.datetime.now()
-            next_task.update_time = datetime.datetime.now()
-            next_task.node_id = node_id
-            next_task.status = 1
-            session.add(next_task)
-            session.commit()
-            session.refresh(next_task)
-            session.close()
-            return next_task
+        '''
+        Claim the next pending task for the node.
+
+        :param node_id: the node which is asking for a task.
+        :return: the claimed SpiderExecutionQueue, or None if there is no pending task.
+        '''
+        next_tasks = self.get_next_tasks(node_id, 1)
+        if next_tasks:
+            return next_tasks[0]
         return None
 
-    def has_task(self):
-        return not self.task_queue.empty()
+    def get_next_tasks(self, node_id, max_tasks=1, node_projects=None):
+        '''
+        Claim up to max_tasks pending tasks for the node, in the order of _fair_share_order.
+        Tasks are only placed on the node if it has free capacity of its registered slots
+        and it has all the tags the spider requires.
+        Each claim is a conditional UPDATE (status PENDING -> RUNNING) on the row, so concurrent
+        callers, even in other forked server processes, can never get the same task.
+        Rows won by another caller are skipped and the next pending ones are tried.
+
+        :param node_id: the node which is asking for tasks.
+        :param max_tasks: the max count of tasks to claim, usually the free slots of the node.
+        :param node_projects: projects having workspace ready on the node, these projects are preferred.
+        :return: list of claimed SpiderExecutionQueue.
+        '''
+        claimed_tasks = []
+        with session_scope() as session:
+            node = session.query(Node).filter_by(id=node_id).first()
+            node_tags = parse_tags(node.tags) if node else set()
+            max_tasks = min(max_tasks, self._node_free_slots(session, node, max_tasks))
+
+            excluded_spider_ids = self._excluded_spider_ids(session, node_tags)
+            for _ in range(self.claim_task_retries):
+                wanted = max_tasks - len(claimed_tasks)
+                if wanted <= 0:
+                    break
+                pending_projects = self._pending_projects(session, excluded_spider_ids)
+                if not pending_projects:
+                    break
+                running_counts = dict(session.query(SpiderExecutionQueue.project_name, func.count())
+                                      .filter(SpiderExecutionQueue.status == JOB_STATUS_RUNNING)
+                                      .group_by(SpiderExecutionQueue.project_name))
+                picked_projects = self._fair_share_order(pending_projects, running_counts, wanted, node_projects)
+                # only the first tasks of the picked projects are loaded.
+                candidates = self._first_pending_tasks(session, picked_projects, excluded_spider_ids)
+                if not candidates:
+                    break
+
+                now = datetime.datetime.now()
+                for project_name in picked_projects:
+                    if not candidates.get(project_name):
+                        continue
+                    candidate = candidates[project_name].pop(0)
+                    claimed = session.query(SpiderExecutionQueue)\
+                        .filter(SpiderExecutionQueue.id == candidate.id,
+                                SpiderExecutionQueue.status == JOB_STATUS_PENDING)\
+                        .update({'status': JOB_STATUS_RUNNING,
+                                 'node_id': node_id,
+                                 'start_time': now,
+                                 'update_time': now}, synchronize_session=False)
+                    if claimed:
+                        claimed_tasks.append(candidate)
+                    else:
+                        logger.debug('task %s claimed by others, skipping.' % candidate.id)
+                session.commit()
+                if len(claimed_tasks) >= max_tasks:
+                    break
+
+            for claimed_task in claimed_tasks:
+                session.refresh(claimed_task)
+        return claimed_tasks
+
+    def _supports_window_functions(self, session):
+        '''
+        Whether the database supports window functions, which are not available before
+        SQLite 3.25, MySQL 8.0 and MariaDB 10.2.
+        '''
+        dialect = session.get_bind().dialect
+        version = tuple(v for v in dialect.server_version_info or () if isinstance(v, int))
+        if dialect.name == 'sqlite':
+            return version >= (3, 25)
+        if dialect.name == 'mysql':
+            if getattr(dialect, '_is_mariadb', False):
+                return version >= (10, 2)
+            return version >= (8, 0)
+        return True
+
+    def _pending_projects(self, session, excluded_spider_ids=None):
+        '''
+        Projects having pending tasks, one aggregated row for each project.
+
+        :return: dict of project_name -> (pending count, max priority, oldest update_time).
+        '''
+        query = session.query(SpiderExecutionQueue.project_name,
+                              func.count(SpiderExecutionQueue.id),
+                              func.max(SpiderExecutionQueue.priority),
+                              func.min(SpiderExecutionQueue.update_time))\
+            .filter(SpiderExecutionQueue.status == JOB_STATUS_PENDING)
+        if excluded_spider_ids:
+            query = query.filter(SpiderExecutionQueue.spider_id.notin_(excluded_spider_ids))
+        return {project_name: (pending_count, max_priority or 0, update_time)
+                for project_name, pending_count, max_priority, update_time
+                in query.group_by(SpiderExecutionQueue.project_name)}
+
+    def _first_pending_tasks(self, session, picked_projects, excluded_spider_ids=None):
+        '''
+        The first pending tasks of the picked projects by priority and update_time,
+        as many as each project is picked.
+
+        :param picked_projects: list of project names, a project is repeated for each task picked.
+        :return: dict of project_name -> [SpiderExecutionQueue].
+        '''
+        counts = {}
+        for project_name in picked_projects:
+            counts[project_name] = counts.get(project_name, 0) + 1
+        order_by = (desc(SpiderExecutionQueue.priority), SpiderExecutionQueue.update_time)
+        pending_filters = [SpiderExecutionQueue.status == JOB_STATUS_PENDING]
+        if excluded_spider_ids:
+            pending_filters.append(SpiderExecutionQueue.spider_id.notin_(excluded_spider_ids))
+
+        tasks = {}
+        if not self._supports_window_functions(session):
+            for project_name, count in counts.items():
+                tasks[project_name] = session.query(SpiderExecutionQueue)\
+                    .filter(SpiderExecutionQueue.project_name == project_name, *pending_filters)\
+                    .order_by(*order_by)\
+                    .limit(count)\
+                    .all()
+            return tasks
+
+        row_number = func.row_number().over(partition_by=SpiderExecutionQueue.project_name, order_by=order_by)
+        ranked = session.query(SpiderExecutionQueue, row_number.label('row_number'))\
+            .filter(SpiderExecutionQueue.project_name.in_(list(counts)), *pending_filters)\
+            .subquery()
+        ranked_task = aliased(SpiderExecutionQueue, ranked)
+        for task, task_row_number in session.query(ranked_task, ranked.c.row_number)\
+                .filter(ranked.c.row_number <= max(counts.values()))\
+                .order_by(ranked.c.row_number):
+            if task_row_number <= counts[task.project_name]:
+                tasks.setdefault(task.project_name, []).append(task)
+        return tasks
+
+    def _node_free_slots(self, session, node, default):
+        '''
+        Free capacity of the registered slots of node, default if the node has not registered slots.
+        '''
+        if node is None or not node.slots:
+            return default
+        running_on_node = session.query(func.count(SpiderExecutionQueue.id))\
+            .filter(SpiderExecutionQueue.node_id == node.id,
+                    SpiderExecutionQueue.status == JOB_STATUS_RUNNING)\
+            .scalar()
+        return node.slots - running_on_node
+
+    def _excluded_spider_ids(self, session, node_tags):
+        '''
+        Spiders requiring tags the node does not have.
+        '''
+        return [setting.spider_id for setting in
+                session.query(SpiderSettings).filter(SpiderSettings.setting_key == 'tags')
+                if not parse_tags(setting.value) <= node_tags]
+
+    def _priority_weight(self, priority):
+        '''
+        Share weight of a priority, priority 0 weights 1, every priority above adds 1,
+        every priority below divides the weight, so that -1 weights 1/2.
+        '''
+        priority = priority or 0
+        if priority >= 0:
+            return float(priority + 1)
+        return 1.0 / (1 - priority)
+
+    def _fair_share_order(self, pending_projects, running_counts, max_tasks, node_projects=None):
+        '''
+        Pick projects for max_tasks tasks by weighted fair share.
+        A project's weight comes from the highest priority of its pending tasks, the project
+        with the least running jobs per weight goes first, so a project with higher priority
+        gets a larger share but never starves the others, neither does a project firing
+        lots of jobs. Projects already having workspace on the node are preferred at the
+        same share, then the project waiting longest.
+        Inside a project, tasks are dispatched by priority and then the oldest.
+
+        :param pending_projects: dict of project_name -> (pending count, max priority, oldest update_time).
+        :param running_counts: dict of project_name -> running jobs count.
+        :param max_tasks: max count of tasks to pick.
+        :param node_projects: projects having workspace ready on the node.
+        :return: list of project names in dispatching order, one for each task.
+        '''
+        pending_counts = {project_name: pending[0] for project_name, pending in pending_projects.items()}
+        running_counts = dict(running_counts)
+        node_projects = set(node_projects or [])
+
+        def share_key(project_name):
+            pending_count, max_priority, update_time = pending_projects[project_name]
+            return ((running_counts.get(project_name, 0) + 1) / self._priority_weight(max_priority),
+                    project_name not in node_projects,
+                    update_time)
+
+        picked_projects = []
+        while len(picked_projects) < max_tasks:
+            project_names = [project_name for project_name, count in pending_counts.items() if count > 0]
+            if not project_names:
+                break
+            next_project = min(project_names, key=share_key)
+            pending_counts[next_project] -= 1
+            running_counts[next_project] = running_counts.get(next_project, 0) + 1
+            picked_projects.append(next_project)
+        return picked_projects
+
+    def has_task(self, node_id=None):
+        '''
+        Whether there is pending task. If node_id is specified, only the tasks the node can
+        lease count, which requires free slots on the node and the tags spiders require.
+        '''
+        with session_scope() as session:
+            if node_id is None:
+                return session.query(SpiderExecutionQueue.id)\
+                           .filter(SpiderExecutionQueue.status == JOB_STATUS_PENDING)\
+                           .first() is not None
+
+            node = session.query(Node).filter_by(id=node_id).first()
+            if self._node_free_slots(session, node, 1) <= 0:
+                return False
+            node_tags = parse_tags(node.tags) if node else set()
+            query = session.query(SpiderExecutionQueue.id)\
+                .filter(SpiderExecutionQueue.status == JOB_STATUS_PENDING)
+            excluded_spider_ids = self._excluded_spider_ids(session, node_tags)
+            if excluded_spider_ids:
+                query = query.filter(SpiderExecutionQueue.spider_id.notin_(excluded_spider_ids))
+            return query.first() is not None
+
+    def notify_new_task(self):
+        '''
+        Wake up agents waiting on wait_task. It is safe to be called from other threads,
+        such as the apscheduler executor running trigger_fired.
+        '''
+        self.ioloop.add_callback(self.check_new_task)
+
+    def check_new_task(self):
+        '''
+        Refresh pending_task_tags and wake up agents waiting on wait_task if there are pending tasks.
+        Tasks queued by other forked server processes cannot notify the waiters in this process,
+        so it is also called periodically.
+        '''
+        with session_scope() as session:
+            pending_spider_ids = set(spider_id for spider_id, in session.query(SpiderExecutionQueue.spider_id)
+                                     .filter(SpiderExecutionQueue.status == JOB_STATUS_PENDING)
+                                     .distinct())
+            required_tags = {}
+            if pending_spider_ids:
+                required_tags = {setting.spider_id: parse_tags(setting.value) for setting in
+                                 session.query(SpiderSettings).filter(SpiderSettings.setting_key == 'tags',
+                                                                      SpiderSettings.spider_id.in_(pending_spider_ids))}
+        self.pending_task_tags = set(frozenset(required_tags.get(spider_id, ())) for spider_id in pending_spider_ids)
+        if self.task_waiters and self.pending_task_tags:
+            self.new_task_condition.notify_all()
+
+    def has_pending_task(self, node_tags=None):
+        '''
+        Whether there are pending tasks a node having node_tags can run, answered from the state
+        refreshed by check_new_task without querying database.
+        '''
+        node_tags = node_tags or set()
+        return any(required_tags <= node_tags for required_tags in self.pending_task_tags)
+
+    @gen.coroutine
+    def wait_task(self, timeout, node_id=None):
+        '''
+        Wait until there is pending task in queue, which the node can lease if node_id is specified.
+
+        :param timeout: max seconds to wait.
+        :param node_id: the node waiting for task.
+        :return: future of whether there is pending task.
+        '''
+        if self.has_task(node_id):
+            raise gen.Return(True)
+        deadline = self.ioloop.time() + timeout
+        self.task_waiters += 1
+        try:
+            # woken by tasks the node may not lease, wait again until the deadline.
+            while self.ioloop.time() < deadline:
+                yield self.new_task_condition.wait(timeout=deadline)
+                if self.has_task(node_id):
+                    raise gen.Return(True)
+        finally:
+            self.task_waiters -= 1
+        raise gen.Return(False)
 
     def jobs_running(self, node_id, job_ids):
         '''
+        Refresh the running jobs reported by node heartbeat with one bulk UPDATE.
 
         :param node_id:
         :param job_ids:
-        :return:(job_id) to kill
+        :return:[job_id] to kill
         '''
         with session_scope() as session:
+            jobs = {job.id: job for job in session.query(SpiderExecutionQueue.id,
+                                                         SpiderExecutionQueue.node_id,
+                                                         SpiderExecutionQueue.status)
+                .filter(SpiderExecutionQueue.id.in_(job_ids))}
+            killing_jobs = []
+            refreshing_jobs = []
             for job_id in job_ids:
-                job = session.query(SpiderExecutionQueue).filter(
-                    SpiderExecutionQueue.id == job_id).first()
-
-                if job:
-                    if job.node_id is None:
-                        job.node_id = node_id
-                    if job.node_id != node_id or \
-                        job.status != 1:
-                        yield job.id
-                    else:
-                        job.update_time = datetime.datetime.now()
-                        session.add(job)
+                job = jobs.get(job_id)
+                if job is None or \
+                        (job.node_id is not None and job.node_id != node_id) or \
+                        job.status != JOB_STATUS_RUNNING:
+                    killing_jobs.append(job_id)
                 else:
-                    yield job_id
-            session.commit()
+                    refreshing_jobs.append(job_id)
+
+            if refreshing_jobs:
+                session.query(SpiderExecutionQueue)\
+                    .filter(SpiderExecutionQueue.id.in_(refreshing_jobs),
+                            SpiderExecutionQueue.status == JOB_STATUS_RUNNING)\
+                    .update({'node_id': node_id,
+                             'update_time': datetime.datetime.now()}, synchronize_session=False)
+        return killing_jobs
 
-    def job_finished(self, job, log_file=None, items_file=None):
+    def job_finished(self, job, log_file=None, items_file=None, stats=None):
+        '''
+        Move a completed job into history.
+        Stats are read from log_file if they are not specified, which decompresses a gzipped log.
+        '''
         session = Session()
         if job.status not in (2,3):
             raise Exception('Invliad status.')
@@ -318,27 +645,29 @@ class SchedulerManager():
         historical_job.status = job.status
         if log_file:
             historical_job.log_file = log_file
-            import re
-            items_crawled_pattern = re.compile("\'item_scraped_count\': (\d+),")
-            error_log_pattern = re.compile("\'log_count/ERROR\': (\d+),")
-            warning_log_pattern = re.compile("\'log_count/WARNING\': (\d+),")
-            with open(log_file, 'r') as f:
-                log_content = f.read()
-                m = items_crawled_pattern.search(log_content)
-                if m:
-                    historical_job.items_count = int(m.group(1))
-
-                m = error_log_pattern.search(log_content)
-                if m and historical_job.status == JOB_STATUS_SUCCESS:
+            if stats is None:
+                stats = read_log_stats(log_file)
+            if stats:
+                historical_job.stats = json.dumps(stats)
+                if 'item_scraped_count' in stats:
+                    historical_job.items_count = stats['item_scraped_count']
+
+                if stats.get('log_count/ERROR') and historical_job.status == JOB_STATUS_SUCCESS:
                     historical_job.status = JOB_STATUS_FAIL
-                m = warning_log_pattern.search(log_content)
-                if m and historical_job.status == JOB_STATUS_SUCCESS:
+                if stats.get('log_count/WARNING') and historical_job.status == JOB_STATUS_SUCCESS:
                     historical_job.status = JOB_STATUS_WARNING
 
         if items_file:
             historical_job.items_file = items_file
         session.delete(job)
         session.add(historical_job)
+        if stats:
+            session.flush()
+            session.bulk_save_objects([JobStats(job_id=historical_job.id,
+                                                spider_id=historical_job.spider_id,
+                                                complete_time=historical_job.complete_time,
+                                                stat_key=key,
+                                                value=value) for key, value in numeric_stats(stats).items()])
         session.commit()
         session.refresh(historical_job)
 
@@ -367,19 +696,65 @@ class SchedulerManager():
                 logger.error('Error when sending job_fail mail %s' % e)
 
     def clear_finished_jobs(self):
-        job_history_limit_each_spider = 100
-        with session_scope() as session:
-            spiders = list(session.query(distinct(HistoricalJob.spider_id)))
-        for row in spiders:
-            spider_id = row[0]
+        '''
+        Remove historical jobs over job_history_limit_each_spider of each spider.
+        Over-limit jobs of the spiders having more jobs than the limit are found by one windowed
+        query and deleted in batches, their files are deleted in background thread. Each pass
+        stops after clear_finished_jobs_time_budget seconds, the rest jobs are left to the next pass.
+        '''
+        deadline = time.time() + self.clear_finished_jobs_time_budget
+        while time.time() < deadline:
             with session_scope() as session:
-                over_limitation_jobs = list(session.query(HistoricalJob)\
-                    .filter(HistoricalJob.spider_id==spider_id)\
-                    .order_by(desc(HistoricalJob.complete_time))\
-                    .slice(job_history_limit_each_spider, 1000)\
-                    .all())
-            for over_limitation_job in over_limitation_jobs:
-                self._remove_histical_job(over_limitation_job)
+                over_limitation_jobs = self._over_limitation_jobs(session, self.clear_finished_jobs_batch_size)
+                if not over_limitation_jobs:
+                    break
+
+                over_limitation_job_ids = [job.id for job in over_limitation_jobs]
+                session.query(JobStats)\
+                    .filter(JobStats.job_id.in_(over_limitation_job_ids))\
+                    .delete(synchronize_session=False)
+                session.query(HistoricalJob)\
+                    .filter(HistoricalJob.id.in_(over_limitation_job_ids))\
+                    .delete(synchronize_session=False)
+            logger.info('%d historical jobs removed.' % len(over_limitation_jobs))
+            self.file_remove_executor.submit(self._remove_job_files, over_limitation_jobs)
+
+    def _over_limitation_jobs(self, session, max_count):
+        '''
+        Historical jobs over job_history_limit_each_spider of each spider, at most max_count ones.
+        '''
+        over_limitation_spider_ids = [spider_id for spider_id, in session.query(HistoricalJob.spider_id)
+                                      .group_by(HistoricalJob.spider_id)
+                                      .having(func.count(HistoricalJob.id) > self.job_history_limit_each_spider)]
+        if not over_limitation_spider_ids:
+            return []
+
+        columns = (HistoricalJob.id,
+                   HistoricalJob.project_name,
+                   HistoricalJob.spider_name,
+                   HistoricalJob.log_file,
+                   HistoricalJob.items_file)
+        if not self._supports_window_functions(session):
+            jobs = []
+            for spider_id in over_limitation_spider_ids:
+                if len(jobs) >= max_count:
+                    break
+                jobs.extend(session.query(*columns)
+                            .filter(HistoricalJob.spider_id == spider_id)
+                            .order_by(desc(HistoricalJob.complete_time))
+                            .offset(self.job_history_limit_each_spider)
+                            .limit(max_count - len(jobs)))
+            return jobs
+
+        row_number = func.row_number().over(partition_by=HistoricalJob.spider_id,
+                                            order_by=desc(HistoricalJob.complete_time))
+        ranked_jobs = session.query(*(columns + (row_number.label('row_number'),)))\
+            .filter(HistoricalJob.spider_id.in_(over_limitation_spider_ids))\
+            .subquery()
+        return session.query(ranked_jobs)\
+            .filter(ranked_jobs.c.row_number > self.job_history_limit_each_spider)\
+            .limit(max_count)\
+            .all()
 
     def _clear_running_jobs(self):
         with session_scope() as session:
@@ -388,25 +763,49 @@ class SchedulerManager():
             self._remove_histical_job(job)
 
     def reset_timeout_job(self):
+        '''
+        Reset running jobs not refreshed by heartbeat to PENDING, and kill jobs running
+        over their spider's timeout setting.
+        The spider timeouts are joined into the running jobs query, resets and kills are
+        applied as bulk statements.
+        '''
         with session_scope() as session:
-            timeout_time = datetime.datetime.now() - datetime.timedelta(minutes=1)
-            for job in session.query(SpiderExecutionQueue).filter(SpiderExecutionQueue.status == 1):
-                spider = session.query(Spider).filter_by(id=job.spider_id).first()
-                job_timeout_setting = session.query(SpiderSettings).filter_by(spider_id=spider.id,
-                                                                              setting_key='timeout').first()
-                job_timeout = int(job_timeout_setting.value) if job_timeout_setting else 3600
-                logger.debug((job.update_time - job.start_time).seconds)
-                if job.update_time < timeout_time:
-                    # job is not refresh as expected, node might be died, reset the status to PENDING
-                    job.status = 0
-                    job.pid = None
-                    job.node_id = None
-                    job.update_time = datetime.datetime.now()
-                    session.add(job)
-                    logger.info('Job %s is timeout, reseting.' % job.id)
-                elif (job.update_time - job.start_time).seconds > job_timeout:
-                    # job is running too long, should be killed
-
+            now = datetime.datetime.now()
+            timeout_time = now - datetime.timedelta(minutes=1)
+            # job is not refresh as expected, node might be died, reset the status to PENDING
+            reset_jobs = session.query(SpiderExecutionQueue.id,
+                                       SpiderExecutionQueue.project_name,
+                                       SpiderExecutionQueue.spider_name)\
+                .filter(SpiderExecutionQueue.status == JOB_STATUS_RUNNING,
+                        SpiderExecutionQueue.update_time < timeout_time)\
+                .all()
+            reset_job_ids = [job.id for job in reset_jobs]
+            if reset_job_ids:
+                session.query(SpiderExecutionQueue)\
+                    .filter(SpiderExecutionQueue.id.in_(reset_job_ids),
+                            SpiderExecutionQueue.status == JOB_STATUS_RUNNING)\
+                    .update({'status': JOB_STATUS_PENDING,
+                             'pid': None,
+                             'node_id': None,
+                             'update_time': now}, synchronize_session=False)
+                for job_id in reset_job_ids:
+                    logger.info('Job %s is timeout, reseting.' % job_id)
+
+            # job is running too long, should be killed
+            running_jobs = session.query(SpiderExecutionQueue, SpiderSettings.value)\
+                .outerjoin(SpiderSettings, and_(SpiderSettings.spider_id == SpiderExecutionQueue.spider_id,
+                                                SpiderSettings.setting_key == 'timeout'))\
+                .filter(SpiderExecutionQueue.status == JOB_STATUS_RUNNING,
+                        SpiderExecutionQueue.update_time >= timeout_time)
+            killed_jobs = []
+            for job, job_timeout_value in running_jobs:
+                job_timeout = int(job_timeout_value) if job_timeout_value else 3600
+                if (job.update_time - job.start_time).total_seconds() > job_timeout:
+                    killed_jobs.append(job)
+
+            if killed_jobs:
+                historical_jobs = []
+                for job in killed_jobs:
                     historical_job = HistoricalJob()
                     historical_job.id = job.id
                     historical_job.spider_id = job.spider_id
@@ -415,11 +814,15 @@ class SchedulerManager():
                     historical_job.fire_time = job.fire_time
                     historical_job.start_time = job.start_time
                     historical_job.complete_time = job.update_time
-                    historical_job.status = 3
-                    session.delete(job)
-                    session.add(historical_job)
+                    historical_job.status = JOB_STATUS_FAIL
+                    historical_jobs.append(historical_job)
+                session.query(SpiderExecutionQueue)\
+                    .filter(SpiderExecutionQueue.id.in_([job.id for job in killed_jobs]))\
+                    .delete(synchronize_session=False)
+                session.bulk_save_objects(historical_jobs)
+                for job in killed_jobs:
                     logger.info('Job %s is timeout, killed.' % job.id)
-            session.commit()
+        self._remove_live_files(reset_jobs)
 
     def _remove_histical_job(self, job):
         '''
@@ -428,6 +831,11 @@ class SchedulerManager():
 
         with session_scope() as session:
             job = session.query(HistoricalJob).filter(HistoricalJob.id == job.id).first()
+            self._remove_job_files([job])
+            session.delete(job)
+
+    def _remove_job_files(self, jobs):
+        for job in jobs:
             if job.items_file:
                 try:
                     os.remove(job.items_file)
@@ -447,7 +855,6 @@ class SchedulerManager():
             original_items_file = os.path.join('items', job.project_name, job.spider_name, '%s.jl' % job.id)
             if os.path.exists(original_items_file):
                 os.remove(original_items_file)
-            session.delete(job)
 
     def remove_schedule(self, project_name, spider_name, trigger_id):
         with session_scope() as session:
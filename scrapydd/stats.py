@@ -0,0 +1,109 @@
+import ast
+import datetime
+import logging
+import os
+import re
+from collections import deque
+from .storage import is_compressed, iter_file
+
+logger = logging.getLogger(__name__)
+
+STATS_MARKER = 'Dumping Scrapy stats:'
+# a log record starts with its timestamp, such as "2017-01-01 00:00:00 [scrapy.core.engine] INFO: ..."
+LOG_RECORD_PATTERN = re.compile(r'\r?\n\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}')
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def read_log_stats(log_file, tail_size=64*1024, max_tail_size=1024*1024):
+    '''
+    Read the scrapy stats dumped at the end of a log file.
+    Only the tail of the file is read, it is extended up to max_tail_size if the stats
+    are not found in it.
+    Returns a dict of stats, or None if no stats are found, e.g. the spider is killed.
+    Gzipped log can not be read backward, it is decompressed as a stream, keeping only the
+    last max_tail_size bytes.
+    '''
+    if is_compressed(log_file):
+        tail = _read_compressed_tail(log_file, max_tail_size)
+        idx = tail.rfind(STATS_MARKER)
+        if idx >= 0:
+            return parse_stats(tail[idx + len(STATS_MARKER):])
+        return None
+
+    with open(log_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        while True:
+            size = min(tail_size, file_size)
+            f.seek(file_size - size)
+            tail = f.read(size)
+            idx = tail.rfind(STATS_MARKER)
+            if idx >= 0:
+                return parse_stats(tail[idx + len(STATS_MARKER):])
+            if size >= file_size or tail_size >= max_tail_size:
+                return None
+            tail_size *= 2
+
+
+def _read_compressed_tail(log_file, max_tail_size):
+    chunks = deque()
+    size = 0
+    for chunk in iter_file(log_file):
+        chunks.append(chunk)
+        size += len(chunk)
+        while size - len(chunks[0]) >= max_tail_size:
+            size -= len(chunks.popleft())
+    return b''.join(chunks)
+
+
+def parse_stats(text):
+    '''
+    Parse a stats dict printed by scrapy's stats collector.
+    The text is parsed as a python expression without evaluating it, so only literals and
+    datetime.datetime(...) values are accepted. Datetime values are converted to strings.
+    Returns None if the text cannot be parsed.
+    '''
+    start = text.find('{')
+    if start < 0:
+        return None
+    m = LOG_RECORD_PATTERN.search(text, start)
+    text = text[start:m.start()] if m else text[start:]
+    try:
+        node = ast.parse(text.strip(), mode='eval').body
+        if not isinstance(node, ast.Dict):
+            return None
+        return dict((_literal(key), _literal(value)) for key, value in zip(node.keys, node.values))
+    except (SyntaxError, ValueError) as e:
+        logger.warning('Cannot parse scrapy stats: %s', e)
+        return None
+
+
+def numeric_stats(stats):
+    '''
+    Pick numeric values out of stats, such as request counts, bytes and memory usage.
+    elapsed_time_seconds is derived from start_time and finish_time if scrapy has not reported it.
+    '''
+    values = dict((key, float(value)) for key, value in stats.items()
+                  if isinstance(value, (int, long, float)) and not isinstance(value, bool))
+    if 'elapsed_time_seconds' not in values and stats.get('start_time') and stats.get('finish_time'):
+        try:
+            start_time = datetime.datetime.strptime(stats['start_time'], DATETIME_FORMAT)
+            finish_time = datetime.datetime.strptime(stats['finish_time'], DATETIME_FORMAT)
+            values['elapsed_time_seconds'] = (finish_time - start_time).total_seconds()
+        except (TypeError, ValueError):
+            pass
+    return values
+
+
+def _literal(node):
+    if isinstance(node, ast.Call) and _name(node.func) in ('datetime.datetime', 'datetime'):
+        return datetime.datetime(*[ast.literal_eval(arg) for arg in node.args]).strftime(DATETIME_FORMAT)
+    return ast.literal_eval(node)
+
+
+def _name(node):
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return '%s.%s' % (_name(node.value), node.attr)
+    return None
@@ -0,0 +1,113 @@
+import gzip
+import hashlib
+import os
+import shutil
+
+COMPRESSED_SUFFIX = '.gz'
+CHUNK_SIZE = 64 * 1024
+
+
+def is_compressed(path):
+    return path.endswith(COMPRESSED_SUFFIX)
+
+
+def live_log_path(project_name, spider_name, job_id):
+    '''
+    Path of the log shipped by agent while the job is running, it is replaced by the
+    gzipped log when the job is completed.
+    '''
+    return os.path.join('logs', project_name, spider_name, '%s.log' % job_id)
+
+
+def live_items_path(project_name, spider_name, job_id):
+    '''
+    Path of the items shipped by agent while the job is running, it is replaced by the
+    gzipped items file when the job is completed.
+    '''
+    return os.path.join('items', project_name, spider_name, '%s.jl' % job_id)
+
+
+def compress_file(source, target=None, start=0):
+    '''
+    Gzip source file from start offset into target in a streaming way, target is
+    source + '.gz' if not specified.
+    An existing target is reused, so it can be called again when retrying an upload.
+    Returns the target path.
+    '''
+    if target is None:
+        target = source + COMPRESSED_SUFFIX
+    if os.path.exists(target):
+        return target
+    with open(source, 'rb') as f_source:
+        if start:
+            f_source.seek(start)
+        compress_streams([f_source], target)
+    return target
+
+
+def compress_streams(streams, target):
+    '''
+    Gzip the concatenation of readable streams into target.
+    The target is written to a temporary file first and renamed when completed.
+    '''
+    tmp_target = target + '.tmp'
+    f_target = gzip.open(tmp_target, 'wb')
+    try:
+        for stream in streams:
+            shutil.copyfileobj(stream, f_target, CHUNK_SIZE)
+    finally:
+        f_target.close()
+    if os.path.exists(target):
+        os.remove(target)
+    os.rename(tmp_target, target)
+
+
+def open_file(path):
+    '''
+    Open a stored log or items file for reading, gzipped file is decompressed on the fly.
+    '''
+    if is_compressed(path):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_file(path, decompress=True, chunk_size=CHUNK_SIZE, start=0, end=None):
+    '''
+    Read a stored file in chunks, from start to end (exclusive) offset. If decompress is
+    False the raw content of a gzipped file is returned, otherwise the offsets are of the
+    decompressed content. A gzipped file can only seek by decompressing, the content
+    before start is skipped chunk by chunk and an empty chunk is yielded for each one,
+    so that the caller can let others run in between.
+    '''
+    f = open_file(path) if decompress else open(path, 'rb')
+    try:
+        if start and isinstance(f, gzip.GzipFile):
+            skipped = 0
+            while skipped < start:
+                skipped_chunk = f.read(min(chunk_size, start - skipped))
+                if not skipped_chunk:
+                    break
+                skipped += len(skipped_chunk)
+                yield b''
+        elif start:
+            f.seek(start)
+        position = start
+        while end is None or position < end:
+            size = chunk_size if end is None else min(chunk_size, end - position)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            position += len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def file_checksum(path):
+    '''
+    md5 hex digest of a file, read in chunks.
+    '''
+    md5 = hashlib.md5()
+    for chunk in iter_file(path, decompress=False):
+        md5.update(chunk)
+    return md5.hexdigest()
@@ -24,68 +24,101 @@ class PostDataStreamer:
     header_encoding = "UTF-8"
 
     def __init__(self, total, tmpdir=None):
-        self.buf = b""
+        self.buf = bytearray()
         self.dlen = None
         self.delimiter = None
+        self.part_end = None
         self.in_data = False
+        self.finished = False
         self.headers = []
         self.parts = []
         self.total = total
         self.received = 0
         self.tmpdir = tmpdir
 
-    def _get_raw_header(self,data):
-        idx = data.find(self.SEP)
-        if idx>=0:
-            return (data[:idx], data[idx+self.LSEP:])
-        else:
-            return (None, data)
-
     def receive(self, chunk):
+        """Parse a received chunk.
+
+        Parsed data is removed from the buffer, only the tail which might be the
+        beginning of a boundary is retained, so each byte is scanned and copied
+        a bounded number of times, and the buffer never grows over one chunk
+        plus the delimiter length."""
         self.received += len(chunk)
         self.on_progress()
-        self.buf += chunk
+        self.buf.extend(chunk)
 
         if not self.delimiter:
-            self.delimiter, self.buf = self._get_raw_header(self.buf)
-            if self.delimiter:
-                self.delimiter+=self.SEP
-                self.dlen = len(self.delimiter)
-            elif len(self.buf)>1000:
-                raise Exception("Cannot find multipart delimiter")
-            else:
+            idx = self.buf.find(self.SEP)
+            if idx < 0:
+                if len(self.buf)>1000:
+                    raise Exception("Cannot find multipart delimiter")
                 return
+            self.delimiter = bytes(self.buf[:idx]) + self.SEP
+            self.dlen = len(self.delimiter)
+            # a part ends with CRLF and the boundary, followed by CRLF, or "--" for the last part.
+            self.part_end = self.SEP + self.delimiter[:-self.LSEP]
+            del self.buf[:idx+self.LSEP]
 
-        while True:
+        while not self.finished:
             if self.in_data:
-                if (len(self.buf)>3*self.dlen):
-                    idx = self.buf.find(self.SEP+self.delimiter)
-                    if idx>=0:
-                        self.feed_part(self.buf[:idx])
-                        self.end_part()
-                        self.buf = self.buf[idx+len(self.SEP+self.delimiter):]
-                        self.in_data = False
-                    else:
-                        limit = len(self.buf)-2*self.dlen
-                        self.feed_part(self.buf[:limit])
-                        self.buf = self.buf[limit:]
-                        return
-                else:
+                if not self._receive_data():
                     return
-            if not self.in_data:
-                while True:
-                    header, self.buf = self._get_raw_header(self.buf)
-                    if header==b"":
-                        assert(self.delimiter)
-                        self.in_data = True
-                        self.begin_part(self.headers)
-                        self.headers = []
-                        break
-                    elif header:
-                        self.headers.append(self.parse_header(header))
-                    else:
-                        # Header is None, not enough data yet
-                        return
+            elif not self._receive_header():
+                return
+
+    def _receive_header(self):
+        idx = self.buf.find(self.SEP)
+        if idx < 0:
+            # not enough data yet
+            return False
+        header = bytes(self.buf[:idx])
+        del self.buf[:idx+self.LSEP]
+        if header==b"":
+            self.in_data = True
+            self.begin_part(self.headers)
+            self.headers = []
+        else:
+            self.headers.append(self.parse_header(header))
+        return True
+
+    def _receive_data(self):
+        idx = self.buf.find(self.part_end)
+        if idx < 0:
+            # keep the tail which might be the beginning of the boundary
+            self._feed_buf(len(self.buf) - len(self.part_end) + 1)
+            return False
+
+        tail_start = idx + len(self.part_end)
+        if len(self.buf) < tail_start + self.LSEP:
+            # not enough data to tell what follows the boundary
+            self._feed_buf(idx)
+            return False
+
+        tail = bytes(self.buf[tail_start:tail_start+self.LSEP])
+        if tail == self.SEP:
+            self._feed_buf(idx)
+            self.end_part()
+            del self.buf[:len(self.part_end)+self.LSEP]
+            self.in_data = False
+        elif tail == b"--":
+            self._feed_buf(idx)
+            self.end_part()
+            del self.buf[:]
+            self.in_data = False
+            self.finished = True
+        else:
+            # boundary alike content in data
+            self._feed_buf(idx + 1)
+        return True
+
+    def _feed_buf(self, size):
+        """Feed the first size bytes of the buffer to current part and remove them."""
+        if size <= 0:
+            return
+        view = memoryview(self.buf)
+        self.feed_part(view[:size])
+        del view
+        del self.buf[:size]
 
     def parse_header(self,header):
         header = header.decode(self.header_encoding)
@@ -133,16 +166,31 @@ class PostDataStreamer:
 
         You MUST call this before using the parts."""
         if self.in_data:
-            idx = self.buf.rfind(self.SEP+self.delimiter[:-2])
+            idx = self.buf.rfind(self.part_end)
             if idx>0:
-                self.feed_part(self.buf[:idx])
+                self._feed_buf(idx)
             self.end_part()
+            self.in_data = False
 
     def release_parts(self):
         """Call this to remove the temporary files."""
         for part in self.parts:
             part["tmpfile"].close()
-            os.unlink(part["tmpfile"].name)
+            if not part.get("moved"):
+                os.unlink(part["tmpfile"].name)
+
+    def move_part(self, part, target):
+        """Move the received file of a part to target path.
+
+        The file is renamed instead of copied, so tmpdir should be on the same
+        filesystem as target. The part's file is not removed by release_parts
+        after being moved."""
+        part["tmpfile"].close()
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(part["tmpfile"].name, target)
+        part["moved"] = target
+        return target
 
     def get_part_payload(self, part):
         """Return the contents of a part.
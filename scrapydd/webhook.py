@@ -5,9 +5,12 @@ from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 import logging
 from tornado.concurrent import Future
 from models import Session, WebhookJob, SpiderWebhook, session_scope, SpiderSettings
-import os, os.path, shutil
+import os, os.path
 import sys
+import shutil
+import tempfile
 from .exceptions import *
+from .storage import open_file
 
 logger = logging.getLogger(__name__)
 
@@ -202,16 +205,16 @@ class WebhookDaemon():
         if self.current_job is None:
             next_job = self.storage.get_next_job()
             if next_job:
-                items_file = open(next_job.items_file, 'r')
-
                 max_batch_size = 0
                 if next_job.spider_id:
                     max_batch_size_setting = self.spider_setting_loader.get_spider_setting(next_job.spider_id, 'webhook_batch_size')
                     if max_batch_size_setting:
                         max_batch_size = int(max_batch_size_setting.value)
 
-                self.current_job = WebhookJobExecutor(next_job, items_file, self.webhook_memory_limit, max_batch_size=max_batch_size)
                 try:
+                    # the items file may be missing, fail the job instead of stalling the queue.
+                    items_file = open_file(next_job.items_file)
+                    self.current_job = WebhookJobExecutor(next_job, items_file, self.webhook_memory_limit, max_batch_size=max_batch_size)
                     future = self.current_job.start()
                     self.storage.start_job(next_job.id)
                     future.add_done_callback(self.job_finised)
@@ -250,11 +253,46 @@ class WebhookDaemon():
             os.remove(job.items_file)
         logger.info('webhook job %s failed', job.id)
 
-    def on_spider_complete(self, job, items_file):
+    def get_payload_url(self, spider_id):
         with session_scope() as session:
-            webhook_setting = session.query(SpiderSettings).filter_by(spider_id = job.spider_id, setting_key='webhook_payload').first()
+            webhook_setting = session.query(SpiderSettings).filter_by(spider_id = spider_id, setting_key='webhook_payload').first()
             if webhook_setting and webhook_setting.value:
-                webhook_payload_url = webhook_setting.value
-                task_items_file = os.path.join(self.queue_file_dir, os.path.basename(items_file))
-                shutil.copy(items_file, task_items_file)
-                self.storage.add_job(job.id, webhook_payload_url, task_items_file, job.spider_id)
+                return webhook_setting.value
+
+    def on_spider_complete(self, job, items_file):
+        webhook_payload_url = self.get_payload_url(job.spider_id)
+        if webhook_payload_url:
+            self.storage.add_job(job.id, webhook_payload_url, self.link_items_file(items_file), job.spider_id)
+            # it can be called from other threads
+            self.ioloop.add_callback(self.check_job)
+
+    def on_items_received(self, job, data, offset):
+        '''
+        Queue a batch of items shipped by a running job, the batch starts from offset of
+        the job's items file.
+        '''
+        webhook_payload_url = self.get_payload_url(job.spider_id)
+        if webhook_payload_url:
+            # a rerun of the job ships batches from the same offsets, never overwrite a queued one.
+            fd, task_items_file = tempfile.mkstemp(prefix='%s-%d-' % (job.id, offset), suffix='.jl',
+                                                   dir=self.queue_file_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            self.storage.add_job(job.id, webhook_payload_url, task_items_file, job.spider_id)
+            self.ioloop.add_callback(self.check_job)
+
+    def link_items_file(self, items_file):
+        '''
+        Hardlink the stored items file into the queue dir, so it survives the
+        cleaning of job history until the webhook job is done, without copying
+        the data. Falls back to copying where hardlinks are not available.
+        '''
+        task_items_file = os.path.join(self.queue_file_dir, os.path.basename(items_file))
+        if os.path.exists(task_items_file):
+            os.remove(task_items_file)
+        try:
+            os.link(items_file, task_items_file)
+        except (AttributeError, OSError) as e:
+            logger.warning('Cannot link items file %s, copying it: %s', items_file, e)
+            shutil.copyfile(items_file, task_items_file)
+        return task_items_file
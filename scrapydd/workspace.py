@@ -1,30 +1,43 @@
 import sys
 import os, os.path
-from tornado.concurrent import Future
+from tornado.concurrent import Future, chain_future
 from tornado.ioloop import IOLoop
-from subprocess import Popen, PIPE
+from tornado import gen
 import logging
 import tempfile
 import scrapyd.config
 from scrapyd.eggstorage import FilesystemEggStorage
 import shutil
 import pkg_resources
+import hashlib
 from scrapydd.exceptions import ProcessFailed, InvalidProjectEgg
+from scrapydd.process import run_process
 
 
 logger = logging.getLogger(__name__)
 
 
 class ProjectWorkspace(object):
+    workspace_root = 'workspace'
     pip = None
     python = None
     process = None
     project_workspace_dir = None
     project_check = None
     temp_dir = None
+    # pip installs in progress, project_workspace_dir -> (requirements fingerprint, future)
+    _installing = {}
+    # virtualenvs being created, project_workspace_dir -> future
+    _initializing = {}
+    # blank virtualenvs built ahead, taken by projects initialized for the first time.
+    # it is beside workspace_root, so they can be renamed into place.
+    pool_root = 'workspace-pool'
+    # the size pool is kept at by fill_pool, it is refilled when a virtualenv is taken.
+    pool_size = 0
+    _pool_filling = None
 
     def __init__(self, project_name):
-        project_workspace_dir = os.path.abspath(os.path.join('workspace', project_name))
+        project_workspace_dir = os.path.abspath(os.path.join(self.workspace_root, project_name))
         self.project_workspace_dir = project_workspace_dir
         self.project_name = project_name
         self.egg_storage = FilesystemEggStorage(scrapyd.config.Config())
@@ -37,36 +50,130 @@ class ProjectWorkspace(object):
         else:
             raise NotImplementedError('Unsupported system %s' % sys.platform)
 
+    @classmethod
+    def list_ready_projects(cls):
+        '''
+        List projects whose isolated workspace virtualenv is already created.
+        '''
+        if not os.path.exists(cls.workspace_root):
+            return []
+        ready_projects = []
+        for project_name in os.listdir(cls.workspace_root):
+            workspace = cls(project_name)
+            if os.path.exists(workspace.pip) and os.path.exists(workspace.python):
+                ready_projects.append(project_name)
+        return ready_projects
+
     def init(self):
         '''
-        init project isolated workspace,
+        init project isolated workspace, a pre-built virtualenv is taken from pool if there is one.
         :return: future
         '''
         future = Future()
         if os.path.exists(self.pip) and os.path.exists(self.python):
             future.set_result(self)
             return future
+        if self.project_workspace_dir in self._initializing:
+            return self._initializing[self.project_workspace_dir]
 
-        logger.debug('start creating virtualenv.')
-        try:
-            process = Popen(['virtualenv', '--system-site-packages', self.project_workspace_dir], stdout=PIPE, stderr=PIPE)
-        except Exception as e:
-            future.set_exception(e)
+        # requirements installed in a former virtualenv are gone.
+        if os.path.exists(self.requirements_fingerprint_file):
+            os.remove(self.requirements_fingerprint_file)
+        if self.take_pooled_virtualenv():
+            future.set_result(self)
             return future
-        def check_process():
-            logger.debug('create virtualenv process poll.')
-            retcode = process.poll()
-            if retcode is not None:
-                if retcode == 0:
-                    future.set_result(self)
-                else:
-                    std_output = process.stdout.read()
-                    err_output = process.stderr.read()
-                    future.set_exception(ProcessFailed('Error when init workspace virtualenv ', std_output=std_output, err_output=err_output))
+
+        logger.debug('start creating virtualenv.')
+        self._initializing[self.project_workspace_dir] = future
+
+        def after_create_virtualenv(callback_future):
+            self._initializing.pop(self.project_workspace_dir, None)
+            if callback_future.exception() is not None:
+                future.set_exception(callback_future.exception())
+            else:
+                future.set_result(self)
+
+        self.create_virtualenv(self.project_workspace_dir).add_done_callback(after_create_virtualenv)
+        return future
+
+    @classmethod
+    @gen.coroutine
+    def create_virtualenv(cls, path):
+        retcode, std_output, err_output = yield run_process(['virtualenv', '--system-site-packages', path])
+        if retcode != 0:
+            raise ProcessFailed('Error when init workspace virtualenv ', std_output=std_output, err_output=err_output)
+        raise gen.Return(path)
+
+    @classmethod
+    def list_pooled_virtualenvs(cls):
+        if not os.path.exists(cls.pool_root):
+            return []
+        return [os.path.join(cls.pool_root, name) for name in os.listdir(cls.pool_root) if not name.endswith('.tmp')]
+
+    def take_pooled_virtualenv(self):
+        '''
+        Move a blank virtualenv from pool into the project workspace, returns False if the pool
+        is empty.
+        '''
+        for pooled_dir in self.list_pooled_virtualenvs():
+            if os.path.exists(self.project_workspace_dir):
+                shutil.rmtree(self.project_workspace_dir)
+            parent_dir = os.path.dirname(self.project_workspace_dir)
+            if not os.path.exists(parent_dir):
+                os.makedirs(parent_dir)
+            try:
+                os.rename(pooled_dir, self.project_workspace_dir)
+            except OSError as e:
+                logger.warning('Cannot take pooled virtualenv %s: %s' % (pooled_dir, e))
+                continue
+            logger.debug('took pooled virtualenv %s.' % pooled_dir)
+            if self.pool_size > 0:
+                IOLoop.current().add_callback(self.fill_pool, self.pool_size)
+            return True
+        return False
+
+    @classmethod
+    def fill_pool(cls, size):
+        '''
+        Build blank virtualenvs in background until there are size of them in pool.
+        Virtualenvs are built under a .tmp name and renamed when they are ready. The pool is
+        filled again after a virtualenv is taken from it.
+        :return: future
+        '''
+        cls.pool_size = size
+        if cls._pool_filling is not None:
+            return cls._pool_filling
+        future = Future()
+        cls._pool_filling = future
+        if not os.path.exists(cls.pool_root):
+            os.makedirs(cls.pool_root)
+        # left by an interrupted build
+        for name in os.listdir(cls.pool_root):
+            if name.endswith('.tmp'):
+                shutil.rmtree(os.path.join(cls.pool_root, name), ignore_errors=True)
+
+        def fill(callback_future=None):
+            if callback_future is not None:
+                tmp_dir = callback_future.result() if callback_future.exception() is None else None
+                if tmp_dir is None:
+                    logger.warning('Error when building pooled virtualenv: %s' % callback_future.exception())
+                    done()
+                    return
+                os.rename(tmp_dir, tmp_dir[:-len('.tmp')])
+            if len(cls.list_pooled_virtualenvs()) >= size:
+                done()
                 return
-            IOLoop.current().call_later(1, check_process)
+            tmp_dir = tempfile.mkdtemp(prefix='venv-', suffix='.tmp', dir=cls.pool_root)
+            cls.create_virtualenv(tmp_dir).add_done_callback(fill)
+
+        def done():
+            for name in os.listdir(cls.pool_root):
+                if name.endswith('.tmp'):
+                    shutil.rmtree(os.path.join(cls.pool_root, name), ignore_errors=True)
+            cls._pool_filling = None
+            future.set_result(None)
 
-        check_process()
+        fill()
         return future
 
     def find_project_requirements(self, project, egg_storage=None, eggf=None):
@@ -74,17 +181,21 @@ class ProjectWorkspace(object):
             if egg_storage is None:
                 egg_storage = FilesystemEggStorage(scrapyd.config.Config())
             version, eggf = egg_storage.get(project)
+        eggpath = None
         try:
-            prefix = '%s-nover-' % (project)
-            fd, eggpath = tempfile.mkstemp(prefix=prefix, suffix='.egg')
-            logger.debug('tmp egg file saved to %s' % eggpath)
-            lf = os.fdopen(fd, 'wb')
-            eggf.seek(0)
-            shutil.copyfileobj(eggf, lf)
-            lf.close()
-            try:
-                d = pkg_resources.find_distributions(eggpath).next()
-            except StopIteration:
+            if isinstance(eggf, file) and os.path.exists(eggf.name):
+                # the egg is stored on disk, read it in place.
+                d = next(pkg_resources.find_distributions(eggf.name), None)
+            else:
+                prefix = '%s-nover-' % (project)
+                fd, eggpath = tempfile.mkstemp(prefix=prefix, suffix='.egg')
+                logger.debug('tmp egg file saved to %s' % eggpath)
+                lf = os.fdopen(fd, 'wb')
+                eggf.seek(0)
+                shutil.copyfileobj(eggf, lf)
+                lf.close()
+                d = next(pkg_resources.find_distributions(eggpath), None)
+            if d is None:
                 raise ValueError("Unknown or corrupt egg")
             requirements = [str(x) for x in d.requires()]
             return requirements
@@ -146,55 +257,76 @@ class ProjectWorkspace(object):
                 os.remove(eggpath)
 
 
+    @property
+    def requirements_fingerprint_file(self):
+        return os.path.join(self.project_workspace_dir, 'requirements.fingerprint')
+
+    def requirements_fingerprint(self, requirements):
+        return hashlib.md5('\n'.join(sorted(requirements))).hexdigest()
+
+    def installed_requirements_fingerprint(self):
+        if not os.path.exists(self.requirements_fingerprint_file):
+            return None
+        with open(self.requirements_fingerprint_file, 'r') as f:
+            return f.read().strip()
+
     def pip_install(self, requirements):
-        logger.debug('installing requirements: %s' % requirements)
-        future = Future()
-        try:
-            process = Popen([self.pip, 'install'] + requirements, stdout=PIPE, stderr=PIPE)
-        except Exception as e:
-            future.set_exception(e)
+        '''
+        Install requirements into the workspace virtualenv. It is skipped if the same set of
+        requirements has been installed, concurrent installs of a project are coalesced.
+        :return: future
+        '''
+        fingerprint = self.requirements_fingerprint(requirements)
+        installing = self._installing.get(self.project_workspace_dir)
+        if installing:
+            installing_fingerprint, installing_future = installing
+            if installing_fingerprint == fingerprint:
+                logger.debug('requirements are being installed, wait for it.')
+                return installing_future
+            # install after the running one, which may have installed the same requirements.
+            future = Future()
+            installing_future.add_done_callback(lambda f: chain_future(self.pip_install(requirements), future))
             return future
-        def check_process():
-            logger.debug('poll')
-            retcode = process.poll()
-            if retcode is not None:
-                if retcode == 0:
-                    future.set_result(self)
-                else:
-                    std_out = process.stdout.read()
-                    err_out = process.stderr.read()
-                    future.set_exception(ProcessFailed(std_output=std_out, err_output=err_out))
-                return
-            IOLoop.current().call_later(1, check_process)
 
-        check_process()
+        if fingerprint == self.installed_requirements_fingerprint():
+            logger.debug('requirements have been installed.')
+            future = Future()
+            future.set_result(self)
+            return future
+
+        future = self._pip_install(requirements)
+        self._installing[self.project_workspace_dir] = (fingerprint, future)
+
+        def after_pip_install(callback_future):
+            self._installing.pop(self.project_workspace_dir, None)
+            if callback_future.exception() is None:
+                with open(self.requirements_fingerprint_file, 'w') as f:
+                    f.write(fingerprint)
+
+        future.add_done_callback(after_pip_install)
         return future
 
+    @gen.coroutine
+    def _pip_install(self, requirements):
+        logger.debug('installing requirements: %s' % requirements)
+        # run pip by the python of virtualenv, scripts of pooled virtualenvs are bound to their former path.
+        retcode, std_out, err_out = yield run_process([self.python, '-m', 'pip', 'install'] + requirements)
+        if retcode != 0:
+            raise ProcessFailed(std_output=std_out, err_output=err_out)
+        raise gen.Return(self)
+
+    @gen.coroutine
     def spider_list(self, project, cwd=None):
-        future = Future()
+        env = os.environ.copy()
+        env['SCRAPY_PROJECT'] = project
         try:
-            env = os.environ.copy()
-            env['SCRAPY_PROJECT'] = project
-            process = Popen([self.python, '-m', 'scrapyd.runner', 'list'], env = env, cwd=cwd, stdout = PIPE, stderr= PIPE)
+            retcode, std_out, err_out = yield run_process([self.python, '-m', 'scrapyd.runner', 'list'], env=env, cwd=cwd)
         except Exception as e:
             logger.error(e)
-            future.set_exception(e)
-            return future
-
-        def check_process():
-            logger.debug('poll')
-            retcode = process.poll()
-            if retcode is not None:
-                if retcode == 0:
-                    future.set_result(process.stdout.read().splitlines())
-                else:
-                    #future.set_exception(ProcessFailed(std_output=process.stdout.read(), err_output=process.stderr.read()))
-                    future.set_exception(InvalidProjectEgg(detail=process.stderr.read()))
-                return
-            IOLoop.current().call_later(1, check_process)
-
-        check_process()
-        return future
+            raise
+        if retcode != 0:
+            raise InvalidProjectEgg(detail=err_out)
+        raise gen.Return(std_out.splitlines())
 
     def clearup(self):
         '''
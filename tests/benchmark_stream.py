@@ -0,0 +1,60 @@
+"""
+Benchmark of PostDataStreamer, pushes a synthetic multipart body through the
+parser in network sized chunks and reports the throughput and peak memory.
+
+Usage: python -m tests.benchmark_stream [--size MB] [--chunk-size KB]
+"""
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+from scrapydd.stream import PostDataStreamer
+
+BOUNDARY = b'----------ThIs_Is_tHe_bouNdaRY_$'
+
+
+def generate_body(size, chunk_size):
+    yield b'--%s\r\n' % BOUNDARY
+    yield b'Content-Disposition: form-data; name="task_id"\r\n\r\nabc\r\n'
+    yield b'--%s\r\n' % BOUNDARY
+    yield b'Content-Disposition: form-data; name="log"; filename="log.log"\r\n'
+    yield b'Content-Type: text/plain\r\n\r\n'
+    line = b'2017-01-01 00:00:00 [scrapy] DEBUG: Crawled (200) <GET http://example.com/>\r\n'
+    chunk = line * (chunk_size // len(line) + 1)
+    chunk = chunk[:chunk_size]
+    sent = 0
+    while sent < size:
+        data = chunk[:size - sent]
+        sent += len(data)
+        yield data
+    yield b'\r\n--%s--\r\n' % BOUNDARY
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=1024, help='size of the file part in MB.')
+    parser.add_argument('--chunk-size', type=int, default=64, help='size of received chunks in KB.')
+    args = parser.parse_args()
+    size = args.size * 1024 * 1024
+    tmpdir = tempfile.mkdtemp()
+    try:
+        streamer = PostDataStreamer(size, tmpdir=tmpdir)
+        start = time.time()
+        for chunk in generate_body(size, args.chunk_size * 1024):
+            streamer.receive(chunk)
+        streamer.finish_receive()
+        elapsed = time.time() - start
+        part = streamer.get_parts_by_name('log')[0]
+        assert part['size'] == size, 'part size %d, expected %d' % (part['size'], size)
+        streamer.release_parts()
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print 'received %d MB in %.2f seconds, %.1f MB/s' % (args.size, elapsed, args.size / elapsed)
+        print 'peak rss: %d KB' % peak_rss
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
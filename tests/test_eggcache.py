@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from scrapydd.eggcache import EggCache
+
+
+class EggCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_get_put(self):
+        target = EggCache(cache_dir=self.tmpdir)
+        self.assertIsNone(target.get('project', '1'))
+
+        path = target.put('project', '1', 'abc', b'egg content')
+        self.assertEqual((path, 'abc'), target.get('project', '1'))
+        with open(path, 'rb') as f:
+            self.assertEqual(b'egg content', f.read())
+        self.assertIsNone(target.get('project', '2'))
+        self.assertIsNone(target.get('other', '1'))
+
+    def test_exact_version(self):
+        target = EggCache(cache_dir=self.tmpdir)
+        target.put('project', '1-2', 'a', b'egg 1-2')
+        target.put('project', '1_2', 'b', b'egg 1_2')
+        self.assertIsNone(target.get('project', '1'))
+        self.assertIsNone(target.get('project', '1/2'))
+
+        path = target.put('project', '1/2', 'c', b'egg 1/2')
+        self.assertEqual((path, 'c'), target.get('project', '1/2'))
+        self.assertEqual('a', target.get('project', '1-2')[1])
+        self.assertEqual('b', target.get('project', '1_2')[1])
+
+        # a new egg of the same version replaces the cached one
+        path = target.put('project', '1-2', 'd', b'new egg 1-2')
+        self.assertEqual((path, 'd'), target.get('project', '1-2'))
+        with open(path, 'rb') as f:
+            self.assertEqual(b'new egg 1-2', f.read())
+
+    def test_evict_least_recently_used(self):
+        target = EggCache(max_size=25, cache_dir=self.tmpdir)
+        old_path = target.put('project', '1', 'a', b'0' * 10)
+        used_path = target.put('project', '2', 'b', b'0' * 10)
+        past = time.time() - 100
+        os.utime(old_path, (past, past))
+        os.utime(used_path, (past - 100, past - 100))
+        # using an egg keeps it in cache
+        target.get('project', '2')
+
+        new_path = target.put('other', '1', 'c', b'0' * 10)
+
+        self.assertFalse(os.path.exists(old_path))
+        self.assertIsNone(target.get('project', '1'))
+        self.assertTrue(os.path.exists(used_path))
+        self.assertTrue(os.path.exists(new_path))
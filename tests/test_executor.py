@@ -1,6 +1,12 @@
+import json
+import time
 import unittest
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPError
+from tornado.testing import AsyncTestCase, gen_test
 from scrapydd.agent import AgentConfig
-from scrapydd.executor import SpiderTask
+from scrapydd.executor import SpiderTask, TaskSlotContainer, TaskExecutor, Executor
 
 
 @unittest.skip
@@ -11,3 +17,120 @@ class TaskExecutorTests(unittest.TestCase):
         config = AgentConfig()
 
 
+class TaskSlotContainerTests(unittest.TestCase):
+    def test_free_count(self):
+        target = TaskSlotContainer(3)
+        self.assertEqual(3, target.free_count())
+
+        task = SpiderTask()
+        task.id = 'test_task'
+        task.project_name = 'test_project'
+        task_executor = TaskExecutor(task, config=AgentConfig())
+        target.put_task(task_executor)
+        self.assertEqual(2, target.free_count())
+
+        target.remove_task(task_executor)
+        self.assertEqual(3, target.free_count())
+
+
+class ProjectVersionsHttpClient(object):
+    def __init__(self, versions):
+        self.versions = versions
+        self.fetched_urls = []
+
+    @gen.coroutine
+    def fetch(self, url, **kwargs):
+        self.fetched_urls.append(url)
+        raise gen.Return(FakeResponse(json.dumps(self.versions)))
+
+
+class FakeResponse(object):
+    def __init__(self, body, code=200):
+        self.body = body
+        self.code = code
+        self.error = HTTPError(code) if code >= 400 else None
+
+
+class ExecutorProvisionTest(AsyncTestCase):
+    def setUp(self):
+        super(ExecutorProvisionTest, self).setUp()
+        self.target = Executor(AgentConfig())
+        self.target.warm_projects = ['test_project']
+        self.target.httpclient = ProjectVersionsHttpClient({'test_project': '1'})
+        self.provisioned = []
+        self.provision_fails = False
+
+        @gen.coroutine
+        def provision_project(project_name, version):
+            self.provisioned.append((project_name, version))
+            if self.provision_fails:
+                self.target.provision_failures[project_name] = (version, time.time())
+            else:
+                self.target.provisioned_versions[project_name] = version
+        self.target.provision_project = provision_project
+
+    @gen.coroutine
+    def heartbeat(self, projects_digest):
+        yield self.target.check_header_projects({'X-DD-Projects-Digest': projects_digest})
+        # provisioning runs in callbacks
+        yield gen.moment
+
+    @gen_test
+    def test_versions_fetched_when_digest_changes(self):
+        yield self.heartbeat('a')
+        yield self.heartbeat('a')
+        self.assertEqual(1, len(self.target.httpclient.fetched_urls))
+        self.assertEqual([('test_project', '1')], self.provisioned)
+
+        self.target.httpclient.versions = {'test_project': '2'}
+        yield self.heartbeat('b')
+        self.assertEqual(2, len(self.target.httpclient.fetched_urls))
+        self.assertEqual([('test_project', '1'), ('test_project', '2')], self.provisioned)
+
+    @gen_test
+    def test_failed_provisioning_retried_later(self):
+        self.provision_fails = True
+        yield self.heartbeat('a')
+        yield self.heartbeat('a')
+        self.assertNotIn('test_project', self.target.provisioned_versions)
+        self.assertEqual(1, len(self.provisioned))
+
+        self.target.provision_failures['test_project'] = ('1', time.time() - self.target.provision_retry_interval)
+        self.provision_fails = False
+        yield self.heartbeat('a')
+        self.assertEqual('1', self.target.provisioned_versions['test_project'])
+        self.assertEqual(2, len(self.provisioned))
+
+
+class ExecutorCompleteTest(AsyncTestCase):
+    def setUp(self):
+        super(ExecutorCompleteTest, self).setUp()
+        self.target = Executor(AgentConfig())
+        task = SpiderTask()
+        task.id = 'test_task'
+        task.project_name = 'test_project'
+        self.task_executor = TaskExecutor(task, config=AgentConfig())
+        self.target.task_slots.put_task(self.task_executor)
+        self.completed = []
+        self.target.complete_task = lambda task_executor, status: self.completed.append(task_executor.upload_id)
+
+    def complete_task_done(self, code):
+        future = Future()
+        future.set_result(FakeResponse('', code))
+        self.target.complete_task_done(self.task_executor, 'success', [])(future)
+
+    @gen_test
+    def test_upload_not_found(self):
+        self.task_executor.upload_id = 'expired_upload'
+        self.complete_task_done(404)
+        yield gen.moment
+        # retried with a new upload instead of losing the log and items
+        self.assertEqual([None], self.completed)
+        self.assertEqual(1, len(list(self.target.task_slots.tasks())))
+
+    @gen_test
+    def test_job_not_found(self):
+        self.complete_task_done(404)
+        yield gen.moment
+        self.assertEqual([], self.completed)
+        self.assertEqual(0, len(list(self.target.task_slots.tasks())))
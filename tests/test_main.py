@@ -0,0 +1,678 @@
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import tornado.web
+from io import BytesIO
+from tornado.testing import AsyncHTTPTestCase
+from poster.encode import multipart_encode, MultipartParam
+from scrapydd.main import ExecuteCompleteHandler, NodeHeartbeatHandler, SpiderStatsHandler, LogsHandler, \
+    ItemsFileHandler, JobLogHandler, JobItemsHandler, ResumableUploadHandler, SpiderEggHandler, ProjectEggHandler, \
+    SpiderSettingsHandler, ProjectVersionsHandler
+from scrapydd.schedule import SchedulerManager, JOB_STATUS_SUCCESS
+from scrapydd.nodes import NodeManager
+from scrapydd.webhook import WebhookDaemon
+from scrapydd.settting import SpiderSettingLoader
+from scrapydd.config import Config
+from scrapydd.models import session_scope, HistoricalJob, SpiderExecutionQueue
+from scrapydd.storage import compress_file
+from scrapydd.workspace import ProjectWorkspace
+from scrapydd.models import Spider, Project, SpiderSettings
+from test_schedule import init_test_spider
+
+
+def gzip_content(content):
+    buf = BytesIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(content)
+    f.close()
+    return buf.getvalue()
+
+
+def read_gzip_file(path):
+    with gzip.open(path, 'rb') as f:
+        return f.read()
+
+
+class ExecuteCompleteHandlerTest(AsyncHTTPTestCase):
+    project_name = 'test_complete'
+    spider_name = 'test_spider'
+
+    def setUp(self):
+        init_test_spider(self.project_name, self.spider_name)
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir, ignore_errors=True)
+        self.addCleanup(setattr, ExecuteCompleteHandler, 'upload_dir', ExecuteCompleteHandler.upload_dir)
+        ExecuteCompleteHandler.upload_dir = upload_dir
+        super(ExecuteCompleteHandlerTest, self).setUp()
+
+    def tearDown(self):
+        super(ExecuteCompleteHandlerTest, self).tearDown()
+        for folder in ['logs', 'items']:
+            shutil.rmtree(os.path.join(folder, self.project_name), ignore_errors=True)
+
+    def get_app(self):
+        config = Config()
+        self.scheduler_manager = SchedulerManager(config)
+        self.node_manager = NodeManager(self.scheduler_manager)
+        self.webhook_daemon = WebhookDaemon(config, SpiderSettingLoader())
+        return tornado.web.Application([
+            (r'/executing/complete', ExecuteCompleteHandler, {'webhook_daemon': self.webhook_daemon,
+                                                              'scheduler_manager': self.scheduler_manager}),
+            (r'/nodes/(\d+)/heartbeat', NodeHeartbeatHandler, {'node_manager': self.node_manager,
+                                                                'scheduler_manager': self.scheduler_manager}),
+            (r'/projects/(\w+)/spiders/(\w+)/stats', SpiderStatsHandler),
+            (r'/logs/(\w+)/(\w+)/(\w+).log', LogsHandler),
+            (r'/items/(\w+)/(\w+)/(\w+).jl', ItemsFileHandler),
+            (r'/jobs/(\w+)/log', JobLogHandler, {'scheduler_manager': self.scheduler_manager}),
+            (r'/jobs/(\w+)/items', JobItemsHandler, {'webhook_daemon': self.webhook_daemon}),
+            (r'/executing/uploads', ResumableUploadHandler),
+            (r'/executing/uploads/(\w+)', ResumableUploadHandler),
+            (r'/executing/uploads/(\w+)/(log|items)', ResumableUploadHandler),
+        ])
+
+    def complete_request(self, task_id, status, log_content, items_content, compressed=False, log_offset=0,
+                         items_offset=0, stats=None):
+        log_filename, items_filename = 'log.log', 'items.jl'
+        if compressed:
+            log_filename, items_filename = 'log.log.gz', 'items.jl.gz'
+            log_content, items_content = gzip_content(log_content), gzip_content(items_content)
+        params = [
+            ('task_id', task_id),
+            ('status', status),
+            MultipartParam('log', filename=log_filename, fileobj=BytesIO(log_content), filesize=len(log_content)),
+            MultipartParam('items', filename=items_filename, fileobj=BytesIO(items_content),
+                           filesize=len(items_content)),
+        ]
+        if log_offset:
+            params.append(('log_offset', str(log_offset)))
+        if items_offset:
+            params.append(('items_offset', str(items_offset)))
+        if stats is not None:
+            params.append(('stats', json.dumps(stats)))
+        datagen, headers = multipart_encode(params)
+        return dict(method='POST', headers=headers, body=b''.join(datagen))
+
+    def post_complete(self, task_id, status, log_content, items_content, compressed=False, log_offset=0,
+                      items_offset=0, stats=None):
+        return self.fetch('/executing/complete', **self.complete_request(task_id, status, log_content, items_content,
+                                                                         compressed=compressed,
+                                                                         log_offset=log_offset,
+                                                                         items_offset=items_offset,
+                                                                         stats=stats))
+
+    def test_complete(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        log_content = b"[scrapy.statscollectors] INFO: Dumping Scrapy stats:\r\n{'item_scraped_count': 2,\r\n 'log_count/INFO': 7}\r\n"
+        items_content = b'{"a": 1}\n{"a": 2}\n'
+
+        response = self.post_complete(job.id, 'success', log_content, items_content)
+
+        self.assertEqual(200, response.code)
+        with session_scope() as session:
+            historical_job = session.query(HistoricalJob).filter_by(id=job.id).first()
+        self.assertEqual(JOB_STATUS_SUCCESS, historical_job.status)
+        self.assertEqual(2, historical_job.items_count)
+        self.assertEqual({'item_scraped_count': 2, 'log_count/INFO': 7}, json.loads(historical_job.stats))
+        # uploaded by old agent uncompressed, stored gzipped
+        self.assertEqual(log_content, read_gzip_file(historical_job.log_file))
+        self.assertEqual(items_content, read_gzip_file(historical_job.items_file))
+        # the completing slot is released
+        self.assertEqual(8, self.scheduler_manager.job_complete_semaphore._value)
+
+        response = self.fetch('/projects/%s/spiders/%s/stats?key=item_scraped_count' % (self.project_name,
+                                                                                      self.spider_name))
+        self.assertEqual(200, response.code)
+        jobs = json.loads(response.body)['jobs']
+        self.assertEqual(job.id, jobs[-1]['job_id'])
+        self.assertEqual({'item_scraped_count': 2}, jobs[-1]['stats'])
+
+        response = self.fetch('/projects/%s/spiders/not_exist/stats' % self.project_name)
+        self.assertEqual(404, response.code)
+
+    def test_complete_job_not_found(self):
+        response = self.post_complete('not_exist_job', 'success', b'log', b'')
+
+        self.assertEqual(404, response.code)
+        self.assertEqual(8, self.scheduler_manager.job_complete_semaphore._value)
+
+    def test_heartbeat_while_completing(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        # keep all completing threads busy
+        blocker = threading.Event()
+        for i in range(2):
+            self.scheduler_manager.job_complete_executor.submit(blocker.wait)
+
+        complete_future = self.http_client.fetch(self.get_url('/executing/complete'), raise_error=False,
+                                                 **self.complete_request(job.id, 'success', b'log', b''))
+        heartbeat_response = self.fetch('/nodes/%d/heartbeat' % node.id, method='POST', body='')
+        self.assertEqual(200, heartbeat_response.code)
+        self.assertFalse(complete_future.done())
+
+        blocker.set()
+        self.io_loop.add_future(complete_future, self.stop)
+        self.assertEqual(200, self.wait().result().code)
+
+    def heartbeat_new_task(self, node_id, running_jobs=None):
+        headers = {'X-DD-RunningJobs': ','.join(running_jobs)} if running_jobs else None
+        response = self.fetch('/nodes/%d/heartbeat' % node_id, method='POST', body='', headers=headers)
+        return response.headers['X-DD-New-Task'] == 'True'
+
+    def test_heartbeat_new_task(self):
+        node = self.node_manager.create_node('127.0.0.1', slots=1)
+        gpu_node = self.node_manager.create_node('127.0.0.1', tags=['gpu'])
+        job = self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        with session_scope() as session:
+            session.query(SpiderExecutionQueue).filter(SpiderExecutionQueue.id != job.id).delete()
+            tags_setting = SpiderSettings()
+            tags_setting.spider_id = job.spider_id
+            tags_setting.setting_key = 'tags'
+            tags_setting.value = 'gpu'
+            session.add(tags_setting)
+        self.addCleanup(self.remove_spider_settings, job.spider_id)
+        # heartbeats are answered from memory, which is refreshed by check_new_task
+        self.assertFalse(self.heartbeat_new_task(gpu_node.id))
+        self.scheduler_manager.check_new_task()
+        self.assertTrue(self.heartbeat_new_task(gpu_node.id))
+        # the node has not the required tags
+        self.assertFalse(self.heartbeat_new_task(node.id))
+
+        with session_scope() as session:
+            session.query(SpiderSettings).filter_by(spider_id=job.spider_id).delete()
+        self.scheduler_manager.check_new_task()
+        self.assertTrue(self.heartbeat_new_task(node.id))
+        # the node has no free slot
+        self.assertFalse(self.heartbeat_new_task(node.id, running_jobs=['running_job']))
+
+    def remove_spider_settings(self, spider_id):
+        with session_scope() as session:
+            session.query(SpiderSettings).filter_by(spider_id=spider_id).delete()
+
+    def test_complete_compressed(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        log_content = b"[scrapy.statscollectors] INFO: Dumping Scrapy stats:\r\n{'item_scraped_count': 2}\r\n"
+        items_content = b'{"a": 1}\n{"a": 2}\n'
+
+        response = self.post_complete(job.id, 'success', log_content, items_content, compressed=True)
+
+        self.assertEqual(200, response.code)
+        with session_scope() as session:
+            historical_job = session.query(HistoricalJob).filter_by(id=job.id).first()
+        self.assertEqual(2, historical_job.items_count)
+        self.assertEqual(log_content, read_gzip_file(historical_job.log_file))
+        self.assertEqual(items_content, read_gzip_file(historical_job.items_file))
+
+        log_url = '/logs/%s/%s/%s.log' % (self.project_name, self.spider_name, job.id)
+        response = self.fetch(log_url, decompress_response=False)
+        self.assertEqual(log_content, response.body)
+        self.assertNotIn('Content-Encoding', response.headers)
+        response = self.fetch(log_url, decompress_response=False, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual(log_content, gzip.GzipFile(fileobj=BytesIO(response.body)).read())
+
+        items_url = '/items/%s/%s/%s.jl' % (self.project_name, self.spider_name, job.id)
+        response = self.fetch(items_url)
+        self.assertEqual(items_content, response.body)
+        self.assertEqual('application/json', response.headers['Content-Type'])
+
+    def test_complete_with_stats(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        log_content = b"[scrapy.statscollectors] INFO: Dumping Scrapy stats:\r\n{'item_scraped_count': 2}\r\n"
+
+        # the stats agent read from the log are stored, the gzipped log is not read.
+        response = self.post_complete(job.id, 'success', log_content, b'', compressed=True,
+                                      stats={'item_scraped_count': 3})
+
+        self.assertEqual(200, response.code)
+        with session_scope() as session:
+            historical_job = session.query(HistoricalJob).filter_by(id=job.id).first()
+        self.assertEqual(3, historical_job.items_count)
+        self.assertEqual({'item_scraped_count': 3}, json.loads(historical_job.stats))
+
+    def test_live_log(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        log_url = '/jobs/%s/log' % job.id
+        node_headers = {'X-DD-Nodeid': str(node.id)}
+
+        response = self.fetch(log_url + '?offset=0', method='POST', body=b'line1\n', headers=node_headers)
+        self.assertEqual(200, response.code)
+        self.assertEqual('6', response.headers['X-DD-Offset'])
+        # a retried chunk is only appended once
+        response = self.fetch(log_url + '?offset=0', method='POST', body=b'line1\nline2\n', headers=node_headers)
+        self.assertEqual('12', response.headers['X-DD-Offset'])
+        response = self.fetch(log_url + '?offset=100', method='POST', body=b'line3\n', headers=node_headers)
+        self.assertEqual(409, response.code)
+        self.assertEqual('12', response.headers['X-DD-Offset'])
+        response = self.fetch(log_url + '?offset=12', method='POST', body=b'line3\n', headers={'X-DD-Nodeid': '-1'})
+        self.assertEqual(403, response.code)
+        response = self.fetch(log_url + '?offset=12', method='POST', body=b'line3\n')
+        self.assertEqual(403, response.code)
+        response = self.fetch('/jobs/not_running_job/log?offset=0', method='POST', body=b'line1\n', headers=node_headers)
+        self.assertEqual(404, response.code)
+
+        response = self.fetch(log_url + '?offset=6')
+        self.assertEqual(b'line2\n', response.body)
+        self.assertEqual('True', response.headers['X-DD-Job-Running'])
+
+        # long poll is woken by the next chunk
+        tail_future = self.http_client.fetch(self.get_url(log_url + '?offset=12&wait=10'))
+        self.io_loop.call_later(0.1, self.http_client.fetch, self.get_url(log_url + '?offset=12'),
+                                method='POST', body=b'line3\n', headers=node_headers)
+        self.io_loop.add_future(tail_future, self.stop)
+        response = self.wait(timeout=5).result()
+        self.assertEqual(b'line3\n', response.body)
+        self.assertEqual('12', response.headers['X-DD-Offset'])
+
+        # only the rest of log is uploaded when completing
+        response = self.post_complete(job.id, 'success', b'line4\n', b'', compressed=True, log_offset=18)
+        self.assertEqual(200, response.code)
+        with session_scope() as session:
+            historical_job = session.query(HistoricalJob).filter_by(id=job.id).first()
+        self.assertEqual(b'line1\nline2\nline3\nline4\n', read_gzip_file(historical_job.log_file))
+        self.assertFalse(os.path.exists(os.path.join('logs', self.project_name, self.spider_name, job.id + '.log')))
+
+        response = self.fetch(log_url + '?offset=-6&wait=10')
+        self.assertEqual(b'line4\n', response.body)
+        self.assertEqual('False', response.headers['X-DD-Job-Running'])
+
+    def test_live_items(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        items_url = '/jobs/%s/items' % job.id
+        node_headers = {'X-DD-Nodeid': str(node.id)}
+        received = []
+        self.webhook_daemon.on_items_received = lambda job, data, offset: received.append((data, offset))
+
+        response = self.fetch(items_url + '?offset=0', method='POST', body=b'{"a": 1}\n', headers=node_headers)
+        self.assertEqual(200, response.code)
+        self.assertEqual('9', response.headers['X-DD-Offset'])
+        # a retried batch is only appended and passed to webhook once
+        response = self.fetch(items_url + '?offset=0', method='POST', body=b'{"a": 1}\n{"a": 2}\n',
+                              headers=node_headers)
+        self.assertEqual('18', response.headers['X-DD-Offset'])
+        response = self.fetch(items_url + '?offset=100', method='POST', body=b'{"a": 3}\n', headers=node_headers)
+        self.assertEqual(409, response.code)
+        self.assertEqual('18', response.headers['X-DD-Offset'])
+        # items of the job are only accepted from the node running it
+        response = self.fetch(items_url + '?offset=18', method='POST', body=b'{"a": 3}\n')
+        self.assertEqual(403, response.code)
+        response = self.fetch(items_url + '?offset=18', method='POST', body=b'{"a": 3}\n', headers={'X-DD-Nodeid': '-1'})
+        self.assertEqual(403, response.code)
+        self.assertEqual([(b'{"a": 1}\n', 0), (b'{"a": 2}\n', 9)], received)
+
+        # only the rest of items is uploaded when completing
+        response = self.post_complete(job.id, 'success', b'log', b'{"a": 3}\n', compressed=True, items_offset=18)
+        self.assertEqual(200, response.code)
+        with session_scope() as session:
+            historical_job = session.query(HistoricalJob).filter_by(id=job.id).first()
+        self.assertEqual(b'{"a": 1}\n{"a": 2}\n{"a": 3}\n', read_gzip_file(historical_job.items_file))
+        self.assertFalse(os.path.exists(os.path.join('items', self.project_name, self.spider_name, job.id + '.jl')))
+
+    def test_rerun_live_log(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        log_url = '/jobs/%s/log' % job.id
+        response = self.fetch(log_url + '?offset=0', method='POST', body=b'run1 line1\nrun1 line2\n',
+                              headers={'X-DD-Nodeid': str(node.id)})
+        self.assertEqual(200, response.code)
+
+        # the node is lost, the job is reset to PENDING and rerun on another node
+        self.scheduler_manager.on_node_expired(node.id)
+        other_node = self.node_manager.create_node('127.0.0.1')
+        self.assertEqual(job.id, self.scheduler_manager.get_next_task(other_node.id).id)
+        response = self.fetch(log_url + '?offset=0', method='POST', body=b'run2 line1\n',
+                              headers={'X-DD-Nodeid': str(other_node.id)})
+        self.assertEqual(200, response.code)
+        self.assertEqual('11', response.headers['X-DD-Offset'])
+        response = self.fetch(log_url + '?offset=0', method='POST', body=b'run1 line3\n',
+                              headers={'X-DD-Nodeid': str(node.id)})
+        self.assertEqual(403, response.code)
+
+        response = self.post_complete(job.id, 'success', b'run2 line2\n', b'', compressed=True, log_offset=11)
+        self.assertEqual(200, response.code)
+        with session_scope() as session:
+            historical_job = session.query(HistoricalJob).filter_by(id=job.id).first()
+        self.assertEqual(b'run2 line1\nrun2 line2\n', read_gzip_file(historical_job.log_file))
+
+    def test_rerun_live_items(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        items_url = '/jobs/%s/items' % job.id
+        received = []
+        self.webhook_daemon.on_items_received = lambda job, data, offset: received.append((data, offset))
+        self.fetch(items_url + '?offset=0', method='POST', body=b'{"run": 1}\n', headers={'X-DD-Nodeid': str(node.id)})
+
+        # the job is not refreshed by heartbeat, it is reset to PENDING and rerun
+        with session_scope() as session:
+            session.query(SpiderExecutionQueue).filter_by(id=job.id)\
+                .update({'update_time': datetime.datetime.now() - datetime.timedelta(minutes=10)})
+        self.scheduler_manager.reset_timeout_job()
+        other_node = self.node_manager.create_node('127.0.0.1')
+        self.assertEqual(job.id, self.scheduler_manager.get_next_task(other_node.id).id)
+        response = self.fetch(items_url + '?offset=0', method='POST', body=b'{"run": 2}\n{"run": 2}\n',
+                              headers={'X-DD-Nodeid': str(other_node.id)})
+        self.assertEqual(200, response.code)
+        self.assertEqual('22', response.headers['X-DD-Offset'])
+        # all items of the rerun reach webhook
+        self.assertEqual([(b'{"run": 1}\n', 0), (b'{"run": 2}\n{"run": 2}\n', 0)], received)
+
+        response = self.post_complete(job.id, 'success', b'log', b'', compressed=True, items_offset=22)
+        self.assertEqual(200, response.code)
+        with session_scope() as session:
+            historical_job = session.query(HistoricalJob).filter_by(id=job.id).first()
+        self.assertEqual(b'{"run": 2}\n{"run": 2}\n', read_gzip_file(historical_job.items_file))
+
+    def test_rerun_items_queued_for_webhook(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        queued = []
+        self.webhook_daemon.get_payload_url = lambda spider_id: 'http://localhost/webhook'
+        self.webhook_daemon.storage.add_job = lambda job_id, url, items_file, spider_id: queued.append(items_file)
+
+        # batches of two runs at the same offset are both queued
+        self.webhook_daemon.on_items_received(job, b'{"run": 1}\n', 0)
+        self.webhook_daemon.on_items_received(job, b'{"run": 2}\n', 0)
+        self.assertEqual(2, len(set(queued)))
+        with open(queued[0], 'rb') as f:
+            self.assertEqual(b'{"run": 1}\n', f.read())
+        with open(queued[1], 'rb') as f:
+            self.assertEqual(b'{"run": 2}\n', f.read())
+        for items_file in queued:
+            os.remove(items_file)
+
+    def upload_chunk(self, upload_id, name, offset, data, checksum=None, node_id=None):
+        headers = {'X-DD-Checksum': checksum or hashlib.md5(data).hexdigest()}
+        if node_id:
+            headers['X-DD-Nodeid'] = str(node_id)
+        return self.fetch('/executing/uploads/%s/%s?offset=%d' % (upload_id, name, offset), method='POST',
+                          body=data, headers=headers)
+
+    def test_resumable_upload(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        log_content = gzip_content(b'line1\nline2\n')
+        items_content = gzip_content(b'{"a": 1}\n')
+
+        node_headers = {'X-DD-Nodeid': str(node.id)}
+        response = self.fetch('/executing/uploads', method='POST', body='task_id=%s' % job.id,
+                              headers=node_headers)
+        self.assertEqual(200, response.code)
+        upload_id = json.loads(response.body)['upload_id']
+
+        response = self.upload_chunk(upload_id, 'log', 0, log_content[:10], checksum='0' * 32, node_id=node.id)
+        self.assertEqual(400, response.code)
+        response = self.upload_chunk(upload_id, 'log', 0, log_content[:10], node_id=node.id)
+        self.assertEqual(200, response.code)
+        response = self.upload_chunk(upload_id, 'log', 20, log_content[20:], node_id=node.id)
+        self.assertEqual(409, response.code)
+        self.assertEqual('10', response.headers['X-DD-Offset'])
+        response = self.fetch('/executing/uploads/%s' % upload_id, headers=node_headers)
+        self.assertEqual({'log': 10, 'items': 0}, json.loads(response.body)['files'])
+
+        # resumed from what server has got
+        self.upload_chunk(upload_id, 'log', 10, log_content[10:], node_id=node.id)
+        self.upload_chunk(upload_id, 'items', 0, items_content[:5], node_id=node.id)
+        datagen, headers = multipart_encode({'task_id': job.id, 'status': 'success', 'upload_id': upload_id,
+                                             'log_checksum': hashlib.md5(log_content).hexdigest(),
+                                             'items_checksum': hashlib.md5(items_content).hexdigest()})
+        headers.update(node_headers)
+        complete_request = dict(method='POST', headers=headers, body=b''.join(datagen))
+        response = self.fetch('/executing/complete', **complete_request)
+        self.assertEqual(409, response.code)
+        self.assertEqual(['items'], json.loads(response.body)['files'])
+        response = self.fetch('/executing/uploads/%s' % upload_id, headers=node_headers)
+        self.assertEqual({'log': len(log_content), 'items': 0}, json.loads(response.body)['files'])
+
+        self.upload_chunk(upload_id, 'items', 0, items_content, node_id=node.id)
+        response = self.fetch('/executing/complete', **complete_request)
+        self.assertEqual(200, response.code)
+        with session_scope() as session:
+            historical_job = session.query(HistoricalJob).filter_by(id=job.id).first()
+        self.assertEqual(b'line1\nline2\n', read_gzip_file(historical_job.log_file))
+        self.assertEqual(b'{"a": 1}\n', read_gzip_file(historical_job.items_file))
+        self.assertEqual(404, self.fetch('/executing/uploads/%s' % upload_id, headers=node_headers).code)
+
+    def test_resumable_upload_of_other_node(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        other_node = self.node_manager.create_node('127.0.0.1')
+        self.scheduler_manager.add_task(self.project_name, self.spider_name)
+        job = self.scheduler_manager.get_next_task(node.id)
+        self.assertEqual(403, self.fetch('/executing/uploads', method='POST', body='task_id=%s' % job.id).code)
+        self.assertEqual(403, self.fetch('/executing/uploads', method='POST', body='task_id=%s' % job.id,
+                                         headers={'X-DD-Nodeid': str(other_node.id)}).code)
+        response = self.fetch('/executing/uploads', method='POST', body='task_id=%s' % job.id,
+                              headers={'X-DD-Nodeid': str(node.id)})
+        upload_id = json.loads(response.body)['upload_id']
+
+        self.assertEqual(403, self.upload_chunk(upload_id, 'log', 0, b'log', node_id=other_node.id).code)
+        self.assertEqual(403, self.upload_chunk(upload_id, 'log', 0, b'log').code)
+        self.assertEqual(403, self.fetch('/executing/uploads/%s' % upload_id,
+                                         headers={'X-DD-Nodeid': str(other_node.id)}).code)
+        self.assertEqual(200, self.upload_chunk(upload_id, 'log', 0, b'log', node_id=node.id).code)
+
+
+class StoredFileHandlerTest(AsyncHTTPTestCase):
+    log_content = b''.join(b'2017-06-08 10:52:37 [scrapy] DEBUG: line %d\n' % i for i in range(10000))
+
+    def setUp(self):
+        super(StoredFileHandlerTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        plain_log_file = os.path.join(self.tmpdir, 'plain.log')
+        with open(plain_log_file, 'wb') as f:
+            f.write(self.log_content)
+        with session_scope() as session:
+            session.query(HistoricalJob).filter(HistoricalJob.id.in_(['test_plain_log', 'test_gz_log'])).delete(
+                synchronize_session=False)
+            session.add(HistoricalJob(id='test_plain_log', log_file=plain_log_file))
+            session.add(HistoricalJob(id='test_gz_log', log_file=compress_file(plain_log_file)))
+
+    def get_app(self):
+        return tornado.web.Application([
+            (r'/logs/(\w+)/(\w+)/(\w+).log', LogsHandler),
+        ])
+
+    def fetch_log(self, job_id, query='', **kwargs):
+        return self.fetch('/logs/p/s/%s.log%s' % (job_id, query), decompress_response=False, **kwargs)
+
+    def test_etag(self):
+        for job_id in ['test_plain_log', 'test_gz_log']:
+            response = self.fetch_log(job_id)
+            self.assertEqual(200, response.code)
+            self.assertEqual(self.log_content, response.body)
+            etag = response.headers['Etag']
+
+            response = self.fetch_log(job_id, headers={'If-None-Match': etag})
+            self.assertEqual(304, response.code)
+
+            response = self.fetch_log(job_id, headers={'If-None-Match': etag, 'Accept-Encoding': 'gzip'})
+            self.assertEqual(200 if job_id == 'test_gz_log' else 304, response.code)
+
+    def test_gzip_refused(self):
+        response = self.fetch_log('test_gz_log', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        self.assertEqual(self.log_content, response.body)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        response = self.fetch_log('test_gz_log', headers={'Accept-Encoding': 'deflate, gzip;q=0.5'})
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+
+    def test_range(self):
+        response = self.fetch_log('test_plain_log', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(206, response.code)
+        self.assertEqual(self.log_content[10:20], response.body)
+        self.assertEqual('bytes 10-19/%d' % len(self.log_content), response.headers['Content-Range'])
+
+        response = self.fetch_log('test_plain_log', headers={'Range': 'bytes=-100'})
+        self.assertEqual(206, response.code)
+        self.assertEqual(self.log_content[-100:], response.body)
+
+        response = self.fetch_log('test_plain_log', headers={'Range': 'bytes=%d-' % len(self.log_content)})
+        self.assertEqual(416, response.code)
+
+        gz_size = os.path.getsize(os.path.join(self.tmpdir, 'plain.log.gz'))
+        response = self.fetch_log('test_gz_log', headers={'Range': 'bytes=0-99', 'Accept-Encoding': 'gzip'})
+        self.assertEqual(206, response.code)
+        self.assertEqual('bytes 0-99/%d' % gz_size, response.headers['Content-Range'])
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+
+        # decompressed on the fly, range is not supported
+        response = self.fetch_log('test_gz_log', headers={'Range': 'bytes=0-99'})
+        self.assertEqual(200, response.code)
+        self.assertEqual(self.log_content, response.body)
+
+    def test_paging(self):
+        for job_id in ['test_plain_log', 'test_gz_log']:
+            response = self.fetch_log(job_id, '?offset=100&limit=50')
+            self.assertEqual(self.log_content[100:150], response.body)
+            self.assertEqual('100', response.headers['X-DD-Offset'])
+
+            response = self.fetch_log(job_id, '?offset=-100')
+            self.assertEqual(self.log_content[-100:], response.body)
+            self.assertEqual(str(len(self.log_content) - 100), response.headers['X-DD-Offset'])
+
+            response = self.fetch_log(job_id, '?offset=-100&limit=10', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(self.log_content[-100:-90], response.body)
+            self.assertNotIn('Content-Encoding', response.headers)
+
+            response = self.fetch_log(job_id, '?offset=%d' % (len(self.log_content) + 10))
+            self.assertEqual(b'', response.body)
+
+    def test_tail_cached(self):
+        self.addCleanup(LogsHandler.tail_cache.clear)
+        self.addCleanup(setattr, LogsHandler, 'max_page_size', LogsHandler.max_page_size)
+        LogsHandler.max_page_size = 1000
+        read_tail = LogsHandler.read_tail
+        read_tail_calls = []
+
+        def counted_read_tail(handler, file_path, tail_size):
+            read_tail_calls.append(file_path)
+            return read_tail(handler, file_path, tail_size)
+        self.addCleanup(setattr, LogsHandler, 'read_tail', read_tail)
+        LogsHandler.read_tail = counted_read_tail
+
+        response = self.fetch_log('test_gz_log', '?offset=-100')
+        self.assertEqual(self.log_content[-100:], response.body)
+        response = self.fetch_log('test_gz_log', '?offset=-1000&limit=10')
+        self.assertEqual(self.log_content[-1000:-990], response.body)
+        self.assertEqual(1, len(read_tail_calls))
+
+        # the page starting before the cached tail
+        response = self.fetch_log('test_gz_log', '?offset=-5000&limit=100')
+        self.assertEqual(self.log_content[-5000:-4900], response.body)
+        self.assertEqual(str(len(self.log_content) - 5000), response.headers['X-DD-Offset'])
+
+
+class SpiderEggHandlerTest(AsyncHTTPTestCase):
+    project_name = 'test_egg'
+    spider_name = 'test_spider'
+
+    def setUp(self):
+        super(SpiderEggHandlerTest, self).setUp()
+        init_test_spider(self.project_name, self.spider_name)
+        workspace = ProjectWorkspace(self.project_name)
+        workspace.egg_storage.put(BytesIO(b'egg content'), self.project_name, '1')
+        self.addCleanup(workspace.delete_egg, self.project_name)
+        with session_scope() as session:
+            session.query(Project).filter_by(name=self.project_name).first().version = '1'
+            self.spider_id = session.query(Spider).filter_by(name=self.spider_name).join(Spider.project) \
+                .filter_by(name=self.project_name).first().id
+
+    def get_app(self):
+        self.scheduler_manager = SchedulerManager(Config())
+        self.node_manager = NodeManager(self.scheduler_manager)
+        return tornado.web.Application([
+            (r'/spiders/(\d+)/egg', SpiderEggHandler),
+            (r'/projects/(\w+)/egg', ProjectEggHandler),
+            (r'/executing/projects', ProjectVersionsHandler),
+            (r'/nodes/(\d+)/heartbeat', NodeHeartbeatHandler, {'node_manager': self.node_manager,
+                                                                'scheduler_manager': self.scheduler_manager}),
+        ])
+
+    def test_conditional_get(self):
+        response = self.fetch('/spiders/%d/egg' % self.spider_id)
+        self.assertEqual(200, response.code)
+        self.assertEqual(b'egg content', response.body)
+        self.assertEqual('1', response.headers['X-DD-Version'])
+        etag = response.headers['Etag']
+        self.assertEqual('"%s"' % hashlib.md5(b'egg content').hexdigest(), etag)
+
+        response = self.fetch('/spiders/%d/egg' % self.spider_id, headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+        self.assertEqual(b'', response.body)
+
+        response = self.fetch('/spiders/%d/egg' % self.spider_id, headers={'If-None-Match': '"outdated"'})
+        self.assertEqual(200, response.code)
+        self.assertEqual(404, self.fetch('/spiders/0/egg').code)
+
+    def test_project_egg(self):
+        response = self.fetch('/projects/%s/egg' % self.project_name)
+        self.assertEqual(200, response.code)
+        self.assertEqual(b'egg content', response.body)
+        response = self.fetch('/projects/%s/egg' % self.project_name, headers={'If-None-Match': response.headers['Etag']})
+        self.assertEqual(304, response.code)
+        self.assertEqual(404, self.fetch('/projects/not_exist/egg').code)
+
+    def test_heartbeat_announces_project_versions(self):
+        self.addCleanup(setattr, ProjectVersionsHandler, '_cached', None)
+        ProjectVersionsHandler._cached = None
+        node = self.node_manager.create_node('127.0.0.1')
+        response = self.fetch('/nodes/%d/heartbeat' % node.id, method='POST', body='')
+        self.assertNotIn('X-DD-Projects', response.headers)
+        digest = response.headers['X-DD-Projects-Digest']
+
+        response = self.fetch('/executing/projects')
+        self.assertEqual('"%s"' % digest, response.headers['Etag'])
+        self.assertEqual('1', json.loads(response.body)[self.project_name])
+        response = self.fetch('/executing/projects', headers={'If-None-Match': '"%s"' % digest})
+        self.assertEqual(304, response.code)
+
+
+class SpiderSettingsHandlerTest(AsyncHTTPTestCase):
+    project_name = 'test_settings'
+    spider_name = 'test_spider'
+
+    def setUp(self):
+        super(SpiderSettingsHandlerTest, self).setUp()
+        init_test_spider(self.project_name, self.spider_name)
+
+    def get_app(self):
+        return tornado.web.Application([
+            (r'/projects/(\w+)/spiders/(\w+)/settings', SpiderSettingsHandler),
+        ])
+
+    def post_priority(self, priority):
+        return self.fetch('/projects/%s/spiders/%s/settings' % (self.project_name, self.spider_name),
+                          method='POST', body='priority=%s' % priority, follow_redirects=False)
+
+    def spider_priority(self):
+        with session_scope() as session:
+            spider = session.query(Spider).filter_by(name=self.spider_name).join(Spider.project) \
+                .filter_by(name=self.project_name).first()
+            setting = session.query(SpiderSettings).filter_by(spider_id=spider.id, setting_key='priority').first()
+            return setting.value if setting else None
+
+    def test_priority(self):
+        self.assertEqual(302, self.post_priority('-5').code)
+        self.assertEqual('-5', self.spider_priority())
+
+        self.assertEqual(400, self.post_priority('high').code)
+        self.assertEqual('-5', self.spider_priority())
@@ -0,0 +1,43 @@
+import unittest
+import datetime
+from scrapydd.nodes import NodeManager
+from scrapydd.models import init_database, session_scope, Node
+from scrapydd.exceptions import NodeExpired
+
+
+class NodeManagerTest(unittest.TestCase):
+    def setUp(self):
+        init_database()
+        self.target = NodeManager(None)
+
+    def get_node(self, node_id):
+        with session_scope() as session:
+            return session.query(Node).filter_by(id=node_id).first()
+
+    def test_heartbeat_flushed(self):
+        node = self.target.create_node('127.0.0.1')
+        with session_scope() as session:
+            session.query(Node).filter_by(id=node.id)\
+                .update({'last_heartbeat': datetime.datetime.now() - datetime.timedelta(minutes=1)})
+        last_heartbeat = self.get_node(node.id).last_heartbeat
+
+        self.target.heartbeat(node.id)
+        # heartbeat is not written until flushed
+        self.assertEqual(last_heartbeat, self.get_node(node.id).last_heartbeat)
+
+        self.target.flush_heartbeats()
+        self.assertGreater(self.get_node(node.id).last_heartbeat, last_heartbeat)
+
+    def test_heartbeat_node_not_exist(self):
+        self.assertRaises(NodeExpired, self.target.heartbeat, -1)
+
+    def test_heartbeat_node_expired(self):
+        node = self.target.create_node('127.0.0.1')
+        self.target.heartbeat(node.id)
+
+        # the node is expired by other server process
+        with session_scope() as session:
+            session.query(Node).filter_by(id=node.id).update({'isalive': 0})
+        self.target.flush_heartbeats()
+
+        self.assertRaises(NodeExpired, self.target.heartbeat, node.id)
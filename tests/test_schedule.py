@@ -1,7 +1,15 @@
 import unittest
-from scrapydd.schedule import SchedulerManager
+from tornado.testing import AsyncTestCase, gen_test
+from scrapydd.schedule import SchedulerManager, JOB_STATUS_PENDING, JOB_STATUS_RUNNING, JOB_STATUS_SUCCESS, \
+    JOB_STATUS_FAIL
+from scrapydd.config import Config
+from scrapydd.nodes import NodeManager
+import os
+import tempfile
 import logging
-from scrapydd.models import Session, HistoricalJob, init_database
+import datetime
+from scrapydd.models import Session, HistoricalJob, init_database, session_scope, Project, Spider, \
+    SpiderExecutionQueue, SpiderSettings
 
 class SchedulerManagerTest(unittest.TestCase):
     def setUp(self):
@@ -28,3 +36,385 @@ class SchedulerManagerTest(unittest.TestCase):
         for job in session.query(HistoricalJob).filter(HistoricalJob.spider_id==spider_id):
             self.assertTrue(job.id in jobids)
         session.close()
+
+
+def init_test_spider(project_name, spider_name):
+    '''
+    Create the project and spider if not exist and clear the job queue.
+    '''
+    init_database()
+    with session_scope() as session:
+        session.query(SpiderExecutionQueue).delete()
+        project = session.query(Project).filter_by(name=project_name).first()
+        if project is None:
+            project = Project()
+            project.name = project_name
+            session.add(project)
+            session.flush()
+        spider = session.query(Spider).filter_by(project_id=project.id, name=spider_name).first()
+        if spider is None:
+            spider = Spider()
+            spider.project_id = project.id
+            spider.name = spider_name
+            session.add(spider)
+
+
+class SchedulerManagerDispatchTest(unittest.TestCase):
+    project_name = 'test_dispatch'
+    spider_name = 'test_spider'
+
+    def setUp(self):
+        logging.basicConfig(level=logging.DEBUG)
+        init_test_spider(self.project_name, self.spider_name)
+
+    def test_get_next_task(self):
+        target = SchedulerManager()
+        self.assertFalse(target.has_task())
+        job = target.add_task(self.project_name, self.spider_name)
+        self.assertTrue(target.has_task())
+
+        node_id = 1
+        next_task = target.get_next_task(node_id)
+        self.assertEqual(job.id, next_task.id)
+        self.assertEqual(JOB_STATUS_RUNNING, next_task.status)
+        self.assertEqual(node_id, next_task.node_id)
+        self.assertIsNotNone(next_task.start_time)
+
+    def test_get_next_task_claimed_once(self):
+        target = SchedulerManager()
+        target.add_task(self.project_name, self.spider_name)
+
+        self.assertIsNotNone(target.get_next_task(1))
+        # the task is already claimed by node 1, nothing left for node 2.
+        self.assertIsNone(target.get_next_task(2))
+        self.assertFalse(target.has_task())
+
+    def test_get_next_tasks(self):
+        target = SchedulerManager()
+        with session_scope() as session:
+            spider = session.query(Spider).filter_by(name=self.spider_name).first()
+        jobs = [target.add_task(self.project_name, self.spider_name)]
+        # add_task refuses to queue the same spider twice, so queue the second job directly.
+        job = SpiderExecutionQueue()
+        job.id = 'second_job'
+        job.spider_id = spider.id
+        job.project_name = self.project_name
+        job.spider_name = self.spider_name
+        job.update_time = datetime.datetime.now()
+        with session_scope() as session:
+            session.add(job)
+        jobs.append(job)
+
+        next_tasks = target.get_next_tasks(1, 5)
+        self.assertEqual([job.id for job in jobs], [task.id for task in next_tasks])
+        self.assertEqual([], target.get_next_tasks(2, 5))
+
+
+class SchedulerManagerJobsRunningTest(unittest.TestCase):
+    project_name = 'test_dispatch'
+    spider_name = 'test_spider'
+
+    def setUp(self):
+        init_test_spider(self.project_name, self.spider_name)
+
+    def test_jobs_running(self):
+        target = SchedulerManager()
+        target.add_task(self.project_name, self.spider_name)
+        job = target.get_next_task(1)
+        last_update_time = job.update_time
+
+        killing_jobs = target.jobs_running(1, [job.id, 'not_exist_job'])
+        self.assertEqual(['not_exist_job'], killing_jobs)
+        with session_scope() as session:
+            job = session.query(SpiderExecutionQueue).filter_by(id=job.id).first()
+        self.assertGreaterEqual(job.update_time, last_update_time)
+
+        # the job is not running on node 2
+        self.assertEqual([job.id], target.jobs_running(2, [job.id]))
+
+
+class SchedulerManagerFairShareTest(unittest.TestCase):
+    def setUp(self):
+        init_test_spider('test_fair_share_a', 'test_spider')
+        init_test_spider('test_fair_share_b', 'test_spider')
+        self.fire_time = datetime.datetime.now()
+
+    def add_pending_job(self, job_id, project_name, seconds, priority=0):
+        with session_scope() as session:
+            project = session.query(Project).filter_by(name=project_name).first()
+            spider = session.query(Spider).filter_by(project_id=project.id).first()
+            job = SpiderExecutionQueue()
+            job.id = job_id
+            job.spider_id = spider.id
+            job.project_name = project_name
+            job.spider_name = spider.name
+            job.fire_time = self.fire_time
+            job.update_time = self.fire_time + datetime.timedelta(seconds=seconds)
+            job.priority = priority
+            session.add(job)
+
+    def test_fair_share_between_projects(self):
+        for i in range(3):
+            self.add_pending_job('a_%d' % i, 'test_fair_share_a', i)
+        self.add_pending_job('b_0', 'test_fair_share_b', 10)
+
+        target = SchedulerManager()
+        next_tasks = target.get_next_tasks(1, 3)
+        # project b is not starved by the earlier jobs of project a
+        self.assertEqual(['a_0', 'b_0', 'a_1'], [task.id for task in next_tasks])
+
+    def test_fair_share_without_window_functions(self):
+        for i in range(3):
+            self.add_pending_job('a_%d' % i, 'test_fair_share_a', i)
+        self.add_pending_job('b_0', 'test_fair_share_b', 10)
+
+        target = SchedulerManager()
+        target._supports_window_functions = lambda session: False
+        next_tasks = target.get_next_tasks(1, 3)
+        self.assertEqual(['a_0', 'b_0', 'a_1'], [task.id for task in next_tasks])
+
+    def test_priority_first(self):
+        self.add_pending_job('a_0', 'test_fair_share_a', 0)
+        self.add_pending_job('b_0', 'test_fair_share_b', 10, priority=10)
+
+        target = SchedulerManager()
+        next_tasks = target.get_next_tasks(1, 2)
+        self.assertEqual(['b_0', 'a_0'], [task.id for task in next_tasks])
+
+    def test_priority_weighted_share(self):
+        for i in range(3):
+            self.add_pending_job('a_%d' % i, 'test_fair_share_a', i)
+            self.add_pending_job('b_%d' % i, 'test_fair_share_b', 10 + i, priority=1)
+
+        target = SchedulerManager()
+        next_tasks = target.get_next_tasks(1, 3)
+        # project b has twice the share of project a, but does not starve it
+        self.assertEqual(['b_0', 'a_0', 'b_1'], [task.id for task in next_tasks])
+
+    def set_spider_priority(self, value):
+        with session_scope() as session:
+            project = session.query(Project).filter_by(name='test_fair_share_a').first()
+            spider = session.query(Spider).filter_by(project_id=project.id).first()
+            session.query(SpiderSettings).filter_by(spider_id=spider.id).delete()
+            priority_setting = SpiderSettings()
+            priority_setting.spider_id = spider.id
+            priority_setting.setting_key = 'priority'
+            priority_setting.value = value
+            session.add(priority_setting)
+
+    def test_spider_priority_setting(self):
+        self.set_spider_priority('5')
+
+        target = SchedulerManager()
+        job = target.add_task('test_fair_share_a', 'test_spider')
+        self.assertEqual(5, job.priority)
+
+    def test_invalid_spider_priority_setting(self):
+        self.set_spider_priority('high')
+
+        target = SchedulerManager()
+        job = target.add_task('test_fair_share_a', 'test_spider')
+        self.assertEqual(0, job.priority)
+
+
+class SchedulerManagerPlacementTest(unittest.TestCase):
+    def setUp(self):
+        init_test_spider('test_fair_share_a', 'test_spider')
+        init_test_spider('test_fair_share_b', 'test_spider')
+        with session_scope() as session:
+            for project_name in ('test_fair_share_a', 'test_fair_share_b'):
+                project = session.query(Project).filter_by(name=project_name).first()
+                spider = session.query(Spider).filter_by(project_id=project.id).first()
+                session.query(SpiderSettings).filter_by(spider_id=spider.id).delete()
+        self.node_manager = NodeManager(None)
+        self.target = SchedulerManager()
+
+    def set_spider_tags(self, project_name, tags):
+        with session_scope() as session:
+            project = session.query(Project).filter_by(name=project_name).first()
+            spider = session.query(Spider).filter_by(project_id=project.id).first()
+            tags_setting = SpiderSettings()
+            tags_setting.spider_id = spider.id
+            tags_setting.setting_key = 'tags'
+            tags_setting.value = tags
+            session.add(tags_setting)
+
+    def test_node_tags(self):
+        self.set_spider_tags('test_fair_share_a', 'gpu')
+        self.target.add_task('test_fair_share_a', 'test_spider')
+
+        node = self.node_manager.create_node('127.0.0.1')
+        self.assertFalse(self.target.has_task(node.id))
+        self.assertEqual([], self.target.get_next_tasks(node.id, 1))
+
+        gpu_node = self.node_manager.create_node('127.0.0.1', tags=['gpu', 'ssd'])
+        self.assertTrue(self.target.has_task(gpu_node.id))
+        self.assertEqual(1, len(self.target.get_next_tasks(gpu_node.id, 1)))
+
+    def test_node_slots(self):
+        node = self.node_manager.create_node('127.0.0.1', slots=1)
+        self.target.add_task('test_fair_share_a', 'test_spider')
+        self.target.add_task('test_fair_share_b', 'test_spider')
+
+        # the node asks more tasks than its registered slots.
+        self.assertEqual(1, len(self.target.get_next_tasks(node.id, 2)))
+        # a task is still pending, but the node has no free slot for it.
+        self.assertTrue(self.target.has_task())
+        self.assertFalse(self.target.has_task(node.id))
+        self.assertEqual([], self.target.get_next_tasks(node.id, 1))
+
+    def test_prefer_node_projects(self):
+        node = self.node_manager.create_node('127.0.0.1')
+        self.target.add_task('test_fair_share_a', 'test_spider')
+        self.target.add_task('test_fair_share_b', 'test_spider')
+
+        next_tasks = self.target.get_next_tasks(node.id, 1, node_projects=['test_fair_share_b'])
+        self.assertEqual(['test_fair_share_b'], [task.project_name for task in next_tasks])
+
+
+class SchedulerManagerClearFinishedJobsTest(unittest.TestCase):
+    project_name = 'test_dispatch'
+    spider_name = 'test_spider'
+
+    def setUp(self):
+        init_test_spider(self.project_name, self.spider_name)
+        with session_scope() as session:
+            session.query(HistoricalJob).delete()
+            self.spider_id = session.query(Spider).filter_by(name=self.spider_name).first().id
+
+    def test_clear_finished_jobs(self):
+        config = Config(values={'job_history_limit_each_spider': '3'})
+        self.check_clear_finished_jobs(SchedulerManager(config=config))
+
+    def test_clear_finished_jobs_without_window_functions(self):
+        config = Config(values={'job_history_limit_each_spider': '3'})
+        target = SchedulerManager(config=config)
+        target._supports_window_functions = lambda session: False
+        self.check_clear_finished_jobs(target)
+
+    def check_clear_finished_jobs(self, target):
+        complete_time = datetime.datetime.now()
+        log_files = []
+        with session_scope() as session:
+            for i in range(5):
+                fd, log_file = tempfile.mkstemp(suffix='.log')
+                os.close(fd)
+                log_files.append(log_file)
+                job = HistoricalJob()
+                job.id = 'history_job_%d' % i
+                job.spider_id = self.spider_id
+                job.project_name = self.project_name
+                job.spider_name = self.spider_name
+                job.complete_time = complete_time + datetime.timedelta(seconds=i)
+                job.status = JOB_STATUS_SUCCESS
+                job.log_file = log_file
+                session.add(job)
+
+        target.clear_finished_jobs()
+        target.file_remove_executor.shutdown(wait=True)
+
+        with session_scope() as session:
+            job_ids = sorted(job.id for job in session.query(HistoricalJob))
+        # the latest 3 jobs are kept.
+        self.assertEqual(['history_job_2', 'history_job_3', 'history_job_4'], job_ids)
+        self.assertFalse(os.path.exists(log_files[0]))
+        self.assertFalse(os.path.exists(log_files[1]))
+        for log_file in log_files[2:]:
+            self.assertTrue(os.path.exists(log_file))
+            os.remove(log_file)
+
+
+class SchedulerManagerResetTimeoutJobTest(unittest.TestCase):
+    project_name = 'test_dispatch'
+    spider_name = 'test_spider'
+
+    def setUp(self):
+        init_test_spider(self.project_name, self.spider_name)
+        with session_scope() as session:
+            session.query(HistoricalJob).delete()
+            self.spider_id = session.query(Spider).filter_by(name=self.spider_name).first().id
+            session.query(SpiderSettings).filter_by(spider_id=self.spider_id).delete()
+            timeout_setting = SpiderSettings()
+            timeout_setting.spider_id = self.spider_id
+            timeout_setting.setting_key = 'timeout'
+            timeout_setting.value = '60'
+            session.add(timeout_setting)
+
+    def add_running_job(self, job_id, start_time, update_time):
+        with session_scope() as session:
+            job = SpiderExecutionQueue()
+            job.id = job_id
+            job.spider_id = self.spider_id
+            job.project_name = self.project_name
+            job.spider_name = self.spider_name
+            job.status = JOB_STATUS_RUNNING
+            job.node_id = 1
+            job.start_time = start_time
+            job.update_time = update_time
+            session.add(job)
+
+    def test_reset_timeout_job(self):
+        now = datetime.datetime.now()
+        self.add_running_job('not_refreshed_job', now - datetime.timedelta(minutes=2),
+                             now - datetime.timedelta(minutes=2))
+        self.add_running_job('running_too_long_job', now - datetime.timedelta(minutes=2), now)
+        self.add_running_job('running_job', now - datetime.timedelta(seconds=10), now)
+
+        target = SchedulerManager()
+        target.reset_timeout_job()
+
+        with session_scope() as session:
+            not_refreshed_job = session.query(SpiderExecutionQueue).filter_by(id='not_refreshed_job').first()
+            self.assertEqual(JOB_STATUS_PENDING, not_refreshed_job.status)
+            self.assertIsNone(not_refreshed_job.node_id)
+
+            self.assertIsNone(session.query(SpiderExecutionQueue).filter_by(id='running_too_long_job').first())
+            killed_job = session.query(HistoricalJob).filter_by(id='running_too_long_job').first()
+            self.assertEqual(JOB_STATUS_FAIL, killed_job.status)
+
+            running_job = session.query(SpiderExecutionQueue).filter_by(id='running_job').first()
+            self.assertEqual(JOB_STATUS_RUNNING, running_job.status)
+
+
+class SchedulerManagerWaitTaskTest(AsyncTestCase):
+    project_name = 'test_dispatch'
+    spider_name = 'test_spider'
+
+    def setUp(self):
+        super(SchedulerManagerWaitTaskTest, self).setUp()
+        init_test_spider(self.project_name, self.spider_name)
+        self.target = SchedulerManager()
+        self.target.ioloop = self.io_loop
+
+    @gen_test
+    def test_wait_task_notified(self):
+        future = self.target.wait_task(10)
+        self.assertFalse(future.done())
+        self.target.add_task(self.project_name, self.spider_name)
+        new_task = yield future
+        self.assertTrue(new_task)
+
+    @gen_test
+    def test_wait_task_has_pending(self):
+        self.target.add_task(self.project_name, self.spider_name)
+        future = self.target.wait_task(10)
+        self.assertTrue(future.done())
+        self.assertTrue(future.result())
+
+    @gen_test
+    def test_wait_task_timeout(self):
+        new_task = yield self.target.wait_task(0.1)
+        self.assertFalse(new_task)
+
+    @gen_test
+    def test_wait_task_node_cannot_lease(self):
+        init_test_spider('test_wait_task_other', self.spider_name)
+        node = NodeManager(None).create_node('127.0.0.1', slots=1)
+        self.target.add_task(self.project_name, self.spider_name)
+        self.target.get_next_task(node.id)
+        future = self.target.wait_task(0.5, node.id)
+        self.assertFalse(future.done())
+        # notified of a task the node has no free slot for.
+        self.target.add_task('test_wait_task_other', self.spider_name)
+        new_task = yield future
+        self.assertFalse(new_task)
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+from scrapydd.storage import compress_file
+from scrapydd.stats import read_log_stats, parse_stats, numeric_stats
+
+LOG_TAIL = '''2017-06-08 10:52:38 [scrapy.core.engine] INFO: Closing spider (finished)
+2017-06-08 10:52:38 [scrapy.statscollectors] INFO: Dumping Scrapy stats:
+{'downloader/request_bytes': 211,
+ 'downloader/response_status_count/200': 1,
+ 'finish_reason': 'finished',
+ 'finish_time': datetime.datetime(2017, 6, 8, 2, 52, 38, 597000),
+ 'item_scraped_count': 12,
+ 'log_count/DEBUG': 14,
+ 'log_count/ERROR': 1,
+ 'memusage/max': 48840704,
+ 'start_time': datetime.datetime(2017, 6, 8, 2, 52, 37, 931000)}
+2017-06-08 10:52:38 [scrapy.core.engine] INFO: Spider closed (finished)
+'''
+
+
+class ReadLogStatsTest(unittest.TestCase):
+    def write_log(self, content):
+        fd, log_file = tempfile.mkstemp()
+        os.write(fd, content)
+        os.close(fd)
+        self.addCleanup(os.remove, log_file)
+        return log_file
+
+    def test_read_log_stats(self):
+        log_file = self.write_log('2017-06-08 10:52:37 [scrapy] DEBUG: Scraped item\n' * 10000 + LOG_TAIL)
+        stats = read_log_stats(log_file, tail_size=1024)
+        self.assertEqual(12, stats['item_scraped_count'])
+        self.assertEqual(1, stats['log_count/ERROR'])
+        self.assertEqual('finished', stats['finish_reason'])
+        self.assertEqual('2017-06-08 02:52:38', stats['finish_time'])
+        self.assertEqual(9, len(stats))
+
+    def test_read_log_stats_extends_tail(self):
+        log_file = self.write_log(LOG_TAIL + '2017-06-08 10:52:39 [twisted] INFO: Main loop terminated.\n' * 100)
+        self.assertEqual(12, read_log_stats(log_file, tail_size=64)['item_scraped_count'])
+
+    def test_read_compressed_log_stats(self):
+        log_file = compress_file(self.write_log('2017-06-08 10:52:37 [scrapy] DEBUG: Scraped item\n' * 10000 + LOG_TAIL))
+        self.addCleanup(os.remove, log_file)
+        self.assertEqual(12, read_log_stats(log_file, max_tail_size=1024)['item_scraped_count'])
+
+    def test_read_log_stats_not_found(self):
+        log_file = self.write_log('2017-06-08 10:52:37 [scrapy] DEBUG: Scraped item\n' * 100)
+        self.assertIsNone(read_log_stats(log_file, tail_size=64, max_tail_size=256))
+        self.assertIsNone(read_log_stats(self.write_log('')))
+
+    def test_parse_stats_rejects_calls(self):
+        self.assertIsNone(parse_stats("{'a': os.system('ls')}"))
+        self.assertIsNone(parse_stats("{'a': 1,"))
+
+
+class NumericStatsTest(unittest.TestCase):
+    def test_numeric_stats(self):
+        stats = parse_stats(LOG_TAIL[LOG_TAIL.index('{'):])
+        values = numeric_stats(stats)
+        self.assertEqual(12, values['item_scraped_count'])
+        self.assertEqual(48840704, values['memusage/max'])
+        self.assertEqual(1, values['elapsed_time_seconds'])
+        self.assertNotIn('finish_reason', values)
+        self.assertNotIn('finish_time', values)
@@ -0,0 +1,58 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from scrapydd.storage import compress_file, open_file, iter_file, file_checksum
+
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.content = b'{"a": 1}\n' * 100000
+        self.source = os.path.join(self.tmpdir, 'job.jl')
+        with open(self.source, 'wb') as f:
+            f.write(self.content)
+
+    def test_compress_file(self):
+        target = compress_file(self.source)
+        self.assertEqual(self.source + '.gz', target)
+        self.assertLess(os.path.getsize(target), len(self.content))
+        with gzip.open(target, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+        self.assertEqual([os.path.basename(self.source), os.path.basename(target)], sorted(os.listdir(self.tmpdir)))
+
+    def test_open_file(self):
+        target = compress_file(self.source)
+        for path in [self.source, target]:
+            f = open_file(path)
+            self.assertEqual(b'{"a": 1}\n', f.readline())
+            f.close()
+
+    def test_iter_file(self):
+        target = compress_file(self.source)
+        self.assertEqual(self.content, b''.join(iter_file(target, chunk_size=1000)))
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), b''.join(iter_file(target, decompress=False)))
+
+    def test_iter_file_range(self):
+        target = compress_file(self.source)
+        for path in [self.source, target]:
+            self.assertEqual(self.content[1000:5000], b''.join(iter_file(path, chunk_size=1000, start=1000, end=5000)))
+            self.assertEqual(self.content[-10:], b''.join(iter_file(path, start=len(self.content) - 10)))
+
+    def test_iter_file_skip_compressed(self):
+        target = compress_file(self.source)
+        chunks = list(iter_file(target, chunk_size=1000, start=3000, end=4000))
+        # an empty chunk for each chunk skipped by decompressing
+        self.assertEqual([b'', b'', b'', self.content[3000:4000]], chunks)
+
+    def test_compress_file_from_offset(self):
+        target = compress_file(self.source, os.path.join(self.tmpdir, 'rest.gz'), start=1000)
+        with gzip.open(target, 'rb') as f:
+            self.assertEqual(self.content[1000:], f.read())
+
+    def test_file_checksum(self):
+        self.assertEqual(hashlib.md5(self.content).hexdigest(), file_checksum(self.source))
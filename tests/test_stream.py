@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from poster.encode import multipart_encode, MultipartParam
+from scrapydd.stream import PostDataStreamer
+
+
+def encode_body(params):
+    datagen, headers = multipart_encode(params)
+    return b''.join(datagen), int(headers['Content-Length'])
+
+
+class PostDataStreamerTest(unittest.TestCase):
+    def receive(self, body, total, chunk_size):
+        target = PostDataStreamer(total)
+        for i in range(0, len(body), chunk_size):
+            target.receive(body[i:i+chunk_size])
+        target.finish_receive()
+        self.addCleanup(target.release_parts)
+        return target
+
+    def test_values(self):
+        body, total = encode_body({'task_id': 'abc', 'status': 'success'})
+        for chunk_size in [1, 7, 100, len(body)]:
+            target = self.receive(body, total, chunk_size)
+            self.assertEqual({'task_id': 'abc', 'status': 'success'},
+                             target.get_values(['task_id', 'status']))
+
+    def test_file_part(self):
+        content = b'line1\r\nline2\r\n' * 1000
+        body, total = encode_body([('task_id', 'abc'),
+                                   MultipartParam('log', filename='log.log', fileobj=BytesIO(content), filesize=len(content))])
+        for chunk_size in [1, 7, 100, 4096, len(body)]:
+            target = self.receive(body, total, chunk_size)
+            part = target.get_parts_by_name('log')[0]
+            self.assertEqual(len(content), part['size'])
+            self.assertEqual(content, target.get_part_payload(part))
+            self.assertEqual('abc', target.get_values(['task_id'])['task_id'])
+
+    def test_boundary_alike_data(self):
+        body, total = encode_body({'task_id': 'abc'})
+        boundary = body[:body.index(b'\r\n')]
+        content = b'\r\n' + boundary + b'x\r\n' + boundary[:-3] + b'\r\n' + boundary
+        body, total = encode_body([MultipartParam('log', filename='log.log', fileobj=BytesIO(content), filesize=len(content)),
+                                   ('task_id', 'abc')])
+        for chunk_size in [1, 3, 100, len(body)]:
+            target = self.receive(body, total, chunk_size)
+            part = target.get_parts_by_name('log')[0]
+            self.assertEqual(content, target.get_part_payload(part))
+            self.assertEqual('abc', target.get_values(['task_id'])['task_id'])
+
+    def test_empty_part(self):
+        body, total = encode_body([MultipartParam('log', filename='log.log', fileobj=BytesIO(b''), filesize=0),
+                                   ('task_id', 'abc')])
+        target = self.receive(body, total, 5)
+        self.assertEqual(b'', target.get_part_payload(target.get_parts_by_name('log')[0]))
+        self.assertEqual('abc', target.get_values(['task_id'])['task_id'])
+
+    def test_move_part(self):
+        content = b'line1\r\nline2\r\n' * 1000
+        body, total = encode_body([('task_id', 'abc'),
+                                   MultipartParam('log', filename='log.log', fileobj=BytesIO(content), filesize=len(content))])
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        target = PostDataStreamer(total, tmpdir=tmpdir)
+        target.receive(body)
+        target.finish_receive()
+        part = target.get_parts_by_name('log')[0]
+        tmpfile = part['tmpfile'].name
+        self.assertEqual(tmpdir, os.path.dirname(tmpfile))
+
+        log_file = os.path.join(tmpdir, 'job.log')
+        target.move_part(part, log_file)
+        target.release_parts()
+
+        self.assertFalse(os.path.exists(tmpfile))
+        with open(log_file, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual([log_file], [os.path.join(tmpdir, x) for x in os.listdir(tmpdir)])
@@ -6,6 +6,10 @@ import tornado
 import tornado.web
 from tornado.testing import AsyncTestCase, AsyncHTTPTestCase
 import json
+import shutil
+import tempfile
+from scrapydd.config import Config
+from scrapydd.settting import SpiderSettingLoader
 
 
 class WebhookRequestHandler(tornado.web.RequestHandler):
@@ -148,6 +152,55 @@ class WebhookJobExecutorTest(AsyncHTTPTestCase):
         self.assertEqual(self.batches[2][0]['a'], '3')
 
 
+class FakeWebhookJobStateStorage(WebhookJobStateStorage):
+    def __init__(self, next_job):
+        self.next_job = next_job
+        self.failed_jobs = []
 
+    def get_next_job(self):
+        next_job, self.next_job = self.next_job, None
+        return next_job
 
+    def start_job(self, job_id):
+        pass
 
+    def job_failed(self, job_id):
+        self.failed_jobs.append(job_id)
+
+
+class WebhookDaemonTest(AsyncTestCase):
+    def setUp(self):
+        super(WebhookDaemonTest, self).setUp()
+        self.target = WebhookDaemon(Config(), SpiderSettingLoader())
+        self.addCleanup(self.target.poll_next_job_callback.stop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_check_job_items_file_missing(self):
+        job = WebhookJob()
+        job.id = 1
+        job.items_file = os.path.join(self.tmpdir, 'removed.jl')
+        job.payload_url = 'http://localhost/update'
+        self.target.storage = FakeWebhookJobStateStorage(job)
+
+        self.target.check_job()
+        # the job fails instead of stalling the queue
+        self.assertEqual([1], self.target.storage.failed_jobs)
+        self.assertIsNone(self.target.current_job)
+
+    def test_link_items_file_fallback_to_copy(self):
+        items_file = os.path.join(self.tmpdir, 'link_items_file_test.jl')
+        with open(items_file, 'wb') as f:
+            f.write(b'{"a": 1}\n')
+        def link(source, link_name):
+            raise OSError('hardlink is not supported')
+        self.addCleanup(setattr, os, 'link', os.link)
+        os.link = link
+
+        task_items_file = self.target.link_items_file(items_file)
+        self.addCleanup(os.remove, task_items_file)
+        self.assertEqual(self.target.queue_file_dir, os.path.dirname(task_items_file))
+        # the queued file survives the cleaning of the stored one
+        os.remove(items_file)
+        with open(task_items_file, 'rb') as f:
+            self.assertEqual(b'{"a": 1}\n', f.read())
@@ -0,0 +1,134 @@
+import os
+import shutil
+import stat
+import tempfile
+from tornado.process import Subprocess
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+from scrapydd.workspace import ProjectWorkspace
+from scrapydd.exceptions import ProcessFailed
+
+
+class ProjectWorkspacePipInstallTest(AsyncTestCase):
+    def setUp(self):
+        super(ProjectWorkspacePipInstallTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.pip_calls_file = os.path.join(self.tmpdir, 'pip_calls')
+        # a python recording its calls, so installs can be counted without a virtualenv
+        fake_python = os.path.join(self.tmpdir, 'python')
+        with open(fake_python, 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> %s\n' % self.pip_calls_file)
+        os.chmod(fake_python, os.stat(fake_python).st_mode | stat.S_IEXEC)
+        self.fake_python = fake_python
+
+    def tearDown(self):
+        # the SIGCHLD handler is bound to the IOLoop of this test
+        Subprocess.uninitialize()
+        super(ProjectWorkspacePipInstallTest, self).tearDown()
+
+    def create_workspace(self):
+        workspace = ProjectWorkspace('test_project')
+        workspace.project_workspace_dir = self.tmpdir
+        workspace.python = self.fake_python
+        return workspace
+
+    def pip_calls(self):
+        if not os.path.exists(self.pip_calls_file):
+            return []
+        with open(self.pip_calls_file) as f:
+            return f.read().splitlines()
+
+    @gen_test(timeout=10)
+    def test_pip_install_skipped_when_installed(self):
+        yield self.create_workspace().pip_install(['scrapy', 'requests'])
+        yield self.create_workspace().pip_install(['requests', 'scrapy'])
+        self.assertEqual(['-m pip install scrapy requests'], self.pip_calls())
+
+        yield self.create_workspace().pip_install(['requests'])
+        self.assertEqual(['-m pip install scrapy requests', '-m pip install requests'], self.pip_calls())
+
+    @gen_test(timeout=10)
+    def test_concurrent_pip_install_coalesced(self):
+        futures = [self.create_workspace().pip_install(['scrapy']) for i in range(3)]
+        futures.append(self.create_workspace().pip_install(['scrapy', 'requests']))
+        yield futures
+        self.assertEqual(['-m pip install scrapy', '-m pip install scrapy requests'], self.pip_calls())
+
+    @gen_test(timeout=10)
+    def test_spider_list(self):
+        with open(self.fake_python, 'w') as f:
+            f.write('#!/bin/sh\necho spider1\necho spider2\n')
+        spiders = yield self.create_workspace().spider_list('test_project')
+        self.assertEqual(['spider1', 'spider2'], spiders)
+
+    @gen_test(timeout=10)
+    def test_pip_install_output_drained(self):
+        # much more output than a pipe buffer holds, before failing
+        with open(self.fake_python, 'w') as f:
+            f.write('#!/bin/sh\nhead -c 3000000 /dev/zero\nhead -c 100000 /dev/zero >&2\necho error >&2\nexit 1\n')
+        try:
+            yield self.create_workspace().pip_install(['scrapy'])
+            self.fail('ProcessFailed not raised')
+        except ProcessFailed as e:
+            self.assertEqual(1024 * 1024, len(e.std_output))
+            self.assertEqual(100006, len(e.err_output))
+            self.assertTrue(e.err_output.endswith('error\n'))
+
+
+class ProjectWorkspacePoolTest(AsyncTestCase):
+    def setUp(self):
+        super(ProjectWorkspacePoolTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(setattr, ProjectWorkspace, 'pool_root', ProjectWorkspace.pool_root)
+        self.addCleanup(setattr, ProjectWorkspace, 'workspace_root', ProjectWorkspace.workspace_root)
+        ProjectWorkspace.pool_root = os.path.join(self.tmpdir, 'pool')
+        ProjectWorkspace.workspace_root = os.path.join(self.tmpdir, 'workspace')
+
+    def create_pooled_virtualenv(self, name):
+        bin_dir = os.path.join(ProjectWorkspace.pool_root, name, 'bin')
+        os.makedirs(bin_dir)
+        for script in ['pip', 'python']:
+            open(os.path.join(bin_dir, script), 'w').close()
+
+    @gen_test
+    def test_init_takes_pooled_virtualenv(self):
+        self.create_pooled_virtualenv('venv-1')
+        # an unfinished one is not taken
+        os.makedirs(os.path.join(ProjectWorkspace.pool_root, 'venv-2.tmp'))
+
+        workspace = yield ProjectWorkspace('test_project').init()
+
+        self.assertTrue(os.path.exists(workspace.python))
+        self.assertEqual([], ProjectWorkspace.list_pooled_virtualenvs())
+        self.assertEqual(['test_project'], ProjectWorkspace.list_ready_projects())
+
+    @gen_test
+    def test_pool_refilled_after_taken(self):
+        self.addCleanup(setattr, ProjectWorkspace, 'pool_size', ProjectWorkspace.pool_size)
+        self.addCleanup(setattr, ProjectWorkspace, 'create_virtualenv', ProjectWorkspace.__dict__['create_virtualenv'])
+        built = []
+
+        @gen.coroutine
+        def create_virtualenv(cls, path):
+            built.append(path)
+            bin_dir = os.path.join(path, 'bin')
+            os.makedirs(bin_dir)
+            for script in ['pip', 'python']:
+                open(os.path.join(bin_dir, script), 'w').close()
+            raise gen.Return(path)
+        ProjectWorkspace.create_virtualenv = classmethod(create_virtualenv)
+
+        yield ProjectWorkspace.fill_pool(1)
+        self.assertEqual(1, len(built))
+        # the pool is full, nothing is built
+        yield ProjectWorkspace.fill_pool(1)
+        self.assertEqual(1, len(built))
+
+        yield ProjectWorkspace('test_project').init()
+        yield gen.moment
+        if ProjectWorkspace._pool_filling is not None:
+            yield ProjectWorkspace._pool_filling
+        self.assertEqual(2, len(built))
+        self.assertEqual(1, len(ProjectWorkspace.list_pooled_virtualenvs()))